@@ -0,0 +1,190 @@
+# admission.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Resource-aware admission control for annotator instances
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import shutil
+import threading
+
+MB = 1024 * 1024
+
+
+"""Estimate the resources needed to annotate an input file of a given size
+driver.run() writes one temp file per stage (.1 .. .14) next to the input
+and only deletes them at the end, so disk usage peaks at roughly
+(stages + 2) times the input size. Memory is a fixed interpreter/MySQL
+client cost plus a small multiple of the input size.
+"""
+def estimate_footprint(object_size, disk_factor=16, base_memory_mb=150,
+    memory_factor=2):
+    return {
+        'disk': int(object_size * disk_factor),
+        'memory': int(base_memory_mb * MB + object_size * memory_factor)
+    }
+
+
+"""Available memory in bytes, as reported by the kernel
+Falls back to MemFree on kernels that do not report MemAvailable
+"""
+def available_memory():
+    meminfo = {}
+    try:
+        with open('/proc/meminfo', 'r') as fh:
+            for line in fh:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.strip().split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+    return meminfo.get('MemAvailable', meminfo.get('MemFree'))
+
+
+"""Resident set size of a process in bytes (None if it has exited)
+"""
+def process_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return 0
+
+
+"""Free bytes on the file system holding the jobs directory
+"""
+def available_disk(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+"""1-minute load average normalised by the number of CPUs
+"""
+def normalised_load():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return 0.0
+
+
+"""Admission controller
+Keeps a reservation for every job launched by this process until its
+annotation subprocess exits, and only admits a new job if the host has
+enough free memory, disk and CPU for it on top of those reservations.
+"""
+class AdmissionController(object):
+    def __init__(self, jobs_dir, max_jobs=4, max_load=1.5,
+        min_free_disk_mb=512, min_free_memory_mb=256, disk_factor=16,
+        base_memory_mb=150, memory_factor=2):
+        self.jobs_dir = jobs_dir
+        self.max_jobs = int(max_jobs)
+        self.max_load = float(max_load)
+        self.min_free_disk = int(min_free_disk_mb) * MB
+        self.min_free_memory = int(min_free_memory_mb) * MB
+        self.disk_factor = float(disk_factor)
+        self.base_memory_mb = float(base_memory_mb)
+        self.memory_factor = float(memory_factor)
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    """Build a controller from a flat mapping of settings
+    Accepts either the Flask app.config or the [admission] section of
+    ann_config.ini, so the webhook and the polling annotator share limits.
+    """
+    @classmethod
+    def from_config(cls, jobs_dir, settings):
+        return cls(jobs_dir,
+            max_jobs=settings['ANNOTATOR_MAX_JOBS'],
+            max_load=settings['ANNOTATOR_MAX_LOAD'],
+            min_free_disk_mb=settings['ANNOTATOR_MIN_FREE_DISK_MB'],
+            min_free_memory_mb=settings['ANNOTATOR_MIN_FREE_MEMORY_MB'],
+            disk_factor=settings['ANNOTATOR_DISK_FACTOR'],
+            base_memory_mb=settings['ANNOTATOR_BASE_MEMORY_MB'],
+            memory_factor=settings['ANNOTATOR_MEMORY_FACTOR'])
+
+    """Drop reservations for jobs whose subprocess has finished
+    """
+    def reap(self):
+        for job_id, job in list(self.jobs.items()):
+            process = job['process']
+            if process is not None and process.poll() is not None:
+                del self.jobs[job_id]
+
+    """Memory still owed to running jobs: reserved minus what they already use
+    """
+    def _outstanding_memory(self):
+        outstanding = 0
+        for job in self.jobs.values():
+            rss = 0
+            if job['process'] is not None:
+                rss = process_rss(job['process'].pid) or 0
+            outstanding += max(0, job['memory'] - rss)
+        return outstanding
+
+    """Decide whether a job with an input of object_size bytes can run now
+    Returns (admitted, reason); on success the job's footprint is reserved
+    until release() is called or its process (see track()) exits.
+    """
+    def admit(self, job_id, object_size):
+        footprint = estimate_footprint(object_size,
+            disk_factor=self.disk_factor,
+            base_memory_mb=self.base_memory_mb,
+            memory_factor=self.memory_factor)
+
+        with self.lock:
+            self.reap()
+
+            if job_id in self.jobs:
+                return True, 'already admitted'
+
+            if len(self.jobs) >= self.max_jobs:
+                return False, f'{len(self.jobs)} jobs already running'
+
+            load = normalised_load()
+            if self.jobs and load > self.max_load:
+                return False, f'load average {load:.2f} per CPU'
+
+            reserved_disk = sum(job['disk'] for job in self.jobs.values())
+            free_disk = available_disk(self.jobs_dir) - reserved_disk
+            if free_disk - footprint['disk'] < self.min_free_disk:
+                return False, f'needs {footprint["disk"] // MB} MB disk, ' \
+                    f'{max(free_disk, 0) // MB} MB free'
+
+            free_memory = available_memory()
+            if free_memory is not None:
+                free_memory -= self._outstanding_memory()
+                if free_memory - footprint['memory'] < self.min_free_memory:
+                    return False, f'needs {footprint["memory"] // MB} MB ' \
+                        f'memory, {max(free_memory, 0) // MB} MB available'
+
+            self.jobs[job_id] = dict(footprint, process=None)
+            return True, 'admitted'
+
+    """Attach the annotation subprocess to an admitted job
+    """
+    def track(self, job_id, process):
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id]['process'] = process
+
+    """Give back a reservation (e.g. the download or launch failed)
+    """
+    def release(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    """Number of admitted jobs that have not finished yet
+    """
+    def running(self):
+        with self.lock:
+            self.reap()
+            return len(self.jobs)
+
+### EOF
@@ -15,6 +15,32 @@ class Config(object):
   ANNOTATOR_BASE_DIR = "/home/ubuntu/gas/ann/"
   ANNOTATOR_JOBS_DIR = "/home/ubuntu/gas/ann/jobs"
   ANNOTATOR_RUN_SCRIPT_PATH = "/home/ubuntu/gas/ann/run.py"
+  # run.py appends metrics here; served by the webhook on /metrics
+  ANNOTATOR_METRICS_EVENT_LOG = "/home/ubuntu/gas/ann/metrics_events.log"
+  ANNOTATOR_REFERENCE_VERSION = "2019-01"
+  # Inputs at least this large are streamed from S3 by run.py instead of
+  # being downloaded up front (0 disables streaming)
+  ANNOTATOR_STREAMING_MIN_MB = 256
+
+  # Admission control: limits on concurrent jobs and host resources
+  ANNOTATOR_MAX_JOBS = 4
+  ANNOTATOR_MAX_LOAD = 1.5
+  ANNOTATOR_MIN_FREE_DISK_MB = 512
+  ANNOTATOR_MIN_FREE_MEMORY_MB = 256
+  ANNOTATOR_DISK_FACTOR = 16
+  ANNOTATOR_BASE_MEMORY_MB = 150
+  ANNOTATOR_MEMORY_FACTOR = 2
+  # Seconds a rejected message stays hidden before another instance sees it
+  ANNOTATOR_ADMISSION_RETRY_DELAY = 30
+
+  # Seconds between background queue drains when no SNS wakeup arrives
+  ANNOTATOR_DISPATCH_IDLE_POLL = 60
+
+  # A running job's request message (and its run lease in DynamoDB) is
+  # kept hidden for ANNOTATOR_VISIBILITY_TIMEOUT seconds, renewed every
+  # ANNOTATOR_VISIBILITY_HEARTBEAT seconds until run.py exits
+  ANNOTATOR_VISIBILITY_TIMEOUT = 300
+  ANNOTATOR_VISIBILITY_HEARTBEAT = 60
 
   AWS_REGION_NAME = "us-east-1"
 
@@ -23,6 +49,10 @@ class Config(object):
   AWS_S3_RESULTS_BUCKET = "gas-results"
 
   # AWS SNS topics
+  # Job status changes, for the web app's cache and live status page
+  AWS_SNS_JOB_STATUS_TOPIC = "arn:aws:sns:us-east-1:127134666975:haoyiran_a17_job_status"
+  # Completed jobs, for the archive utility's delay scheduler
+  AWS_SNS_RESULTS_READY_TOPIC = "arn:aws:sns:us-east-1:127134666975:haoyiran_a17_results_ready"
 
   # AWS SQS queues
   AWS_SQS_WAIT_TIME = 20
@@ -31,9 +61,8 @@ class Config(object):
 
   # AWS DynamoDB
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "haoyiran_annotations"
+  AWS_DYNAMODB_RESULTS_INDEX_TABLE = "haoyiran_results_index"
 
   # AWS Lambda
   
-  # AWS Step Function
-  AWS_STEPFUNCTION_WAITING_ENGINE = "arn:aws:states:us-east-1:127134666975:stateMachine:haoyiran_a17_waiting_engine"
 ### EOF
\ No newline at end of file
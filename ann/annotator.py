@@ -1,10 +1,13 @@
 import subprocess
 import os
+import time
 import boto3
 from botocore.exceptions import ClientError
 import json
 from configparser import ConfigParser
 
+from admission import AdmissionController
+
 if __name__ == '__main__':
     config = ConfigParser(os.environ)
     config.read('/home/ubuntu/gas/ann/ann_config.ini')
@@ -13,6 +16,8 @@ if __name__ == '__main__':
     base_directory = config['ann']['ANNOTATOR_BASE_DIR']
     job_directory = config['ann']['ANNOTATOR_JOBS_DIR']
     run_script_path = config['ann']['ANNOTATOR_RUN_SCRIPT_PATH']
+    admission = AdmissionController.from_config(job_directory, config['admission'])
+    retry_delay = int(config['admission']['ANNOTATOR_ADMISSION_RETRY_DELAY'])
 
     # Connect to SQS and get queue
     sqs_resource = boto3.resource("sqs", region_name = config['aws']['AWS_REGION_NAME'])
@@ -23,11 +28,17 @@ if __name__ == '__main__':
         print(f'Getting message queue from SQS failed: {str(e.response)}')
     else: 
         while True:
-            print("Asking SQS for up to 10 messages.")
+            # Wait for a free slot before taking more work off the queue
+            free_slots = admission.max_jobs - admission.running()
+            if free_slots <= 0:
+                time.sleep(5)
+                continue
+
+            print(f"Asking SQS for up to {free_slots} messages.")
             # Get messages
             try: 
                 wait_time = int(config['sqs']['AWS_SQS_WAIT_TIME'])
-                max_num_message = int(config['sqs']['AWS_SQS_MAX_MESSAGES'])
+                max_num_message = min(int(config['sqs']['AWS_SQS_MAX_MESSAGES']), free_slots)
                 messages = queue.receive_messages(WaitTimeSeconds = wait_time, 
                                                   MaxNumberOfMessages = max_num_message)
             except ClientError as error:
@@ -48,6 +59,16 @@ if __name__ == '__main__':
                             jobID = msg_body["job_id"]
                             userID = msg_body["user_id"]
 
+                            # leave the message on the queue if the host is saturated
+                            s3_resource = boto3.resource('s3', region_name = config['aws']['AWS_REGION_NAME'])
+                            object_size = s3_resource.meta.client.head_object(
+                                Bucket=bucket, Key=fileKey)['ContentLength']
+                            admitted, reason = admission.admit(jobID, object_size)
+                            if not admitted:
+                                print(f'Deferring job {jobID}: {reason}')
+                                message.change_visibility(VisibilityTimeout=retry_delay)
+                                continue
+
                             # create user and job folder
                             user_does_exist = os.path.exists(f'{job_directory}/{userID}')
                             if not user_does_exist:
@@ -58,7 +79,6 @@ if __name__ == '__main__':
 
                             # download file from s3
                             # referring to documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
-                            s3_resource = boto3.resource('s3', region_name = config['aws']['AWS_REGION_NAME'])
                             s3_resource.meta.client.download_file(bucket, fileKey, f'{job_directory}/{userID}/{jobID}/{fileName}')
 
                             # start a new process to annotate
@@ -66,15 +86,20 @@ if __name__ == '__main__':
                                 f'python {run_script_path} {userID}/{jobID}/{fileName}',
                                 cwd = job_directory,
                                 shell = True) 
+                            admission.track(jobID, anno_process)
                         except ClientError as boto3_e:
+                            admission.release(jobID)
                             print(f'Downloading from S3 failed: {boto3_e.response}') 
                         # subprocess exception list
                         # referring to: https://docs.python.org/3/library/subprocess.html
                         except subprocess.SubprocessError as subprocess_e:
+                            admission.release(jobID)
                             print("Opening subprocess failed: " + str(subprocess_e))
                         except OSError as os_e:
+                            admission.release(jobID)
                             print("OSError ocurred: " + str(os_e))
                         except Exception as other_e:
+                            admission.release(jobID)
                             print("Other error: " + str(other_e))
                         else:
                             # update job status on db to RUNNING
@@ -16,38 +16,515 @@ import botocore
 import json
 import os
 import subprocess
+import sys
+import threading
+import time
+from decimal import Decimal
+
+from admission import AdmissionController
+
+# Import shared metrics and tracing helpers from util
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'util'))
+import metrics
+import tracing
 
 app = Flask(__name__)
 environment = 'ann_config.Config'
 app.config.from_object(environment)
 
+# Tracks jobs launched by this instance so we only accept what fits
+admission = AdmissionController.from_config(
+  app.config['ANNOTATOR_JOBS_DIR'], app.config)
+
+# Runtime metrics served on /metrics; run.py reports per-job timings
+# through the event log
+registry = metrics.Registry()
+gas_metrics = metrics.gas_metrics(registry)
+gas_metrics['jobs_in_flight'].set_function(admission.running, service='annotator')
+metrics.instrument_flask_app(app, registry, gas_metrics, 'annotator',
+  event_logs=[app.config['ANNOTATOR_METRICS_EVENT_LOG']])
+
+
+"""Count a failed processing step
+"""
+def count_error(step):
+  gas_metrics['errors'].inc(service='annotator', step=step)
+
+
+"""Process a single job request message
+Claims the job (PENDING, or RUNNING with an expired run lease when a
+job is redelivered to resume), downloads the input file and launches
+AnnTools as a subprocess. The message then stays in flight with the
+job (see InFlightJobs). Returns True if the message should be deleted
+right away: its job has already finished.
+"""
+def process_message(message):
+  received_at = time.time()
+  # Parse JSON message
+  print("new message")
+  try:
+    msg_body = json.loads(json.loads(message.body)["Message"])
+    print(msg_body)
+  except ValueError as e:
+    count_error('decode')
+    print({
+      "code": 500,
+      "message": f'Unable to decode message into json: {e}'
+    })
+    return False
+
+  try:
+    bucket = msg_body["s3_inputs_bucket"]
+    inputfile_path_s3 = msg_body["s3_key_input_file"]
+    file_name = msg_body["input_file_name"]
+    job_id = msg_body["job_id"]
+    user_id = msg_body["user_id"]
+  except KeyError as e:
+    count_error('decode')
+    print({
+      "code": 500,
+      "message": f'Missing field in message: {e}'
+    })
+    return False
+
+  # size up the input file and check this host has room for the job
+  s3_resource = boto3.resource('s3', region_name = app.config['AWS_REGION_NAME'])
+  try:
+    object_size = s3_resource.meta.client.head_object(
+      Bucket=bucket, Key=inputfile_path_s3)['ContentLength']
+  except botocore.exceptions.ClientError as e:
+    count_error('head_object')
+    if e.response['Error']['Code'] == "404":
+      print({
+        "code": 404,
+        "message": f'File does not exit on S3: {e}'
+      })
+    else:
+      print({
+        "code": 500,
+        "message": f'Unable to get input file size from S3: {e}'
+      })
+    return False
+
+  # carry the job's trace through this instance and into run.py
+  trace = tracing.Trace.from_message(msg_body, 'annotator')
+  trace.add_wait('sqs_wait', received_at)
+
+  if in_flight.has(job_id):
+    # a duplicate of a job running here; it comes back if that run fails
+    print(f'Job {job_id} is already running on this instance')
+    return False
+
+  admitted, reason = admission.admit(job_id, object_size)
+  if not admitted:
+    # leave the message on the queue for a less busy instance
+    print(f'Deferring job {job_id}: {reason}')
+    try:
+      message.change_visibility(
+        VisibilityTimeout=int(app.config['ANNOTATOR_ADMISSION_RETRY_DELAY']))
+    except botocore.exceptions.ClientError as e:
+      print(f'Unable to change message visibility: {e}')
+    return False
+
+  # mark the job RUNNING before anything is launched, so only one copy
+  # runs even if the message is delivered twice
+  claimed = claim_job(job_id, trace, message)
+  if claimed is not True:
+    admission.release(job_id)
+    return claimed is None
+  # the spans so far were written with the claim
+  trace.spans = []
+
+  # variables for file paths
+  base_directory = app.config['ANNOTATOR_BASE_DIR']
+  user_directory = base_directory + "jobs/" + user_id
+  job_directory = base_directory + "jobs/" + user_id + "/" + job_id
+  inputfile_path = job_directory + "/" + file_name
+
+  # create user and job folder
+  try:
+    user_does_exist = os.path.exists(user_directory)
+    if not user_does_exist:
+        os.makedirs(user_directory)
+    job_does_exist = os.path.exists(job_directory)
+    if not job_does_exist:
+        os.makedirs(job_directory)
+  except OSError as e:
+    admission.release(job_id)
+    count_error('job_directory')
+    print({
+      "code": 500,
+      "message": f'Unable to create job folder on instance: {e}'
+    })
+    return False
+
+  # large inputs are streamed from S3 by run.py itself, so downloading,
+  # annotating and uploading overlap
+  streaming_min_mb = int(app.config['ANNOTATOR_STREAMING_MIN_MB'])
+  stream_input = streaming_min_mb > 0 and object_size >= streaming_min_mb * 1024 * 1024
+  run_args = f'{user_id}/{job_id}/{file_name}'
+  if stream_input:
+    print("Input will be streamed from s3...")
+    run_args += f' s3://{bucket}/{inputfile_path_s3}'
+  else:
+    # download file from s3
+    # referring to documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
+    try:
+      print("Downloading input file from s3...")
+      download_start = time.time()
+      s3_resource.meta.client.download_file(bucket, inputfile_path_s3, inputfile_path)
+      trace.add('download', download_start)
+      gas_metrics['s3_transfer_seconds'].inc(time.time() - download_start,
+        service='annotator', direction='download')
+      gas_metrics['s3_transfer_bytes'].inc(object_size,
+        service='annotator', direction='download')
+    except botocore.exceptions.ClientError as e:
+      admission.release(job_id)
+      count_error('download')
+      if e.response['Error']['Code'] == "404":
+        print({
+          "code": 404,
+          "message": f'File does not exit on S3: {e}'
+        })
+      else:
+        print({
+          "code": 500,
+          "message": f'Unable to download input file from S3: {e}'
+        })
+      return False
+    except Exception as e:
+      admission.release(job_id)
+      count_error('download')
+      print({
+        "code": 500,
+        "message": f'Unknown Error while trying to downlod file from S3: {e}'
+      })
+      return False
+
+  # start a new process to annotate
+  run_script_path = app.config['ANNOTATOR_RUN_SCRIPT_PATH']
+  try:
+    print("Launching subprocess...")
+    anno_process = subprocess.Popen(
+    f'python {run_script_path} {run_args}',
+    cwd = job_directory,
+    env = dict(os.environ, **trace.to_env()),
+    shell = True)
+    admission.track(job_id, anno_process)
+    in_flight.add(job_id, message, anno_process)
+  except subprocess.SubprocessError as e:
+    admission.release(job_id)
+    count_error('launch')
+    print({
+      "code": 500,
+      "message": f'Unable to open subprocess for annotation: {e}'
+    })
+    return False
+
+  record_trace_spans(job_id, trace)
+  publish_job_status(user_id, job_id, "RUNNING")
+  return False
+
+
+"""Append the spans recorded after the claim (the download) to the job
+item; best effort
+"""
+def record_trace_spans(job_id, trace):
+  if not trace.spans:
+    return
+  dynamodb_resource = boto3.resource('dynamodb', region_name = app.config['AWS_REGION_NAME'])
+  try:
+    table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    trace_clause, trace_values = trace.update_clause()
+    table.update_item(
+      Key={'job_id': job_id},
+      UpdateExpression='SET ' + trace_clause,
+      ExpressionAttributeValues=trace_values)
+  except botocore.exceptions.ClientError as e:
+    print(f'Unable to record trace spans for job {job_id}: {e}')
+
+
+"""Mark a job RUNNING under a fresh run lease
+Passes for PENDING jobs and for RUNNING jobs whose lease has run out
+(the instance running them died or gave up), so redelivered jobs resume.
+The message is hidden for as long as the lease lasts. Returns True once
+claimed, None if the job has already finished (the message can go) and
+False if it is running elsewhere or the update failed.
+"""
+def claim_job(job_id, trace, message):
+  visibility_timeout = int(app.config['ANNOTATOR_VISIBILITY_TIMEOUT'])
+  now = time.time()
+  dynamodb_resource = boto3.resource('dynamodb', region_name = app.config['AWS_REGION_NAME'])
+  table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  try:
+    trace_clause, trace_values = trace.update_clause()
+    table.update_item(
+      Key={'job_id': job_id},
+      UpdateExpression='SET job_status = :val1, run_lease_until = :lease, ' + trace_clause,
+      ConditionExpression='begins_with(job_status, :val2) OR '
+        '(job_status = :val1 AND (attribute_not_exists(run_lease_until) OR run_lease_until < :now))',
+      ExpressionAttributeValues=dict(trace_values, **{':val1': "RUNNING", ':val2': "PENDING",
+        ':lease': Decimal(str(now + visibility_timeout)), ':now': Decimal(str(now))})
+      )
+  except botocore.exceptions.ClientError as e:
+    code = e.response['Error']['Code']
+    if code != 'ConditionalCheckFailedException':
+      count_error('dynamodb')
+      print({
+        'code': 500,
+        'message': f'Unable to update job status on DynamoDB to RUNNING: {e}'
+      })
+      return False
+    try:
+      job_status = table.get_item(Key={'job_id': job_id},
+        ProjectionExpression='job_status').get('Item', {}).get('job_status', '')
+    except botocore.exceptions.ClientError as e:
+      count_error('dynamodb')
+      print(f'Unable to get status of job {job_id}: {e}')
+      return False
+    if job_status.startswith('PENDING') or job_status == 'RUNNING':
+      print(f'Job {job_id} is running on another instance')
+      return False
+    print(f'Job {job_id} is already {job_status or "gone"}; dropping its message')
+    return None
+
+  try:
+    message.change_visibility(VisibilityTimeout=visibility_timeout)
+  except botocore.exceptions.ClientError as e:
+    print(f'Unable to change message visibility: {e}')
+  return True
+
+
+"""Request messages of the jobs running on this instance
+Each message stays in flight while run.py works on its job: every
+heartbeat the message's visibility timeout and the job's run lease are
+pushed out again. The message is deleted once run.py exits with status
+0. If any step fails run.py exits 1 (or this instance dies), and the
+message reappears when the lease runs out; the job then resumes from its
+checkpoints.
+"""
+class InFlightJobs(object):
+  def __init__(self, visibility_timeout, heartbeat):
+    self.visibility_timeout = visibility_timeout
+    self.heartbeat = heartbeat
+    self.lock = threading.Lock()
+    self.jobs = {}
+    self.thread = None
+
+  def add(self, job_id, message, process):
+    with self.lock:
+      self.jobs[job_id] = (message, process)
+      if self.thread is None or not self.thread.is_alive():
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+  def has(self, job_id):
+    with self.lock:
+      return job_id in self.jobs
+
+  def run(self):
+    while True:
+      time.sleep(self.heartbeat)
+      try:
+        self.renew()
+      except Exception as e:
+        count_error('heartbeat')
+        print(f'Unexpected error while renewing job messages: {e}')
+
+  def renew(self):
+    with self.lock:
+      jobs = list(self.jobs.items())
+    table = None
+    for job_id, (message, process) in jobs:
+      returncode = process.poll()
+      if returncode is None:
+        if table is None:
+          dynamodb_resource = boto3.resource('dynamodb', region_name = app.config['AWS_REGION_NAME'])
+          table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        self.extend(table, job_id, message)
+        continue
+
+      with self.lock:
+        self.jobs.pop(job_id, None)
+      if returncode != 0:
+        count_error('annotate')
+        print(f'run.py failed for job {job_id} (exit code {returncode}); '
+          'the job will be retried')
+        continue
+      try:
+        message.delete()
+      except botocore.exceptions.ClientError as e:
+        count_error('delete')
+        print({
+          'code': 500,
+          'message': f'Unable to delete message on SQS after job {job_id} finished: {e}'
+        })
+
+  def extend(self, table, job_id, message):
+    # the lease never outlasts the message, so a redelivery always finds
+    # it expired
+    now = time.time()
+    try:
+      table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET run_lease_until = :lease',
+        ConditionExpression='job_status = :running',
+        ExpressionAttributeValues={':running': "RUNNING",
+          ':lease': Decimal(str(now + self.visibility_timeout))})
+    except botocore.exceptions.ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        count_error('dynamodb')
+        print(f'Unable to renew run lease of job {job_id}: {e}')
+    try:
+      message.change_visibility(VisibilityTimeout=self.visibility_timeout)
+    except botocore.exceptions.ClientError as e:
+      count_error('visibility')
+      print(f'Unable to extend visibility of job {job_id} message: {e}')
+
+in_flight = InFlightJobs(
+  visibility_timeout=int(app.config['ANNOTATOR_VISIBILITY_TIMEOUT']),
+  heartbeat=int(app.config['ANNOTATOR_VISIBILITY_HEARTBEAT']))
+
+
+"""Announce a job status change to the web app
+Best effort: the web app's cached views also expire on their own.
+"""
+def publish_job_status(user_id, job_id, job_status):
+  sns_client = boto3.client('sns', region_name = app.config['AWS_REGION_NAME'])
+  try:
+    sns_client.publish(
+      TopicArn=app.config['AWS_SNS_JOB_STATUS_TOPIC'],
+      Message=json.dumps({
+        'user_id': user_id,
+        'job_id': job_id,
+        'job_status': job_status,
+        'time': time.time()}))
+  except botocore.exceptions.ClientError as e:
+    count_error('sns')
+    print({
+      'code': 500,
+      'message': f'Unable to publish job status {job_status}: {e}'
+    })
+
+
+"""Drain the job request queue
+Keeps long-polling SQS while it returns messages and this instance has
+free slots; stops at the first empty poll or once the host is saturated.
+"""
+def drain_job_queue(queue):
+  wait_time = int(app.config['AWS_SQS_WAIT_TIME'])
+  while True:
+    # don't take messages off the queue that this instance can't run
+    free_slots = admission.max_jobs - admission.running()
+    if free_slots <= 0:
+      print("Instance is saturated; leaving annotation jobs on the queue.")
+      return
+
+    max_num_message = min(int(app.config['AWS_SQS_MAX_MESSAGES']), free_slots)
+    try:
+      with gas_metrics['sqs_receive_seconds'].time(service='annotator'):
+        messages = queue.receive_messages(WaitTimeSeconds = wait_time,
+                                          MaxNumberOfMessages = max_num_message)
+    except botocore.exceptions.ClientError as e:
+      count_error('receive')
+      print({
+        "code": 500,
+        "message": f'Unable to receive message from SQS: {e}'
+      })
+      return
+
+    gas_metrics['sqs_messages_per_poll'].observe(len(messages), service='annotator')
+    if len(messages) == 0:
+      return
+    print(f'Received {str(len(messages))} messages...')
+
+    # Iterate each message
+    for message in messages:
+      if not process_message(message):
+        continue
+
+      # Delete the message from the queue
+      try:
+        print("Deleting message...")
+        message.delete()
+      except botocore.exceptions.ClientError as e:
+        count_error('delete')
+        print({
+          'code': 500,
+          'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
+        })
+
+
+"""Background dispatcher for job request notifications
+The webhook only sets a wakeup flag; a single worker thread does the
+SQS drain, so SNS gets its 200 back without waiting on SQS, S3 or
+DynamoDB. Wakeups that arrive while a drain is running coalesce into
+one more drain. The worker also wakes up every
+ANNOTATOR_DISPATCH_IDLE_POLL seconds so deferred jobs are picked up
+again once this instance has capacity.
+"""
+class Dispatcher(object):
+  def __init__(self, idle_poll):
+    self.idle_poll = idle_poll
+    self.wakeup = threading.Event()
+    self.lock = threading.Lock()
+    self.thread = None
+    self.queue = None
+
+  def start(self):
+    with self.lock:
+      if self.thread is None or not self.thread.is_alive():
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+  def notify(self):
+    self.start()
+    self.wakeup.set()
+
+  def get_queue(self):
+    if self.queue is None:
+      sqs_resource = boto3.resource("sqs", region_name = app.config['AWS_REGION_NAME'])
+      self.queue = sqs_resource.get_queue_by_name(QueueName = app.config['AWS_SQS_NAME'])
+    return self.queue
+
+  def run(self):
+    while True:
+      self.wakeup.wait(timeout=self.idle_poll)
+      self.wakeup.clear()
+      try:
+        drain_job_queue(self.get_queue())
+      except botocore.exceptions.ClientError as e:
+        print({
+          "code": 503,
+          "message": f'Unable to get SQS queue: {e}'
+        })
+      except Exception as e:
+        count_error('dispatch')
+        print({
+          "code": 500,
+          "message": f'Unexpected error while draining job queue: {e}'
+        })
+
+dispatcher = Dispatcher(idle_poll=int(app.config['ANNOTATOR_DISPATCH_IDLE_POLL']))
+
+
 '''
 A13 - Replace polling with webhook in annotator
 
-Receives request from SNS; queries job queue and processes message.
-Reads request messages from SQS and runs AnnTools as a subprocess.
+Receives request from SNS and wakes up the job dispatcher, which
+reads request messages from SQS and runs AnnTools as a subprocess.
 Updates the annotations database with the status of the request.
 '''
 @app.route('/process-job-request', methods=['GET', 'POST'])
 def annotate():
 
-  # get SQS queue, exit if cannot get queue
-  sqs_resource = boto3.resource("sqs", region_name = app.config['AWS_REGION_NAME'])
-  try:
-    queue = sqs_resource.get_queue_by_name(QueueName = app.config['AWS_SQS_NAME'])
-  except botocore.exceptions.ClientError as e:
-    return jsonify({
-      "code": 503,
-      "message": f'Unable to get SQS queue: {e}'
-      }), 503
-
   # if method is GET, exit
   if (request.method == 'GET'):
     return jsonify({
-      "code": 405, 
-      "message": f'Expecting SNS POST request: {e}'
+      "code": 405,
+      "message": f'Expecting SNS POST request'
     }), 405
-  
+
   # if method is POST, check header
   elif (request.method == 'POST'):
     try:
@@ -57,7 +534,7 @@ def annotate():
         "code": 500,
         "message": f'Unable to decode json data: {e}'
       }), 500
-    
+
     # Check header for message type
     hdr = request.headers.get('x-amz-sns-message-type')
     # Confirm SNS topic subscription confirmation
@@ -75,154 +552,27 @@ def annotate():
           "code": 500,
           "message": f'Unable to subscribe to SNS'
         }), 500
-      
-    # Poll SQS for tasks
+
+    # Hand the SQS drain off to the dispatcher and acknowledge right away
     elif hdr == 'Notification':
-      wait_time = int(app.config['AWS_SQS_WAIT_TIME'])
-      max_num_message = int(app.config['AWS_SQS_MAX_MESSAGES'])
-      try:
-        messages = queue.receive_messages(WaitTimeSeconds = wait_time, 
-                                          MaxNumberOfMessages = max_num_message)
-      except botocore.exceptions.ClientError as e:
-        return jsonify({
-          "code": 500,
-          "message": f'Unable to receive message from SQS: {e}'
-        }), 500
+      dispatcher.notify()
+      return jsonify({
+        "code": 200,
+        "message": "Job request notification received; queue will be drained in the background."
+      }), 200
+
+    else:
+      return jsonify({
+        "code": 400,
+        "message": f'Unexpected SNS message type: {hdr}'
+      }), 400
 
-      # Start processing messages from SQS 
-      if len(messages) > 0:
-        print(f'Received {str(len(messages))} messages...')
-
-        # Iterate each message
-        for message in messages:
-          # Parse JSON message
-          print("new message")
-          try:
-            msg_body = json.loads(json.loads(message.body)["Message"])
-            print(msg_body)
-          except ValueError as e:
-            return jsonify({
-              "code": 500,
-              "message": f'Unable to decode message into json: {e}'
-            }), 500
-          
-          try: 
-            bucket = msg_body["s3_inputs_bucket"]
-            inputfile_path_s3 = msg_body["s3_key_input_file"]
-            file_name = msg_body["input_file_name"]
-            job_id = msg_body["job_id"]
-            user_id = msg_body["user_id"]
-          except KeyError as e:
-            return jsonify({
-                "code": 500,
-                "message": f'Missing field in message: {e}'
-                }), 500
-
-          # variables for file paths
-          base_directory = app.config['ANNOTATOR_BASE_DIR']
-          user_directory = base_directory + "jobs/" + user_id
-          job_directory = base_directory + "jobs/" + user_id + "/" + job_id
-          inputfile_path = job_directory + "/" + file_name
-
-          # create user and job folder
-          try: 
-            user_does_exist = os.path.exists(user_directory)
-            if not user_does_exist:
-                os.makedirs(user_directory)
-            job_does_exist = os.path.exists(job_directory)
-            if not job_does_exist:
-                os.makedirs(job_directory)
-          except OSError as e:
-            return jsonify({
-              "code": 500,
-              "message": f'Unable to create job folder on instance: {e}'
-            }), 500
-
-          # download file from s3
-          # referring to documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
-          s3_resource = boto3.resource('s3', region_name = app.config['AWS_REGION_NAME'])
-          try:
-            print("Downloading input file from s3...")
-            s3_resource.meta.client.download_file(bucket, inputfile_path_s3, inputfile_path)
-          except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404": 
-                return jsonify({
-                  "code": 404,
-                  "message": f'File does not exit on S3: {e}'
-                  }), 404
-            else: 
-                return jsonify({
-                  "code": 500,
-                  "message": f'Unable to download input file from S3: {e}'
-                  }), 500
-          except Exception as e:
-                return jsonify({
-                  "code": 500,
-                  "message": f'Unknown Error while trying to downlod file from S3: {e}'
-                  }), 500
-
-          # start a new process to annotate
-          run_script_path = app.config['ANNOTATOR_RUN_SCRIPT_PATH']
-          try:
-            print("Launching subprocess...")
-            anno_process = subprocess.Popen(
-            f'python {run_script_path} {user_id}/{job_id}/{file_name}',
-            cwd = job_directory,
-            shell = True) 
-          except subprocess.SubprocessError as e:
-            return jsonify({
-              "code": 500,
-              "message": f'Unable to open subprocess for annotation: {e}'
-            }), 500
-          
-          # update job status to RUNNING on dynamodb
-          dynamodb_resource = boto3.resource('dynamodb', region_name = app.config['AWS_REGION_NAME'])
-          try: 
-            table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-            table.update_item(
-              Key={'job_id': msg_body["job_id"]},
-              UpdateExpression='SET job_status = :val1',
-              ConditionExpression='begins_with(job_status, :val2)',
-              ExpressionAttributeValues={':val1': "RUNNING", ':val2': "PENDING"}
-              )
-          except botocore.exceptions.ClientError as e:
-            code = e.response['Error']['Code']
-            if code == 'ResourceNotFoundexception': 
-              return jsonify({
-                'code': 500, 
-                'message': f'Unable to fetch dynamodb table while trying to update job status: {e}'
-              }), 500
-            else:
-              return jsonify({
-                'code': 500, 
-                'message': f'Unable to update job status on DynamoDB to RUNNING: {e}'
-              }), 500
-          
-          # Delete the message from the queue
-          try: 
-            print("Deleting message...")
-            message.delete()
-          except botocore.exceptions.ClientError as e:
-            return jsonify({
-              'code': 500, 
-              'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
-              }), 500
-          
-        return jsonify({
-          "code": 200, 
-          "message": "All annotation jobs from this poll have been processed."
-        }), 200
-      
-      else:
-        return jsonify({
-          "code": 500, 
-          "message": "Got SNS notification but polled no message from SQS."
-          }), 500
-    
 @app.route('/', methods=['GET'])
 def home():
   return {"code": 200, "message": "Great you found your page"}
 
-app.run('0.0.0.0', debug=True)
+# Run using dev server; not when imported (e.g. by util/local/gas_local.py)
+if __name__ == '__main__':
+  app.run('0.0.0.0', debug=True)
 
-### EOF
\ No newline at end of file
+### EOF
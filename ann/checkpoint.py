@@ -0,0 +1,173 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Stage-level checkpoints for AnnTools runs
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import hashlib
+import json
+import os
+
+from botocore.exceptions import ClientError
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+"""SHA-256 of a file, or of its first `length` bytes
+"""
+def sha256_file(path, length=None):
+    digest = hashlib.sha256()
+    remaining = length
+    with open(path, 'rb') as fh:
+        while remaining is None or remaining > 0:
+            chunk = fh.read(1024 * 1024 if remaining is None
+                else min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+"""Checkpoints for one annotation job
+driver.run() writes each stage's output to <infile>.<n> and appends to
+<infile>.count.log. After every stage the manifest records the stage's
+output checksum plus the size and checksum of the log at that point, so
+a rerun of the same input can skip finished stages: the newest stage
+whose output still verifies is the resume point, and the log is cut back
+to what it was when that stage completed.
+
+The manifest lives next to the input. If an S3 client is given, stage
+outputs, the log and the manifest are also copied to
+s3://<bucket>/<prefix><job key>/ so a job can resume on another instance.
+"""
+class Checkpoint(object):
+    def __init__(self, infile, s3_client=None, bucket=None, prefix=None):
+        self.infile = infile
+        self.logfile = infile + '.count.log'
+        self.manifest_path = infile + MANIFEST_SUFFIX
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.manifest = None
+
+    def _s3_key(self, path):
+        return self.prefix + os.path.basename(path)
+
+    def _upload(self, path):
+        if self.s3 is None:
+            return
+        try:
+            self.s3.upload_file(path, self.bucket, self._s3_key(path))
+        except (ClientError, OSError) as e:
+            # local checkpoints still work; only cross-instance resume is lost
+            print(f'Unable to copy checkpoint {path} to S3: {e}')
+
+    def _download(self, path):
+        if self.s3 is None:
+            return False
+        try:
+            self.s3.download_file(self.bucket, self._s3_key(path), path)
+            return True
+        except (ClientError, OSError) as e:
+            print(f'No checkpoint {os.path.basename(path)} on S3: {e}')
+            return False
+
+    def _load_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            self._download(self.manifest_path)
+        try:
+            with open(self.manifest_path, 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def _save_manifest(self):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.manifest, fh)
+        os.replace(tmp, self.manifest_path)
+        self._upload(self.manifest_path)
+
+    def _verify_output(self, entry):
+        path = self.infile + entry['ext']
+        if not os.path.isfile(path) and not self._download(path):
+            return False
+        return os.path.getsize(path) == entry['size'] and \
+            sha256_file(path) == entry['sha256']
+
+    def _restore_log(self, entry):
+        if not os.path.isfile(self.logfile) or \
+            os.path.getsize(self.logfile) < entry['log_size']:
+            if not self._download(self.logfile):
+                return False
+        if os.path.getsize(self.logfile) < entry['log_size'] or \
+            sha256_file(self.logfile, entry['log_size']) != entry['log_sha256']:
+            return False
+        # drop anything a half-finished later stage appended
+        with open(self.logfile, 'r+b') as fh:
+            fh.truncate(entry['log_size'])
+        return True
+
+    """Number of stages that can be skipped
+    Returns 0 (start from scratch) unless the manifest belongs to this
+    exact input and a recorded stage output verifies.
+    """
+    def resume(self):
+        input_sha256 = sha256_file(self.infile)
+        manifest = self._load_manifest()
+        self.manifest = {'input_sha256': input_sha256, 'stages': []}
+        if not manifest or manifest.get('input_sha256') != input_sha256:
+            return 0
+
+        stages = manifest.get('stages', [])
+        for done in range(len(stages), 0, -1):
+            entry = stages[done - 1]
+            if self._verify_output(entry) and self._restore_log(entry):
+                self.manifest['stages'] = stages[:done]
+                print(f'Resuming after stage {entry["stage"]} '
+                    f'({done} stages already done)')
+                return done
+            print(f'Checkpoint for stage {entry["stage"]} failed verification')
+        return 0
+
+    """Record a finished stage whose output is <infile><ext>
+    """
+    def record(self, stage, ext):
+        path = self.infile + ext
+        log_size = os.path.getsize(self.logfile) \
+            if os.path.isfile(self.logfile) else 0
+        self.manifest['stages'].append({
+            'stage': stage,
+            'ext': ext,
+            'size': os.path.getsize(path),
+            'sha256': sha256_file(path),
+            'log_size': log_size,
+            'log_sha256': sha256_file(self.logfile, log_size)
+                if log_size else hashlib.sha256().hexdigest()
+        })
+        self._upload(path)
+        self._upload(self.logfile)
+        self._save_manifest()
+
+    """Remove the manifest (local and S3) once the job has finished
+    """
+    def clear(self):
+        if os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)
+        if self.s3 is None or self.manifest is None:
+            return
+        paths = [self.manifest_path, self.logfile] + \
+            [self.infile + entry['ext'] for entry in self.manifest['stages']]
+        for path in paths:
+            try:
+                self.s3.delete_object(Bucket=self.bucket, Key=self._s3_key(path))
+            except ClientError as e:
+                print(f'Unable to delete checkpoint {path} from S3: {e}')
+
+### EOF
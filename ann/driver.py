@@ -12,110 +12,89 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import time
 import file_utils as fu
 import annotate as ann
 
-def run(infile, format):
+"""Record how long a stage took and return the start time of the next one
+"""
+def lap(timings, stage, stage_start):
+    now = time.time()
+    if timings is not None:
+        timings[stage] = now - stage_start
+    return now
+
+"""Annotation stages in the order they run
+Each entry is (stage label, progress message, function, extra kwargs);
+stage n reads <infile>.<n-1> and writes <infile>.<n> (stage 1 reads the
+input itself).
+"""
+STAGES = [
+    ('dbSNP', 'dbSNP', ann.getSnpsFromDbSnp, {'format': 'vcf'}),
+    ('bigRefGene', 'BigRefGene', ann.getBigRefGene, {'format': 'vcf'}),
+    ('refGene', 'BigRefGene', ann.getGenes,
+        {'format': 'vcf', 'table': 'refGene', 'promoter_offset': 500}),
+    ('cytoBand', 'Cytoband', ann.addOverlapWithCytoband,
+        {'format': 'vcf', 'table': 'cytoBand'}),
+    ('gadAll', 'gadAll', ann.addOverlapWithGadAll,
+        {'format': 'vcf', 'table': 'gadAll'}),
+    ('gwasCatalog', 'GwasCatalog', ann.addOverlapWithGwasCatalog,
+        {'format': 'vcf', 'table': 'gwasCatalog'}),
+    ('targetScanS', 'miRNA', ann.addOverlapWithMiRNA,
+        {'format': 'vcf', 'table': 'targetScanS'}),
+    ('hugo', 'HUGO Gene Nomenclature Committee',
+        ann.addOverlapWitHUGOGeneNomenclature,
+        {'format': 'vcf', 'table': 'hugo'}),
+    ('dgv_Cnv', 'dgv_Cnv', ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'dgv_Cnv'}),
+    ('abParts_IG_T_CelReceptors', 'abParts_IG_T_CelReceptors',
+        ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'abParts_IG_T_CelReceptors'}),
+    ('mcCarroll_Cnv', 'mcCarroll_Cnv', ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'mcCarroll_Cnv'}),
+    ('conrad_Cnv', 'conrad_Cnv', ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'conrad_Cnv'}),
+    ('genomicSuperDups', 'genomicSuperDups',
+        ann.addOverlapWithGenomicSuperDups,
+        {'format': 'vcf', 'table': 'genomicSuperDups'}),
+    ('tfbsConsSites', 'addOverlapWithTfbsConsSites',
+        ann.addOverlapWithTfbsConsSites, {'table': 'tfbsConsSites'}),
+]
+
+"""Run all annotation stages on infile
+If a timings dict is passed, it is filled with seconds spent per stage.
+If a checkpoint (see checkpoint.py) is passed, stages it has already
+recorded for this input are skipped and each finished stage is recorded.
+"""
+def run(infile, format, timings=None, checkpoint=None):
 
     print("Running . . .")
-
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    done = checkpoint.resume() if checkpoint is not None else 0
+    stage_start = time.time()
+
+    for i, (stage, message, function, kwargs) in enumerate(STAGES):
+        tmpextin = '' if i == 0 else '.' + str(i)
+        tmpextout = '.' + str(i + 1)
+        if i < done:
+            print(f"{message} - skipped (checkpoint).")
+            continue
+
+        function(vcf=infile, tmpextin=tmpextin, tmpextout=tmpextout, **kwargs)
+        print(f"{message} - done.")
+        stage_start = lap(timings, stage, stage_start)
+        if checkpoint is not None:
+            checkpoint.record(stage, tmpextout)
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    last = len(STAGES)
+    for i in range(1, last):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
+    os.rename(infile + '.' + str(last), infile + '.annot')
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile + '.annot', finalout)
 
-### EOF
\ No newline at end of file
+    if checkpoint is not None:
+        checkpoint.clear()
+
+### EOF
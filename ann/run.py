@@ -12,6 +12,8 @@ from flask import Flask, request, jsonify, Response
 import sys
 import time
 import driver
+import streaming
+from checkpoint import Checkpoint
 import boto3
 import botocore
 import os
@@ -35,15 +37,27 @@ class Timer(object):
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-# read config file
+# read config file (ANNOTATOR_CONFIG_FILE points elsewhere, e.g. for
+# util/local/gas_local.py)
 config = ConfigParser(os.environ)
-config.read('/home/ubuntu/gas/ann/ann_config.ini')
+config.read(os.environ.get('ANNOTATOR_CONFIG_FILE', '/home/ubuntu/gas/ann/ann_config.ini'))
 base_directory = config['ann']['ANNOTATOR_BASE_DIR']
 result_bucket = config['s3']['AWS_S3_RESULTS_BUCKET']
 
+# Import shared metrics helpers; observations are picked up by the
+# webhook's /metrics endpoint
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'util'))
+from metrics import EventLog
+import tracing
+metrics_events = EventLog(config['ann']['ANNOTATOR_METRICS_EVENT_LOG'])
 
 
-def main(file_path):
+
+"""Annotate one job and upload its results
+Returns False if any step failed, so the webhook keeps the job's message
+and the job is retried.
+"""
+def main(file_path, stream_source=None):
 	# variables for file path
 	user_id, job_id, file_name = file_path.split("/")
 	logfile_name = file_name + ".count.log"
@@ -56,65 +70,135 @@ def main(file_path):
 	annofile_path = job_directory + "/" + annofile_name
 	annofile_path_s3 = "haoyiran/" + user_id + "/" + job_id + "~" + annofile_name  
 	
-	with Timer():
-		try:
-			driver.run(inputfile_path, 'vcf')
-		except FileNotFoundError as e: 
-			print({
-                'code': 404, 
-                'status': 'NotFound', 
-                'message': f'FileNotFoundError: {inputfile_path}',
-            })
-			return
+	# trace context handed over by the annotator webhook
+	trace = tracing.Trace.from_env('annotator')
+
+	# stage checkpoints let a redelivered job skip stages already done,
+	# here or (with S3 checkpoints) on another instance
+	if config.getboolean('ann', 'ANNOTATOR_CHECKPOINT_TO_S3'):
+		checkpoint = Checkpoint(inputfile_path,
+			s3_client=boto3.client('s3', region_name = config['aws']['AWS_REGION_NAME']),
+			bucket=config['s3']['AWS_S3_CHECKPOINT_BUCKET'],
+			prefix=config['s3']['AWS_S3_CHECKPOINT_PREFIX'] + user_id + "/" + job_id + "/")
+	else:
+		checkpoint = Checkpoint(inputfile_path)
+
+	job_start = time.time()
+	timings = {}
+	if stream_source:
+		# streaming mode: the input is read from S3 and the annotated file
+		# uploaded while annotation is still running
+		input_bucket, input_key = stream_source[len('s3://'):].split('/', 1)
+		stream_client = boto3.client('s3', region_name = config['aws']['AWS_REGION_NAME'])
+		with Timer():
+			try:
+				bytes_in, bytes_out = streaming.run(stream_client, input_bucket, input_key,
+					job_directory, logfile_path, result_bucket, annofile_path_s3,
+					timings=timings,
+					chunk_records=int(config['ann']['ANNOTATOR_STREAM_CHUNK_RECORDS']),
+					range_size=int(config['ann']['ANNOTATOR_STREAM_RANGE_MB']) * streaming.MB,
+					part_size=int(config['ann']['ANNOTATOR_STREAM_PART_MB']) * streaming.MB)
+			except Exception as e:
+				metrics_events.inc('gas_errors_total', service='annotator', step='stream')
+				print({
+					'code': 500,
+					'status': 'StreamingFailed',
+					'message': f'Failed to stream {stream_source}: {e}',
+				})
+				return False
+		metrics_events.inc('gas_s3_transfer_bytes_total', bytes_in,
+			service='annotator', direction='download')
+		metrics_events.inc('gas_s3_transfer_bytes_total', bytes_out,
+			service='annotator', direction='upload')
+		trace.add('annotate:stream', job_start)
+	else:
+		with Timer():
+			try:
+				driver.run(inputfile_path, 'vcf', timings=timings, checkpoint=checkpoint)
+			except FileNotFoundError as e: 
+				metrics_events.inc('gas_errors_total', service='annotator', step='annotate')
+				print({
+	                'code': 404, 
+	                'status': 'NotFound', 
+	                'message': f'FileNotFoundError: {inputfile_path}',
+	            })
+				return False
 
 
 	# if job dir,log file, annotation file do not exist, return
-	if not (os.path.exists(job_directory) and os.path.isfile(logfile_path) and os.path.isfile(annofile_path)):
+	if not (os.path.exists(job_directory) and os.path.isfile(logfile_path) and (stream_source or os.path.isfile(annofile_path))):
+		metrics_events.inc('gas_errors_total', service='annotator', step='results')
 		print({
 			'code': 500,
 			'status': 'ResultsFilesMissing',
 			'message': f'Failed to produce results files for: {inputfile_path}',
 		}) 
-		return
+		return False
 		
+	# stages run back to back, so their spans can be laid out from job_start
+	# (in streaming mode they are totals over all chunks)
+	stage_start = job_start
+	for stage, secs in timings.items():
+		metrics_events.observe('gas_annotation_stage_seconds', secs, stage=stage)
+		if not stream_source:
+			trace.add('annotate:' + stage, stage_start, stage_start + secs)
+		stage_start += secs
+
 	# upload log and annotation files on S3
 	s3_resource = boto3.resource('s3', region_name = config['aws']['AWS_REGION_NAME'])
 	try:
-		s3_resource.meta.client.upload_file(logfile_path, result_bucket, logfile_path_s3)
-		s3_resource.meta.client.upload_file(annofile_path, result_bucket, annofile_path_s3)
+		upload_start = time.time()
+		upload_paths = [(logfile_path, logfile_path_s3)]
+		if not stream_source:
+			# already uploaded by streaming.run otherwise
+			upload_paths.append((annofile_path, annofile_path_s3))
+		for local_path, s3_key in upload_paths:
+			s3_resource.meta.client.upload_file(local_path, result_bucket, s3_key)
+		trace.add('upload', upload_start)
+		metrics_events.inc('gas_s3_transfer_seconds_total', time.time() - upload_start, 
+			service='annotator', direction='upload')
+		metrics_events.inc('gas_s3_transfer_bytes_total', 
+			sum(os.path.getsize(local_path) for local_path, _ in upload_paths), 
+			service='annotator', direction='upload')
 	except botocore.exceptions.ClientError as e:
+		metrics_events.inc('gas_errors_total', service='annotator', step='upload')
 		print({
 			'code': 500,
 			'status': 'S3UploadFailed',
 			'message': f'Failed to upload results files for: {inputfile_path}',
 		})
-		return
+		return False
 	except FileNotFoundError as e: 
+		metrics_events.inc('gas_errors_total', service='annotator', step='upload')
 		print({
 			'code': 404, 
 			'status': 'NotFound', 
 			'message': f'FileNotFoundError: {inputfile_path}',
 		})
-		return
+		return False
 	except Exception as e:
+		metrics_events.inc('gas_errors_total', service='annotator', step='upload')
 		print(e)
-		return
+		return False
 	
 
 	# update job status to COMPLETED on dynamodb
 	dynamodb_resource = boto3.resource('dynamodb', region_name = config['aws']['AWS_REGION_NAME'])
 	try: 
 		table = dynamodb_resource.Table(config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-		table.update_item(
+		trace_clause, trace_values = trace.update_clause()
+		response = table.update_item(
 			Key={'job_id': job_id},
-			UpdateExpression='SET job_status = :val1, s3_results_bucket = :val2, s3_key_result_file = :val3, s3_key_log_file = :val4, complete_time = :val5',
-			ExpressionAttributeValues={
+			UpdateExpression='SET job_status = :val1, s3_results_bucket = :val2, s3_key_result_file = :val3, s3_key_log_file = :val4, complete_time = :val5, ' + trace_clause,
+			ExpressionAttributeValues=dict(trace_values, **{
 				':val1': "COMPLETED",
 				':val2': result_bucket,
 				':val3': annofile_path_s3,
 				':val4': logfile_path_s3,
-				':val5': Decimal(time.time())})
+				':val5': Decimal(time.time())}),
+			ReturnValues='ALL_NEW')
 	except botocore.exceptions.ClientError as e:
+		metrics_events.inc('gas_errors_total', service='annotator', step='dynamodb')
 		code = e.response['Error']['Code']
 		if code == 'ResourceNotFoundexception': 
 			print({
@@ -122,78 +206,112 @@ def main(file_path):
 				'status': 'RequestedResourceNotFound', 
 				'message': f'Failed to fetch dynamodb table: {e}'
 				})
-			return
+			return False
 		else:
 			print({
 				'code': 500, 
 				'status': 'ServerError', 
 				'message': f'{e}'
 			})
-			return
+			return False
 	
-	# trigger step function
-	# referring to: https://www.youtube.com/watch?v=s0XFX3WHg0w
-	msg_step = {}
-	msg_step["user_id"] = user_id
-	msg_step["job_id"] = job_id
-	msg_step["results_bucket"] = result_bucket
-	msg_step["annofile_path_s3"] = annofile_path_s3
-	stepfunction_client = boto3.client('stepfunctions', region_name = config['aws']['AWS_REGION_NAME'])
+	# let the web app drop its cached view of this user's jobs
+	sns_client = boto3.client('sns', region_name = config['aws']['AWS_REGION_NAME'])
+	try:
+		sns_client.publish(
+			TopicArn = config['sns']['AWS_SNS_JOB_STATUS_TOPIC'],
+			Message = json.dumps({
+				'user_id': user_id,
+				'job_id': job_id,
+				'job_status': "COMPLETED",
+				'time': time.time()}))
+	except botocore.exceptions.ClientError as e:
+		metrics_events.inc('gas_errors_total', service='annotator', step='sns')
+		# not fatal, the web app's cache expires on its own
+		print({
+			'code': 500,
+			'status': 'StatusPublishFailed',
+			'message': f'Failed to publish job status: {e}'
+		})
+
+	# remember these results so identical inputs can reuse them
+	input_etag = response['Attributes'].get('input_etag')
+	if input_etag:
+		try:
+			index_table = dynamodb_resource.Table(config['dynamodb']['AWS_DYNAMODB_RESULTS_INDEX_TABLE'])
+			index_table.put_item(Item={
+				'content_key': f"{input_etag}:{config['ann']['ANNOTATOR_REFERENCE_VERSION']}",
+				'job_id': job_id,
+				's3_results_bucket': result_bucket,
+				's3_key_result_file': annofile_path_s3,
+				's3_key_log_file': logfile_path_s3,
+				'complete_time': Decimal(time.time())})
+		except botocore.exceptions.ClientError as e:
+			metrics_events.inc('gas_errors_total', service='annotator', step='results_index')
+			# not fatal, the job itself has completed
+			print({
+				'code': 500,
+				'status': 'ResultsIndexFailed',
+				'message': f'Failed to index results for: {inputfile_path}: {e}'
+			})
+
+	# hand the results to the archive utility's delay scheduler, which
+	# releases them for archival after the free user retention period
+	msg_archive = {}
+	msg_archive["user_id"] = user_id
+	msg_archive["job_id"] = job_id
+	msg_archive["results_bucket"] = result_bucket
+	msg_archive["annofile_path_s3"] = annofile_path_s3
+	msg_archive["completed_at"] = time.time()
+	msg_archive["trace"] = trace.handoff()
 	try: 
-		response = stepfunction_client.start_execution(
-			stateMachineArn = config["stepfunction"]["AWS_STEPFUNCTION_WAITING_ENGINE"],
-			name=f'{job_id}-stepfunctions',
-			input=json.dumps(msg_step),
-			traceHeader='string'
+		sns_client.publish(
+			TopicArn = config['sns']['AWS_SNS_RESULTS_READY_TOPIC'],
+			Message = json.dumps(msg_archive)
 		)
 	except botocore.exceptions.ClientError as e:
-		if e.response['Error']['Code'] == 'ExecutionAlreadyExists':
-			print({
-				'code': 500, 
-				'message': f'Execution already exists, cannot start a new execution'
-				})
-			return
-		elif e.response['Error']['Code'] == 'StateMachineNotRunning':
-			print({
-				'code': 500, 
-				'message': f'State machine is not in a running state, cannot start a new execution'
-				})
-			return
-		else:
-			print({
-				'code': 500, 
-				'message': f'Error starting Step Function execution: {e}'
-				})
-			return
-	except Exception as e:
+		metrics_events.inc('gas_errors_total', service='annotator', step='sns')
 		print({
 			'code': 500, 
-			'message': f'Unexpected Error: {e}'
+			'message': f'Failed to schedule archival of results: {e}'
 			})
-		return
+		return False
 		
+	metrics_events.observe('gas_job_duration_seconds', time.time() - job_start, service='annotator')
+
 	# delete job directory from local instance 
 	try: 
 		os.remove(logfile_path)
-		os.remove(annofile_path)
-		os.remove(inputfile_path)
+		if not stream_source:
+			os.remove(annofile_path)
+			os.remove(inputfile_path)
 		os.rmdir(job_directory)
 	except OSError as e:
+		metrics_events.inc('gas_errors_total', service='annotator', step='cleanup')
 		print({
 			'code': 500,
 			'status': 'OSError',
 			'message': f'OSError: {e}'
 		})
-		return
+		return False
+
+	return True
 
 
 if __name__ == '__main__':
 	# Call the AnnTools pipeline
-	if len(sys.argv) > 1:
-		main(sys.argv[1])
+	if len(sys.argv) > 2:
+		# run.py <user/job/file> s3://<bucket>/<key> streams the input
+		if not main(sys.argv[1], stream_source=sys.argv[2]):
+			sys.exit(1)
+
+	elif len(sys.argv) > 1:
+		if not main(sys.argv[1]):
+			sys.exit(1)
 
 	else:
 		print("A valid .vcf file must be provided as input to this program.")
+		sys.exit(1)
  
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,260 @@
+# streaming.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Streaming mode for AnnTools: overlap S3 download, annotation and upload
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import queue
+import re
+import shutil
+import threading
+
+import driver
+
+MB = 1024 * 1024
+
+# S3 multipart uploads need every part but the last to be at least 5 MB
+MIN_PART_SIZE = 5 * MB
+
+# Marks the end of a queue
+_DONE = object()
+
+# Ends the writer's queue when the input could not be read or annotated in
+# full: the multipart upload is aborted instead of completed
+_ABORT = object()
+
+
+class StreamAborted(Exception):
+    pass
+
+
+"""Read a VCF from S3 with ranged GETs and cut it into chunk files
+Each chunk holds the VCF header plus up to `chunk_records` records, so
+driver.run() can annotate it on its own while later ranges download.
+"""
+class ChunkReader(threading.Thread):
+    def __init__(self, s3_client, bucket, key, chunk_dir, chunks,
+        chunk_records=5000, range_size=8 * MB):
+        super().__init__(daemon=True)
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.chunk_dir = chunk_dir
+        self.chunks = chunks
+        self.chunk_records = chunk_records
+        self.range_size = range_size
+        self.bytes_read = 0
+        self.error = None
+
+    def lines(self):
+        size = self.s3.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        pending = b''
+        for start in range(0, size, self.range_size):
+            end = min(start + self.range_size, size) - 1
+            body = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+                Range=f'bytes={start}-{end}')['Body']
+            data = pending + body.read()
+            self.bytes_read += end - start + 1
+            lines = data.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if pending:
+            yield pending + b'\n'
+
+    def run(self):
+        try:
+            header, records, in_header = [], [], True
+            for line in self.lines():
+                if in_header and line.startswith(b'#'):
+                    header.append(line)
+                    continue
+                in_header = False
+                records.append(line)
+                if len(records) >= self.chunk_records:
+                    self.emit(header, records)
+                    records = []
+            if records or self.chunks_emitted == 0:
+                self.emit(header, records)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put(_DONE)
+
+    chunks_emitted = 0
+
+    def emit(self, header, records):
+        path = os.path.join(self.chunk_dir,
+            f'chunk{self.chunks_emitted:05d}.vcf')
+        with open(path, 'wb') as fh:
+            fh.writelines(header)
+            fh.writelines(records)
+        self.chunks_emitted += 1
+        self.chunks.put(path)
+
+
+"""Push annotated chunks to S3 through a multipart upload as parts fill
+Only the first chunk's header lines are kept. The upload is completed
+on _DONE and aborted on _ABORT, so a partial result never appears at
+the result key.
+"""
+class MultipartWriter(threading.Thread):
+    def __init__(self, s3_client, bucket, key, outputs, part_size=8 * MB):
+        super().__init__(daemon=True)
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.outputs = outputs
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.bytes_written = 0
+        self.error = None
+
+    def run(self):
+        upload_id = None
+        try:
+            upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+            parts, buffer, first = [], bytearray(), True
+            while True:
+                path = self.outputs.get()
+                if path is _DONE:
+                    break
+                if path is _ABORT:
+                    raise StreamAborted('Input was not annotated in full')
+                with open(path, 'rb') as fh:
+                    for line in fh:
+                        if line.startswith(b'#') and not first:
+                            continue
+                        buffer += line
+                first = False
+                os.remove(path)
+                while len(buffer) >= self.part_size:
+                    self.upload_part(upload_id, parts, bytes(buffer[:self.part_size]))
+                    del buffer[:self.part_size]
+            if buffer or not parts:
+                self.upload_part(upload_id, parts, bytes(buffer))
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except Exception as e:
+            self.error = e
+            if upload_id is not None:
+                try:
+                    self.s3.abort_multipart_upload(Bucket=self.bucket,
+                        Key=self.key, UploadId=upload_id)
+                except Exception as abort_error:
+                    print(f'Unable to abort multipart upload: {abort_error}')
+            # keep draining so the annotator never blocks on a full queue
+            if not isinstance(e, StreamAborted):
+                while self.outputs.get() not in (_DONE, _ABORT):
+                    pass
+
+    def upload_part(self, upload_id, parts, data):
+        number = len(parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+            UploadId=upload_id, PartNumber=number, Body=data)
+        parts.append({'PartNumber': number, 'ETag': response['ETag']})
+        self.bytes_written += len(data)
+
+
+"""Combine per-chunk count logs into one
+The logs of all chunks have the same lines; counts are added up. Each
+chunk's "Total" is its record count plus one (see getSnpsFromDbSnp), and
+percentages are recomputed from the combined totals.
+"""
+def merge_count_logs(paths, merged_path):
+    logs = []
+    for path in paths:
+        with open(path, 'r') as fh:
+            logs.append(fh.read().splitlines())
+    if not logs:
+        open(merged_path, 'w').close()
+        return
+
+    merged, total = [], None
+    # standalone counts only, not digits in labels like "'3 UTR"
+    number = re.compile(r"(?<![\w'])\d+(?!\w)")
+    def first_count(line):
+        return int(number.search(line).group(0))
+
+    for lines in zip(*logs):
+        line = lines[0]
+        if line.startswith('Total:'):
+            total = sum(first_count(l) for l in lines) - (len(lines) - 1)
+            line = f'Total: {total}'
+        elif line.startswith('In dbSNP:'):
+            in_dbsnp = sum(first_count(l) for l in lines)
+            ratio = (in_dbsnp / float(total)) * 100 if total else 0.0
+            line = f'In dbSNP: {in_dbsnp} ({ratio}%)'
+        elif all(number.sub('', l) == number.sub('', line) for l in lines):
+            counts = [[int(n) for n in number.findall(l)] for l in lines]
+            values = iter([sum(col) for col in zip(*counts)])
+            line = number.sub(lambda m: str(next(values)), line)
+        merged.append(line)
+    with open(merged_path, 'w') as fh:
+        fh.write('\n'.join(merged) + '\n')
+
+
+"""Annotate an S3 object chunk by chunk with download and upload overlapped
+Writes the combined count log to `logfile_path` and the annotated VCF to
+s3://<result_bucket>/<annofile_key>. Fills `timings` with seconds per
+stage summed over chunks. Returns (bytes downloaded, bytes uploaded).
+"""
+def run(s3_client, input_bucket, input_key, job_directory, logfile_path,
+    result_bucket, annofile_key, timings=None, chunk_records=5000,
+    range_size=8 * MB, part_size=8 * MB):
+
+    chunk_dir = os.path.join(job_directory, 'chunks')
+    os.makedirs(chunk_dir, exist_ok=True)
+
+    # small queues bound local disk use to a few chunks at a time
+    chunks = queue.Queue(maxsize=2)
+    outputs = queue.Queue(maxsize=2)
+    reader = ChunkReader(s3_client, input_bucket, input_key, chunk_dir,
+        chunks, chunk_records=chunk_records, range_size=range_size)
+    writer = MultipartWriter(s3_client, result_bucket, annofile_key, outputs,
+        part_size=part_size)
+    reader.start()
+    writer.start()
+
+    logs = []
+    annotated = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                break
+            chunk_timings = {}
+            driver.run(chunk, 'vcf', timings=chunk_timings)
+            for stage, secs in chunk_timings.items():
+                if timings is not None:
+                    timings[stage] = timings.get(stage, 0.0) + secs
+            logs.append(chunk + '.count.log')
+            os.remove(chunk)
+            outputs.put(chunk[:-4] + '.annot.vcf')
+        annotated = True
+    finally:
+        # unblock the reader if annotation failed part way
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        # publish the result only if every chunk was read and annotated
+        outputs.put(_DONE if annotated and reader.error is None else _ABORT)
+        writer.join()
+
+    if reader.error is not None:
+        raise reader.error
+    if writer.error is not None:
+        raise writer.error
+
+    merge_count_logs(logs, logfile_path)
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    return reader.bytes_read, writer.bytes_written
+
+### EOF
@@ -0,0 +1,133 @@
+# test_admission.py
+#
+# Limits applied by the annotator's AdmissionController (admission.py),
+# with the host's free memory, disk and load replaced by fixed values
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir))
+import admission
+from admission import MB, AdmissionController, estimate_footprint
+
+
+class Host(object):
+    def __init__(self, memory=8192 * MB, disk=100000 * MB, load=0.1):
+        self.memory = memory
+        self.disk = disk
+        self.load = load
+        self.rss = {}
+
+
+@pytest.fixture
+def host(monkeypatch):
+    host = Host()
+    monkeypatch.setattr(admission, 'available_memory', lambda: host.memory)
+    monkeypatch.setattr(admission, 'available_disk', lambda path: host.disk)
+    monkeypatch.setattr(admission, 'normalised_load', lambda: host.load)
+    monkeypatch.setattr(admission, 'process_rss', lambda pid: host.rss.get(pid))
+    return host
+
+
+class Process(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+def controller(**kwargs):
+    settings = dict(max_jobs=2, max_load=1.5, min_free_disk_mb=512,
+        min_free_memory_mb=256, disk_factor=16, base_memory_mb=150,
+        memory_factor=2)
+    settings.update(kwargs)
+    return AdmissionController('/jobs', **settings)
+
+
+def test_estimate_footprint():
+    assert estimate_footprint(10 * MB) == {'disk': 160 * MB,
+        'memory': 170 * MB}
+
+
+def test_max_jobs(host):
+    admit = controller()
+    assert admit.admit('a', MB)[0]
+    assert admit.admit('a', MB) == (True, 'already admitted')
+    assert admit.admit('b', MB)[0]
+    admitted, reason = admit.admit('c', MB)
+    assert not admitted and '2 jobs' in reason
+    admit.release('a')
+    assert admit.admit('c', MB)[0]
+    assert admit.running() == 2
+
+
+def test_finished_processes_free_their_slot(host):
+    admit = controller(max_jobs=1)
+    process = Process(100)
+    assert admit.admit('a', MB)[0]
+    admit.track('a', process)
+    assert not admit.admit('b', MB)[0]
+    process.returncode = 0
+    assert admit.admit('b', MB)[0]
+
+
+def test_load_only_limits_a_busy_host(host):
+    host.load = 5.0
+    admit = controller()
+    # an idle annotator always takes one job, however high the load
+    assert admit.admit('a', MB)[0]
+    admitted, reason = admit.admit('b', MB)
+    assert not admitted and 'load' in reason
+
+
+def test_disk_reservations(host):
+    # room for 1000 MB of temp files above the 512 MB floor
+    host.disk = 1512 * MB
+    admit = controller(max_jobs=10)
+    assert admit.admit('a', 50 * MB)[0]      # 800 MB reserved
+    admitted, reason = admit.admit('b', 50 * MB)
+    assert not admitted and 'disk' in reason
+    assert admit.admit('c', 10 * MB)[0]      # 160 MB more fits
+
+
+def test_memory_reservations_shrink_as_jobs_grow(host):
+    # 1000 MB above the 256 MB floor; a 100 MB input needs 350 MB
+    host.memory = 1256 * MB
+    admit = controller(max_jobs=10)
+    process = Process(100)
+    assert admit.admit('a', 100 * MB)[0]
+    admit.track('a', process)
+    assert admit.admit('b', 100 * MB)[0]
+    admitted, reason = admit.admit('c', 100 * MB)
+    assert not admitted and 'memory' in reason
+
+    # job a now holds its memory itself: the kernel's figure already
+    # counts it, so only the rest of its reservation is still owed
+    host.memory -= 300 * MB
+    host.rss[100] = 300 * MB
+    assert not admit.admit('c', 100 * MB)[0]
+    host.memory += 300 * MB
+    assert admit.admit('c', 100 * MB)[0]
+
+
+def test_unknown_memory_is_not_a_limit(host):
+    host.memory = None
+    assert controller().admit('a', 1000 * MB)[0]
+
+
+def test_from_config():
+    admit = AdmissionController.from_config('/jobs', {
+        'ANNOTATOR_MAX_JOBS': '3', 'ANNOTATOR_MAX_LOAD': '2.0',
+        'ANNOTATOR_MIN_FREE_DISK_MB': '100', 'ANNOTATOR_MIN_FREE_MEMORY_MB': '200',
+        'ANNOTATOR_DISK_FACTOR': '4', 'ANNOTATOR_BASE_MEMORY_MB': '50',
+        'ANNOTATOR_MEMORY_FACTOR': '1'})
+    assert (admit.max_jobs, admit.max_load) == (3, 2.0)
+    assert (admit.min_free_disk, admit.min_free_memory) == (100 * MB, 200 * MB)
+
+### EOF
@@ -0,0 +1,149 @@
+# test_checkpoint.py
+#
+# Resume points of checkpoint.py: which stages a rerun may skip, and the
+# state of the count log it resumes from
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import shutil
+import sys
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir))
+from checkpoint import Checkpoint
+
+
+"""Run `stages` fake stages the way driver.run() does: write <infile>.<n>,
+append to the count log, then record the checkpoint
+"""
+def run_stages(checkpoint, stages, start=0):
+    for n in range(start + 1, stages + 1):
+        with open(checkpoint.infile + f'.{n}', 'w') as fh:
+            fh.write(f'output of stage {n}\n' * n)
+        with open(checkpoint.logfile, 'a') as fh:
+            fh.write(f'stage {n} done\n')
+        checkpoint.record(f'stage{n}', f'.{n}')
+
+
+def log_text(checkpoint):
+    with open(checkpoint.logfile) as fh:
+        return fh.read()
+
+
+@pytest.fixture
+def infile(tmp_path):
+    path = str(tmp_path / 'input.vcf')
+    with open(path, 'w') as fh:
+        fh.write('chr1\t1\t.\tA\tG\n')
+    return path
+
+
+def test_fresh_job_starts_from_scratch(infile):
+    assert Checkpoint(infile).resume() == 0
+
+
+def test_resume_after_last_recorded_stage(infile):
+    checkpoint = Checkpoint(infile)
+    checkpoint.resume()
+    run_stages(checkpoint, 3)
+    # a fourth stage appended to the log but died before its checkpoint
+    with open(checkpoint.logfile, 'a') as fh:
+        fh.write('stage 4 half')
+
+    rerun = Checkpoint(infile)
+    assert rerun.resume() == 3
+    assert log_text(rerun) == 'stage 1 done\nstage 2 done\nstage 3 done\n'
+    run_stages(rerun, 5, start=3)
+    assert [s['stage'] for s in rerun.manifest['stages']] == \
+        ['stage1', 'stage2', 'stage3', 'stage4', 'stage5']
+
+
+def test_corrupt_output_falls_back_to_an_earlier_stage(infile):
+    checkpoint = Checkpoint(infile)
+    checkpoint.resume()
+    run_stages(checkpoint, 3)
+    with open(infile + '.3', 'a') as fh:
+        fh.write('garbage')
+
+    rerun = Checkpoint(infile)
+    assert rerun.resume() == 2
+    assert log_text(rerun) == 'stage 1 done\nstage 2 done\n'
+
+
+def test_changed_log_is_not_resumed(infile):
+    checkpoint = Checkpoint(infile)
+    checkpoint.resume()
+    run_stages(checkpoint, 2)
+    with open(checkpoint.logfile, 'w') as fh:
+        fh.write('stage 1 DONE\nstage 2 done\n')
+    assert Checkpoint(infile).resume() == 0
+
+
+def test_other_input_is_not_resumed(infile):
+    checkpoint = Checkpoint(infile)
+    checkpoint.resume()
+    run_stages(checkpoint, 2)
+    with open(infile, 'a') as fh:
+        fh.write('chr1\t2\t.\tC\tT\n')
+    rerun = Checkpoint(infile)
+    assert rerun.resume() == 0
+    assert rerun.manifest['stages'] == []
+
+
+def test_unreadable_manifest_is_ignored(infile):
+    checkpoint = Checkpoint(infile)
+    checkpoint.resume()
+    run_stages(checkpoint, 1)
+    with open(checkpoint.manifest_path, 'w') as fh:
+        fh.write('{"input_sha256": ')
+    assert Checkpoint(infile).resume() == 0
+
+
+class DirectoryS3(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def upload_file(self, path, bucket, key):
+        os.makedirs(os.path.dirname(self._path(bucket, key)), exist_ok=True)
+        shutil.copyfile(path, self._path(bucket, key))
+
+    def download_file(self, bucket, key, path):
+        if not os.path.isfile(self._path(bucket, key)):
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        shutil.copyfile(self._path(bucket, key), path)
+
+    def delete_object(self, Bucket, Key):
+        if os.path.isfile(self._path(Bucket, Key)):
+            os.remove(self._path(Bucket, Key))
+
+
+def test_resume_on_another_instance(tmp_path):
+    s3 = DirectoryS3(str(tmp_path / 's3'))
+    instances = []
+    for name in ('first', 'second'):
+        os.makedirs(tmp_path / name)
+        infile = str(tmp_path / name / 'input.vcf')
+        with open(infile, 'w') as fh:
+            fh.write('chr1\t1\t.\tA\tG\n')
+        instances.append(Checkpoint(infile, s3_client=s3, bucket='checkpoints',
+            prefix='user/job/'))
+
+    first, second = instances
+    first.resume()
+    run_stages(first, 2)
+    assert second.resume() == 2
+    assert log_text(second) == 'stage 1 done\nstage 2 done\n'
+    with open(second.infile + '.2') as fh:
+        assert fh.read() == 'output of stage 2\n' * 2
+
+    second.clear()
+    assert not os.path.exists(second.manifest_path)
+    assert os.listdir(tmp_path / 's3' / 'checkpoints' / 'user' / 'job') == []
+
+### EOF
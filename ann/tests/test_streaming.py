@@ -0,0 +1,66 @@
+# test_streaming.py
+#
+# Merging of per-chunk count logs in streaming.py
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import types
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir))
+# streaming.run() calls driver.run(), which needs the MySQL reference
+# database; merge_count_logs() does not
+sys.modules.setdefault('driver', types.ModuleType('driver'))
+from streaming import merge_count_logs
+
+
+"""A count log as annotate.py writes it for `records` records
+"""
+def count_log(records, in_dbsnp, locations):
+    total = records + 1
+    lines = ['## Please notice that all Isoforms were counted',
+        '## Numbers may exceed number of variants in the annotated file',
+        f'Total: {total}',
+        f'In dbSNP: {in_dbsnp} ({(in_dbsnp / float(total)) * 100}%)',
+        'Variants located:']
+    lines += [f'In {name} {count}' for name, count in locations]
+    return '\n'.join(lines) + '\n'
+
+
+def write_logs(tmp_path, logs):
+    paths = []
+    for n, text in enumerate(logs):
+        path = str(tmp_path / f'chunk{n}.count.log')
+        with open(path, 'w') as fh:
+            fh.write(text)
+        paths.append(path)
+    return paths
+
+
+def merged(tmp_path, logs):
+    merged_path = str(tmp_path / 'merged.count.log')
+    merge_count_logs(write_logs(tmp_path, logs), merged_path)
+    with open(merged_path) as fh:
+        return fh.read()
+
+
+def test_counts_are_added_up(tmp_path):
+    logs = [
+        count_log(10, 4, [('interGenic', 6), ("'3 UTR", 3), ('CDS', 1)]),
+        count_log(5, 1, [('interGenic', 2), ("'3 UTR", 2), ('CDS', 0)]),
+        count_log(20, 0, [('interGenic', 20), ("'3 UTR", 0), ('CDS', 0)]),
+    ]
+    assert merged(tmp_path, logs) == count_log(35, 5,
+        [('interGenic', 28), ("'3 UTR", 5), ('CDS', 1)])
+
+
+def test_single_log_is_unchanged(tmp_path):
+    log = count_log(7, 3, [('Putative Promoter Region', 2), ("'5 UTR", 1)])
+    assert merged(tmp_path, [log]) == log
+
+
+def test_no_logs(tmp_path):
+    assert merged(tmp_path, []) == ''
+
+### EOF
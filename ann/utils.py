@@ -12,40 +12,47 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 
 import os
-import json
+import sys
 import pymysql
-import boto3
 from botocore.exceptions import ClientError
 
+# Cached Secrets Manager access shared with the other GAS modules
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'util'))
+from secret_store import get_provider, get_secret
+
 """Get connection to reference database
+If the login is refused (the password was rotated since the secret was
+cached), the secret is fetched again and the connection retried once.
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    for attempt in range(2):
+        # Get RDS secret from AWS Secrets Manager (cached; see secret_store.py)
+        try:
+            rds_secret = get_secret('rds/anntools_database')
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+        # Extract database connection parameters
+        rds_host = rds_secret['host']
+        mysql_port = rds_secret['port']
+        username = rds_secret['username']
+        password = rds_secret['password']
+        database_name = 'annotator'
+
+        # Return a connection to the database
+        try:
+            return pymysql.connect(
+                host=rds_host,
+                port=mysql_port,
+                user=username,
+                passwd=password,
+                db=database_name)
+        except pymysql.err.OperationalError as e:
+            # 1045: access denied
+            if e.args[0] != 1045 or attempt == 1:
+                raise e
+            get_provider().invalidate('rds/anntools_database')
 
 
 """Column inices for pileup and VCF
@@ -5,37 +5,356 @@
 #
 # Exercises the annotator's auto scaling
 #
+# Submits synthetic annotation jobs the same way the web app does
+# (S3 input upload, PENDING item in DynamoDB, request notification),
+# follows every job until it is COMPLETED, then reports throughput and
+# end-to-end latency percentiles.
+#
+# Examples:
+#   python ann_load.py --jobs 200 --rate 2 --arrival poisson
+#   python ann_load.py --arrival burst --burst-size 20 --rate 1
+#   python ann_load.py --endpoint-url http://localhost:4566  (LocalStack/moto)
+#
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import argparse
+import json
+import math
+import random
+import threading
 import uuid
 import time
 import sys
-import json
+from decimal import Decimal
+
 import boto3
 from botocore.exceptions import ClientError
 
 # Define constants here; no config file is used for this scipt
 USER_ID = "<UUID_for_your_Globus_Auth_identity>"
 EMAIL = "<CNetID>@uchicago.edu"
+AWS_REGION_NAME = "us-east-1"
+AWS_S3_INPUTS_BUCKET = "gas-inputs"
+AWS_S3_KEY_PREFIX = "haoyiran/"
+AWS_DYNAMODB_ANNOTATIONS_TABLE = "haoyiran_annotations"
+AWS_SNS_JOB_REQUEST_TOPIC = \
+  "arn:aws:sns:us-east-1:127134666975:haoyiran_a17_job_requests"
+
+# Synthetic input sizes (number of variant records) and their share of jobs
+DEFAULT_SIZE_MIX = "100:0.6,1000:0.3,10000:0.1"
+
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ['X', 'Y']
+BASES = 'ACGT'
+
+
+"""Build a synthetic VCF file with the given number of variant records
+"""
+def synthetic_vcf(records, rng=random):
+  lines = [
+    '##fileformat=VCFv4.1',
+    '##source=ann_load.py',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO'
+  ]
+  for _ in range(records):
+    ref = rng.choice(BASES)
+    alt = rng.choice([b for b in BASES if b != ref])
+    lines.append('\t'.join([
+      'chr' + rng.choice(CHROMOSOMES),
+      str(rng.randint(10000, 150000000)),
+      '.', ref, alt,
+      str(rng.randint(20, 99)), 'PASS', '.']))
+  return ('\n'.join(lines) + '\n').encode()
+
+
+"""Parse a size mix like "100:0.6,1000:0.3,10000:0.1" into (sizes, weights)
+"""
+def parse_size_mix(mix):
+  sizes, weights = [], []
+  for entry in mix.split(','):
+    size, _, weight = entry.partition(':')
+    sizes.append(int(size))
+    weights.append(float(weight or 1))
+  return sizes, weights
+
 
-"""Fires off annotation jobs with hardcoded data for testing
+"""Seconds to wait before each job for the requested arrival pattern
+constant - evenly spaced at `rate` jobs/s
+poisson  - exponential inter-arrival times with mean 1/rate
+burst    - `burst_size` jobs at once, bursts spaced to average `rate` jobs/s
 """
-def load_requests_queue():
+def arrival_gaps(pattern, rate, jobs, burst_size=10, rng=random):
+  if rate <= 0 or burst_size <= 0:
+    raise ValueError('Arrival rate and burst size must be positive')
+  for i in range(jobs):
+    if i == 0:
+      yield 0.0
+    elif pattern == 'constant':
+      yield 1.0 / rate
+    elif pattern == 'poisson':
+      yield rng.expovariate(rate)
+    elif pattern == 'burst':
+      yield (burst_size / rate) if i % burst_size == 0 else 0.0
+    else:
+      raise ValueError(f'Unknown arrival pattern: {pattern}')
+
+
+"""Nearest-rank percentile of a list of numbers
+"""
+def percentile(values, pct):
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = max(1, int(math.ceil(pct / 100.0 * len(ordered))))
+  return ordered[rank - 1]
+
+
+"""AWS handles used by the load generator
+Any objects with the same methods work, so the tool can run against
+LocalStack/moto (via endpoint_url) or the in-process stand-ins.
+"""
+class Targets(object):
+  def __init__(self, s3, table, sns=None, topic_arn=None, queue=None):
+    self.s3 = s3
+    self.table = table
+    self.sns = sns
+    self.topic_arn = topic_arn
+    self.queue = queue
+
+  @classmethod
+  def from_boto3(cls, region_name=AWS_REGION_NAME, endpoint_url=None,
+    table_name=AWS_DYNAMODB_ANNOTATIONS_TABLE, topic_arn=None,
+    queue_name=None):
+    kwargs = {'region_name': region_name}
+    if endpoint_url:
+      kwargs['endpoint_url'] = endpoint_url
+    s3 = boto3.client('s3', **kwargs)
+    table = boto3.resource('dynamodb', **kwargs).Table(table_name)
+    if queue_name:
+      queue = boto3.resource('sqs', **kwargs).get_queue_by_name(
+        QueueName=queue_name)
+      return cls(s3, table, queue=queue)
+    return cls(s3, table, sns=boto3.client('sns', **kwargs),
+      topic_arn=topic_arn or AWS_SNS_JOB_REQUEST_TOPIC)
+
+
+"""Fires off one annotation job with synthetic data
+Mirrors views.create_annotation_job_request; returns the job record.
+"""
+def load_requests_queue(targets, records, user_id=USER_ID,
+  bucket=AWS_S3_INPUTS_BUCKET, key_prefix=AWS_S3_KEY_PREFIX, rng=random):
+
+  job_id = str(uuid.uuid4())
+  file_name = f'load_{records}.vcf'
+  key = f'{key_prefix}{user_id}/{job_id}~{file_name}'
+  body = synthetic_vcf(records, rng)
+  targets.s3.put_object(Bucket=bucket, Key=key, Body=body)
 
   # Define and persist job data
+  submit_time = time.time()
+  data = {
+    "job_id": job_id,
+    "user_id": user_id,
+    "input_file_name": file_name,
+    "s3_inputs_bucket": bucket,
+    "s3_key_input_file": key,
+    "submit_time": Decimal(str(submit_time)),
+    "job_status": "PENDING"
+  }
+  targets.table.put_item(Item=data)
 
   # Send message to request queue
+  message = json.dumps(dict(data, submit_time=str(submit_time)))
+  if targets.queue is not None:
+    # annotator expects the SNS envelope around the job data
+    targets.queue.send_message(MessageBody=json.dumps({"Message": message}))
+  else:
+    targets.sns.publish(TopicArn=targets.topic_arn, Message=message)
 
-  pass
+  return {'job_id': job_id, 'records': records, 'bytes': len(body),
+    'submit_time': submit_time}
 
-if __name__ == '__main__':
-  while True:
+
+"""Follows submitted jobs in DynamoDB until they are COMPLETED
+"""
+class Tracker(object):
+  def __init__(self, table, poll_interval=2.0):
+    self.table = table
+    self.poll_interval = poll_interval
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.completed = []
+    self.errors = 0
+
+  def add(self, job):
+    with self.lock:
+      self.pending[job['job_id']] = job
+
+  def outstanding(self):
+    with self.lock:
+      return len(self.pending)
+
+  def poll(self):
+    with self.lock:
+      jobs = list(self.pending.values())
+    for job in jobs:
+      try:
+        item = self.table.get_item(Key={'job_id': job['job_id']}).get('Item')
+      except ClientError as e:
+        print(f'Unable to read job {job["job_id"]}: {e}')
+        self.errors += 1
+        continue
+      if item and item.get('job_status') == 'COMPLETED':
+        observed = time.time()
+        complete_time = float(item.get('complete_time', observed))
+        job['complete_time'] = complete_time
+        job['latency'] = complete_time - job['submit_time']
+        with self.lock:
+          self.pending.pop(job['job_id'], None)
+          self.completed.append(job)
+
+  def wait(self, timeout):
+    deadline = time.time() + timeout
+    while self.outstanding() > 0 and time.time() < deadline:
+      self.poll()
+      if self.outstanding() > 0:
+        time.sleep(self.poll_interval)
+
+
+"""Submit jobs following an arrival pattern and track them to completion
+Returns a summary dict (see report()).
+"""
+def run_load(targets, jobs=20, rate=1.0, arrival='constant',
+  size_mix=DEFAULT_SIZE_MIX, burst_size=10, timeout=1800,
+  poll_interval=2.0, user_id=USER_ID, rng=random,
+  bucket=AWS_S3_INPUTS_BUCKET, key_prefix=AWS_S3_KEY_PREFIX):
+
+  sizes, weights = parse_size_mix(size_mix)
+  tracker = Tracker(targets.table, poll_interval=poll_interval)
+  submit_errors = 0
+
+  # poll for completions in the background while jobs are being submitted
+  stop = threading.Event()
+  def track():
+    while not stop.is_set():
+      tracker.poll()
+      stop.wait(poll_interval)
+  tracker_thread = threading.Thread(target=track, daemon=True)
+  tracker_thread.start()
+
+  start = time.time()
+  for gap in arrival_gaps(arrival, rate, jobs, burst_size, rng):
+    if gap > 0:
+      time.sleep(gap)
+    records = rng.choices(sizes, weights)[0]
     try:
-      load_requests_queue()
-      time.sleep(3)
+      tracker.add(load_requests_queue(targets, records, user_id=user_id,
+        bucket=bucket, key_prefix=key_prefix, rng=rng))
     except ClientError as e:
-      print("Irrecoverable error. Exiting.")
-      sys.exit()
+      print(f'Unable to submit job: {e}')
+      submit_errors += 1
+  submit_end = time.time()
+
+  stop.set()
+  tracker_thread.join()
+  tracker.wait(max(0, timeout - (time.time() - start)))
+
+  return summarize(tracker, start, submit_end, submit_errors)
+
+
+"""Throughput and latency percentiles for a finished load run
+"""
+def summarize(tracker, start, submit_end, submit_errors=0):
+  latencies = [job['latency'] for job in tracker.completed]
+  end = max([job['complete_time'] for job in tracker.completed] or [time.time()])
+  elapsed = max(end - start, 1e-9)
+  return {
+    'submitted': len(tracker.completed) + tracker.outstanding(),
+    'completed': len(tracker.completed),
+    'timed_out': tracker.outstanding(),
+    'submit_errors': submit_errors,
+    'poll_errors': tracker.errors,
+    'submit_seconds': submit_end - start,
+    'elapsed_seconds': elapsed,
+    'throughput_jobs_per_sec': len(tracker.completed) / elapsed,
+    'latency_p50': percentile(latencies, 50),
+    'latency_p95': percentile(latencies, 95),
+    'latency_p99': percentile(latencies, 99),
+    'latency_max': max(latencies) if latencies else None,
+  }
+
+
+"""Print a load run summary
+"""
+def report(summary):
+  def fmt(value):
+    return '-' if value is None else f'{value:.2f}s'
+  print(f"Jobs submitted:  {summary['submitted']} "
+    f"({summary['submit_errors']} submit errors)")
+  print(f"Jobs completed:  {summary['completed']} "
+    f"({summary['timed_out']} timed out)")
+  print(f"Elapsed:         {summary['elapsed_seconds']:.1f}s "
+    f"(submission took {summary['submit_seconds']:.1f}s)")
+  print(f"Throughput:      {summary['throughput_jobs_per_sec']:.3f} jobs/s")
+  print(f"Latency p50/p95/p99/max: {fmt(summary['latency_p50'])} / "
+    f"{fmt(summary['latency_p95'])} / {fmt(summary['latency_p99'])} / "
+    f"{fmt(summary['latency_max'])}")
+
+
+"""argparse types for values that must be greater than zero
+"""
+def positive_float(value):
+  number = float(value)
+  if number <= 0:
+    raise argparse.ArgumentTypeError(f'{value} is not a positive number')
+  return number
+
+def positive_int(value):
+  number = int(value)
+  if number <= 0:
+    raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+  return number
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description='GAS annotator load generator')
+  parser.add_argument('--jobs', type=int, default=20,
+    help='number of jobs to submit')
+  parser.add_argument('--rate', type=positive_float, default=1.0,
+    help='average arrival rate (jobs/s)')
+  parser.add_argument('--arrival', choices=['constant', 'poisson', 'burst'],
+    default='constant')
+  parser.add_argument('--burst-size', type=positive_int, default=10)
+  parser.add_argument('--sizes', default=DEFAULT_SIZE_MIX,
+    help='records:weight pairs for synthetic VCF sizes')
+  parser.add_argument('--timeout', type=float, default=1800,
+    help='seconds to wait for all jobs to complete')
+  parser.add_argument('--poll-interval', type=float, default=2.0)
+  parser.add_argument('--user-id', default=USER_ID)
+  parser.add_argument('--region', default=AWS_REGION_NAME)
+  parser.add_argument('--endpoint-url', default=None,
+    help='AWS endpoint override, e.g. LocalStack or moto server')
+  parser.add_argument('--table', default=AWS_DYNAMODB_ANNOTATIONS_TABLE)
+  parser.add_argument('--topic-arn', default=AWS_SNS_JOB_REQUEST_TOPIC)
+  parser.add_argument('--queue-name', default=None,
+    help='send straight to this SQS queue instead of publishing to SNS')
+  parser.add_argument('--seed', type=int, default=None)
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = parse_args()
+  rng = random.Random(args.seed)
+  try:
+    targets = Targets.from_boto3(region_name=args.region,
+      endpoint_url=args.endpoint_url, table_name=args.table,
+      topic_arn=args.topic_arn, queue_name=args.queue_name)
+    summary = run_load(targets, jobs=args.jobs, rate=args.rate,
+      arrival=args.arrival, size_mix=args.sizes, burst_size=args.burst_size,
+      timeout=args.timeout, poll_interval=args.poll_interval,
+      user_id=args.user_id, rng=rng)
+  except ClientError as e:
+    print(f"Irrecoverable error. Exiting: {e}")
+    sys.exit(1)
+  report(summary)
 
-### EOF
\ No newline at end of file
+### EOF
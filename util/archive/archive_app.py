@@ -14,20 +14,176 @@ import json
 import requests
 import os
 import sys
+import time
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import metrics
+import tracing
+from glacier_stream import GlacierStreamUploader, MB
+from bundler import ResultBundler
+from archive_codec import CODEC_ATTRIBUTE, CompressingReader, select_codec
+from delay_scheduler import DelayScheduler
 
 app = Flask(__name__)
 environment = 'archive_app_config.Config'
 app.config.from_object(environment)
 
+# Runtime metrics served on /metrics
+registry = metrics.Registry()
+gas_metrics = metrics.gas_metrics(registry)
+metrics.instrument_flask_app(app, registry, gas_metrics, 'archive')
+
+
+def glacier_uploader():
+    return GlacierStreamUploader(
+        boto3.client('glacier', region_name=app.config['AWS_REGION_NAME']),
+        app.config['AWS_GLACIER_VAULT_NAME'],
+        part_size=int(app.config['AWS_GLACIER_PART_SIZE_MB']) * MB,
+        workers=int(app.config['AWS_GLACIER_UPLOAD_WORKERS']))
+
+
+# Compression applied before archival ("gzip", "zstd" or "none")
+codec = select_codec(app.config['AWS_GLACIER_COMPRESSION'])
+
+def count_archived_bundle(archive_id, size, files):
+    gas_metrics['s3_transfer_bytes'].inc(size, service='archive', direction='archive')
+
+# Bundle free user results into shared Glacier archives (window > 0), or
+# archive each result file on its own
+bundler = None
+if int(app.config['AWS_GLACIER_BUNDLE_WINDOW']) > 0:
+    bundler = ResultBundler(
+        boto3.client('s3', region_name=app.config['AWS_REGION_NAME']),
+        glacier_uploader(),
+        boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME']).Table(
+            app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']),
+        app.config['ARCHIVE_SPOOL_DIR'],
+        window=int(app.config['AWS_GLACIER_BUNDLE_WINDOW']),
+        max_bytes=int(app.config['AWS_GLACIER_BUNDLE_MAX_MB']) * MB,
+        max_files=int(app.config['AWS_GLACIER_BUNDLE_MAX_FILES']),
+        codec=codec,
+        on_archived=count_archived_bundle)
+
+
+"""Publish archive requests whose retention period has ended, 10 per call
+Each one reaches the wait-ended queue (and pings /archive) just like the
+message the waiting-engine state machine used to publish. Returns the
+keys (job IDs) that could not be published.
+"""
+def publish_wait_ended(entries):
+    sns_client = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+    failed = []
+    for i in range(0, len(entries), 10):
+        chunk = entries[i:i + 10]
+        try:
+            response = sns_client.publish_batch(
+                TopicArn=app.config['AWS_SNS_WAIT_ENDED_TOPIC'],
+                PublishBatchRequestEntries=[
+                    {'Id': str(n), 'Message': json.dumps(payload)}
+                    for n, (_, payload) in enumerate(chunk)])
+            failed += [chunk[int(f['Id'])][0] for f in response.get('Failed', [])]
+        except botocore.exceptions.ClientError as e:
+            print(f'Unable to publish archive requests: {e}')
+            failed += [key for key, _ in chunk]
+    print(f'Released {len(entries) - len(failed)} results for archival')
+    return failed
+
+# Results wait here for FREE_USER_DATA_RETENTION seconds before archival
+scheduler = DelayScheduler(app.config['ARCHIVE_SCHEDULE_FILE'], publish_wait_ended,
+    batch_size=int(app.config['ARCHIVE_SCHEDULE_BATCH_SIZE']))
+
+
+"""True if the job's results are already in Glacier, or the job is gone
+Redelivered and duplicate archive requests are dropped on this; when the
+job item can't be read the request is handled as usual.
+"""
+def already_archived(job_id):
+    dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    try:
+        table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        item = table.get_item(Key={'job_id': job_id},
+            ProjectionExpression='job_id, results_file_archive_id').get('Item')
+    except botocore.exceptions.ClientError as e:
+        print(f'Unable to look up job {job_id}: {e}')
+        return False
+    return item is None or 'results_file_archive_id' in item
+
+
+"""Append the archive hop's trace spans to the job item (best effort)
+"""
+def record_trace_spans(job_id, trace):
+    dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    trace_clause, trace_values = trace.update_clause()
+    try:
+        table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET ' + trace_clause,
+            ExpressionAttributeValues=trace_values
+        )
+    except botocore.exceptions.ClientError as e:
+        print(f'Unable to record trace spans for job {job_id}: {e}')
+
 
 @app.route('/', methods=['GET'])
 def home():
     return (f"This is the Archive utility: POST requests to /archive.")
 
+"""Accept a completed job from the results-ready topic and schedule its
+archival; the entry is on disk before SNS gets its 200
+"""
+@app.route('/schedule', methods=['POST'])
+def schedule_archival():
+    try:
+        js = json.loads(request.data)
+    except json.JSONDecodeError as e:
+        print(e)
+        return jsonify({
+            "code": 500,
+            "message": f'Unable to decode json data: {e}'
+        }), 500
+
+    hdr = request.headers.get('x-amz-sns-message-type')
+    if hdr == 'SubscriptionConfirmation' and 'SubscribeURL' in js:
+        r = requests.get(js['SubscribeURL'])
+        if r.status_code == 200:
+            return jsonify({
+                "code": 200,
+                "message": f'You have succefully subscribed to SNS'
+                }), 200
+        else:
+            return jsonify({
+                "code": 500,
+                "message": f'Unable to subscribe to SNS'
+                }), 500
+
+    elif hdr == 'Notification':
+        try:
+            msg_body = json.loads(js['Message'])
+            job_id = msg_body['job_id']
+        except (KeyError, ValueError) as e:
+            print(e)
+            return jsonify({
+                "code": 400,
+                "message": f'Unable to read results ready message: {e}'
+                }), 400
+
+        completed_at = float(msg_body.get('completed_at') or time.time())
+        due_at = completed_at + float(app.config['FREE_USER_DATA_RETENTION'])
+        scheduler.schedule(job_id, due_at, msg_body)
+        return jsonify({
+            "code": 200,
+            "message": f'Archival of job {job_id} scheduled; {len(scheduler)} pending.'
+            }), 200
+
+    return jsonify({
+        "code": 400,
+        "message": f'Unexpected SNS message type: {hdr}'
+        }), 400
+
+
 @app.route('/archive', methods=['POST'])
 def archive_free_user_data():
     if request.method == 'POST':
@@ -75,8 +231,9 @@ def archive_free_user_data():
             wait_time = int(app.config['AWS_SQS_WAIT_TIME'])
             max_num_message = int(app.config['AWS_SQS_MAX_MESSAGES'])
             try:
-                messages = queue.receive_messages(WaitTimeSeconds = wait_time, 
-                                                  MaxNumberOfMessages = max_num_message)
+                with gas_metrics['sqs_receive_seconds'].time(service='archive'):
+                    messages = queue.receive_messages(WaitTimeSeconds = wait_time, 
+                                                      MaxNumberOfMessages = max_num_message)
             except botocore.exceptions.ClientError as e:
                 print(e)
                 return jsonify({
@@ -84,143 +241,189 @@ def archive_free_user_data():
                     "message": f'Unable to receive message from SQS: {e}'
                     }), 500
             
+            gas_metrics['sqs_messages_per_poll'].observe(len(messages), service='archive')
+            received_at = time.time()
+
             # Start processing messages from SQS 
             if len(messages) > 0:
                 print(f'Received {str(len(messages))} messages...')
 
                 # Iterate each message
                 for message in messages:
-                    # Parse JSON message
-                    print("new message")
-                    try:
-                        msg_body = json.loads(json.loads(message.body)["Message"])
-                        print(msg_body)
-                    except json.JSONDecodeError as e:
-                        print(e)
-                        return jsonify({
-                            "code": 500,
-                            "message": f'Unable to decode message into json: {e}'
-                            }), 500
-                    
-                    try: 
-                        job_id = msg_body["job_id"]
-                        user_id = msg_body["user_id"]
-                        results_bucket = msg_body["results_bucket"]
-                        annofile_path_s3 = msg_body["annofile_path_s3"]
-                    except KeyError as e:
-                        print(e)
-                        return jsonify({
-                            "code": 500,
-                            "message": f'Missing field in message: {e}'
-                            }), 500
+                    with metrics.track_job(gas_metrics, 'archive'):
+                        # Parse JSON message
+                        print("new message")
+                        try:
+                            msg_body = json.loads(json.loads(message.body)["Message"])
+                            print(msg_body)
+                        except json.JSONDecodeError as e:
+                            print(e)
+                            return jsonify({
+                                "code": 500,
+                                "message": f'Unable to decode message into json: {e}'
+                                }), 500
                     
-                    # get user_id profile
-                    _, _, _, _, role, _, _ = helpers.get_user_profile(id = user_id) 
-                    # If premium user, delete the message from the queue
-                    if role == 'premium_user':
-                        print("premium user")
                         try: 
-                            print("Deleting message...")
-                            message.delete()
-                        except botocore.exceptions.ClientError as e:
+                            job_id = msg_body["job_id"]
+                            user_id = msg_body["user_id"]
+                            results_bucket = msg_body["results_bucket"]
+                            annofile_path_s3 = msg_body["annofile_path_s3"]
+                        except KeyError as e:
                             print(e)
                             return jsonify({
-                            'code': 500, 
-                            'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
-                            }), 500
+                                "code": 500,
+                                "message": f'Missing field in message: {e}'
+                                }), 500
                     
-                    else:
-                        print("free user")
-                        
-                        # Retrieve the S3 object
-                        s3_resource = boto3.resource('s3', region_name=app.config['AWS_REGION_NAME'])
-                        try:
-                            annofile = s3_resource.Object(results_bucket, annofile_path_s3)
-                        except botocore.exceptions.ClientError as e:
-                            print(e)
-                            error_code = e.response['Error']['Code']
-                            if 'NoSuchBucket' in error_code or 'NoSuchKey' in error_code:
-                                return jsonify({
-                                    'code': 400, 
-                                    'message': f'Unable to find result file on S3: {e}'
-                                    }), 400
-                            else:
-                                return jsonify({
-                                    'code': 500, 
-                                    'message': f'Unexpected error while getting result file from S3: {e}'
-                                    }), 500
+                        # time spent in the waiting engine counts towards the job's trace
+                        trace = tracing.Trace.from_message(msg_body, 'archive')
+                        trace.add_wait('archive_wait', received_at)
 
+                        if already_archived(job_id):
+                            print(f'Job {job_id} is already archived; dropping its message')
+                            try:
+                                message.delete()
+                            except botocore.exceptions.ClientError as e:
+                                print(e)
+                            continue
 
-                        # Upload the S3 object to Glacier and get archive id
-                        glacier_client = boto3.client('glacier', region_name=app.config['AWS_REGION_NAME'])
-                        try:
-                            print("moving result file to Glacier")
-                            response = glacier_client.upload_archive(
-                                vaultName=app.config['AWS_GLACIER_VAULT_NAME'],
-                                archiveDescription=job_id,
-                                body=annofile.get()['Body'].read()
-                            )
-                            print(response)
-                            archive_id = response['archiveId']
-                        except botocore.exceptions.ClientError as e:
-                            print(e)
-                            error_code = e.response['Error']['Code']
-                            if 'ResourceNotFoundException' in error_code or 'InvalidParameterValueException' in error_code:
+                        # get user_id role (read fresh, not from the profile cache)
+                        role = helpers.get_user_role(id = user_id)
+                        # If premium user, delete the message from the queue
+                        if role == 'premium_user':
+                            print("premium user")
+                            record_trace_spans(job_id, trace)
+                            try: 
+                                print("Deleting message...")
+                                message.delete()
+                            except botocore.exceptions.ClientError as e:
+                                print(e)
                                 return jsonify({
-                                    'code': 400,
-                                    'message': f'Unable to locate vault on S3 Glacier: {e}'
-                                }), 400
-                            else:
+                                'code': 500, 
+                                'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
+                                }), 500
+                    
+                        elif bundler is not None:
+                            # archived with other results once the bundle fills
+                            # up or its window ends; the message is deleted then
+                            print("free user, bundling result file")
+                            try:
+                                bundler.add(job_id, results_bucket, annofile_path_s3,
+                                    message, trace)
+                            except (botocore.exceptions.ClientError,
+                                botocore.exceptions.BotoCoreError, OSError) as e:
+                                # e.g. the S3 read failed part way; the message
+                                # reappears and the file is bundled again
+                                print(e)
                                 return jsonify({
                                     'code': 500,
-                                    'message': f'Unexpected error while uploading file to S3 Glacier: {e}'
-                                }), 500
+                                    'message': f'Unable to add result file to archive bundle: {e}'
+                                    }), 500
+
+                        else:
+                            print("free user")
                         
+                            # Retrieve the S3 object
+                            s3_resource = boto3.resource('s3', region_name=app.config['AWS_REGION_NAME'])
+                            try:
+                                annofile = s3_resource.Object(results_bucket, annofile_path_s3)
+                            except botocore.exceptions.ClientError as e:
+                                print(e)
+                                error_code = e.response['Error']['Code']
+                                if 'NoSuchBucket' in error_code or 'NoSuchKey' in error_code:
+                                    return jsonify({
+                                        'code': 400, 
+                                        'message': f'Unable to find result file on S3: {e}'
+                                        }), 400
+                                else:
+                                    return jsonify({
+                                        'code': 500, 
+                                        'message': f'Unexpected error while getting result file from S3: {e}'
+                                        }), 500
 
-                        # Update Dynamodb with Glacier key
-                        dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-                        try:
-                            print("persisting archive id to dynamodb")
-                            table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-                            response = table.update_item(
-                                Key={'job_id': job_id},
-                                UpdateExpression='SET results_file_archive_id = :val1 REMOVE s3_key_result_file',
-                                ExpressionAttributeValues={
-                                    ':val1': archive_id
-                                }
-                            )
-                        except botocore.exceptions.ClientError as e:
-                            print(e)
-                            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                                return jsonify({
-                                    'code': 400,
-                                    'message': f'Unable to update because the condition was not met: {e}'
-                                }), 400
-                            elif e.response['Error']['Code'] == 'ItemNotFoundException':
-                                return jsonify({
-                                    'code': 404,
-                                    'message': f'Unable to find the item: {e}'
-                                }), 404
-                            else:
-                                return jsonify({
-                                    'code': 500,
-                                    'message': f'Unexpected error while updating dynamodb: {e}'
-                                }), 500
+
+                            # Stream the S3 object to Glacier (multipart, a few parts
+                            # in memory at a time) and get archive id
+                            uploader = glacier_uploader()
+                            try:
+                                print("moving result file to Glacier")
+                                transfer_start = time.time()
+                                stream = annofile.get()['Body']
+                                if codec:
+                                    stream = CompressingReader(stream, codec)
+                                archive_id, archive_size, _ = uploader.upload(
+                                    stream, description=job_id)
+                                gas_metrics['s3_transfer_seconds'].inc(time.time() - transfer_start,
+                                    service='archive', direction='archive')
+                                gas_metrics['s3_transfer_bytes'].inc(archive_size,
+                                    service='archive', direction='archive')
+                                print(f'archive id: {archive_id}')
+                                trace.add('glacier_upload', transfer_start)
+                            except botocore.exceptions.ClientError as e:
+                                print(e)
+                                error_code = e.response['Error']['Code']
+                                if 'ResourceNotFoundException' in error_code or 'InvalidParameterValueException' in error_code:
+                                    return jsonify({
+                                        'code': 400,
+                                        'message': f'Unable to locate vault on S3 Glacier: {e}'
+                                    }), 400
+                                else:
+                                    return jsonify({
+                                        'code': 500,
+                                        'message': f'Unexpected error while uploading file to S3 Glacier: {e}'
+                                    }), 500
+                        
+
+                            # Update Dynamodb with Glacier key
+                            dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+                            try:
+                                print("persisting archive id to dynamodb")
+                                table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+                                trace_clause, trace_values = trace.update_clause()
+                                codec_clause, codec_values = '', {}
+                                if codec:
+                                    # tells restore how to decompress the archive
+                                    codec_clause = f'{CODEC_ATTRIBUTE} = :codec, '
+                                    codec_values = {':codec': codec}
+                                response = table.update_item(
+                                    Key={'job_id': job_id},
+                                    UpdateExpression='SET results_file_archive_id = :val1, ' + codec_clause + trace_clause + ' REMOVE s3_key_result_file',
+                                    ExpressionAttributeValues=dict(trace_values, **codec_values, **{
+                                        ':val1': archive_id
+                                    })
+                                )
+                            except botocore.exceptions.ClientError as e:
+                                print(e)
+                                if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                                    return jsonify({
+                                        'code': 400,
+                                        'message': f'Unable to update because the condition was not met: {e}'
+                                    }), 400
+                                elif e.response['Error']['Code'] == 'ItemNotFoundException':
+                                    return jsonify({
+                                        'code': 404,
+                                        'message': f'Unable to find the item: {e}'
+                                    }), 404
+                                else:
+                                    return jsonify({
+                                        'code': 500,
+                                        'message': f'Unexpected error while updating dynamodb: {e}'
+                                    }), 500
                             
 
-                        # Remove file from S3
-                        # referring to: https://stackoverflow.com/questions/3140779/how-to-delete-files-from-amazon-s3-bucket
-                        print("deleting result file on S3")
-                        annofile.delete()
-                        try: 
-                            print("Deleting message...")
-                            message.delete()
-                        except botocore.exceptions.ClientError as e:
-                            print(e)
-                            return jsonify({
-                            'code': 500, 
-                            'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
-                            }), 500
+                            # Remove file from S3
+                            # referring to: https://stackoverflow.com/questions/3140779/how-to-delete-files-from-amazon-s3-bucket
+                            print("deleting result file on S3")
+                            annofile.delete()
+                            try: 
+                                print("Deleting message...")
+                                message.delete()
+                            except botocore.exceptions.ClientError as e:
+                                print(e)
+                                return jsonify({
+                                'code': 500, 
+                                'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
+                                }), 500
 
                 return jsonify({
                     "code": 200, 
@@ -236,6 +439,9 @@ def archive_free_user_data():
 
                    
     
-# Run using dev server (remove if running via uWSGI)
-app.run('0.0.0.0', debug=True)
+# Run using dev server (remove if running via uWSGI); not when imported
+# (e.g. by util/local/gas_local.py). No reloader: its watcher process
+# would import this module and start a second scheduler on the same journal
+if __name__ == '__main__':
+    app.run('0.0.0.0', debug=True, use_reloader=False)
 ### EOF
\ No newline at end of file
@@ -8,6 +8,10 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
 class Config(object):
 
   CSRF_ENABLED = True
@@ -19,10 +23,38 @@ class Config(object):
   AWS_SQS_WAIT_TIME = 20
   AWS_SQS_MAX_MESSAGES = 10
 
+  # AWS SNS topic: completed jobs arrive from the results ready topic
+  # (POSTed to /schedule) and are published here once
+  # FREE_USER_DATA_RETENTION seconds have passed
+  AWS_SNS_WAIT_ENDED_TOPIC = \
+    "arn:aws:sns:us-east-1:127134666975:haoyiran_a17_wait_ended"
+
+  # Delayed archival: pending entries are journaled in ARCHIVE_SCHEDULE_FILE
+  # and released in batches of up to ARCHIVE_SCHEDULE_BATCH_SIZE
+  FREE_USER_DATA_RETENTION = 300
+  ARCHIVE_SCHEDULE_FILE = os.path.join(basedir, 'schedule', 'archive_schedule.jsonl')
+  ARCHIVE_SCHEDULE_BATCH_SIZE = 100
+
   # AWS DynamoDB table
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "haoyiran_annotations"
 
   # AWS Glacier vault
   AWS_GLACIER_VAULT_NAME = "ucmpcs"
+  # Multipart uploads: part size (1 MB times a power of two) and parts
+  # uploaded at once; memory use is about (workers + 2) parts
+  AWS_GLACIER_PART_SIZE_MB = 8
+  AWS_GLACIER_UPLOAD_WORKERS = 4
+  # Compress result files before archival: "gzip", "zstd" or "none".
+  # zstd archives can only be restored once the restore Lambda ships the
+  # zstandard package (archival falls back to gzip where it is missing)
+  AWS_GLACIER_COMPRESSION = "gzip"
+
+  # Bundling: free user results are collected for up to WINDOW seconds
+  # (or MAX_MB / MAX_FILES) and archived together; a window of 0 archives
+  # each result file on its own. Bundles are built in ARCHIVE_SPOOL_DIR.
+  AWS_GLACIER_BUNDLE_WINDOW = 300
+  AWS_GLACIER_BUNDLE_MAX_MB = 1024
+  AWS_GLACIER_BUNDLE_MAX_FILES = 1000
+  ARCHIVE_SPOOL_DIR = os.path.join(basedir, 'spool')
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,75 @@
+# archive_codec.py
+#
+# Compression of results files on their way to Glacier
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Job item attribute naming the codec of the archived file; absent for
+# files archived uncompressed
+CODEC_ATTRIBUTE = 'results_file_archive_codec'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+"""Codec to use for a configured preference
+"zstd" falls back to "gzip" where the zstandard package is missing;
+"none" (or anything unknown) means no compression (None).
+"""
+def select_codec(preferred):
+    preferred = (preferred or 'none').lower()
+    if preferred == 'zstd':
+        return 'zstd' if zstandard is not None else 'gzip'
+    if preferred == 'gzip':
+        return 'gzip'
+    return None
+
+
+def new_compressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if codec == 'gzip':
+        # wbits 31: gzip container, so the file is also readable with gunzip
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    raise ValueError(f'Unknown codec: {codec}')
+
+
+"""File-like object returning the compressed form of `stream`
+Reads the source CHUNK_SIZE bytes at a time, so any stream with read(n)
+is compressed without holding it in memory.
+"""
+class CompressingReader(object):
+    def __init__(self, stream, codec):
+        self.stream = stream
+        self.compressor = new_compressor(codec)
+        self.buffer = b''
+        self.done = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or len(self.buffer) < size):
+            data = self.stream.read(CHUNK_SIZE)
+            if data:
+                self.bytes_in += len(data)
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.done = True
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.bytes_out += len(data)
+        return data
+
+### EOF
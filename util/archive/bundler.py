@@ -0,0 +1,237 @@
+# bundler.py
+#
+# Bundled archival of free user results
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+
+import botocore
+
+from archive_codec import CODEC_ATTRIBUTE, CHUNK_SIZE, CompressingReader
+
+# Member name suffix per codec
+CODEC_SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+
+MANIFEST_NAME = 'MANIFEST.json'
+
+
+"""A tar file being filled with result files
+Member data is stored as-is, so each file is one contiguous byte range
+of the archive: (offset, length) in the manifest. A retrieval of just
+that range (rounded out to whole megabytes, as Glacier requires) gets
+the file back without thawing the rest of the bundle.
+"""
+class Bundle(object):
+    def __init__(self, spool_dir):
+        self.bundle_id = str(uuid.uuid4())
+        self.path = os.path.join(spool_dir, f'{self.bundle_id}.tar')
+        self.tar = tarfile.open(self.path, 'w', format=tarfile.PAX_FORMAT)
+        self.entries = []
+        self.opened_at = time.time()
+
+    @property
+    def size(self):
+        return self.tar.offset
+
+    def __contains__(self, job_id):
+        return any(e['job_id'] == job_id for e in self.entries)
+
+    """Append a file read from `stream` (exactly `length` bytes)
+    Returns the manifest entry: name, data offset and length.
+    """
+    def add(self, job_id, name, stream, length, **attributes):
+        info = tarfile.TarInfo(name)
+        info.size = length
+        info.mtime = int(time.time())
+        self.tar.addfile(info, stream)
+        # the data is the member's last blocks, padded to 512 bytes
+        padded = -(-length // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        entry = dict(attributes, job_id=job_id, name=name,
+            offset=self.tar.offset - padded, length=length)
+        self.entries.append(entry)
+        return entry
+
+    def discard(self):
+        try:
+            self.tar.close()
+        except Exception:
+            pass
+        os.remove(self.path)
+
+    """Write the manifest as the last member and close the tar
+    """
+    def close(self):
+        manifest = json.dumps({'bundle_id': self.bundle_id,
+            'files': self.entries}, default=str).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(manifest)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(manifest))
+        self.tar.close()
+        return os.path.getsize(self.path)
+
+
+"""Accumulates free user results into bundles and archives each bundle
+as one Glacier archive
+
+add() spools a result file into the open bundle (compressed first when
+a codec is set) and keeps the job's SQS message; nothing is deleted
+yet. A background thread closes the bundle once it holds max_files
+files or max_bytes bytes, or window seconds after its first file (add()
+only wakes it, so the caller never waits on the upload), then:
+  1. uploads it to Glacier (GlacierStreamUploader),
+  2. records (archive id, offset, length) on every job item,
+  3. deletes the S3 result files and the SQS messages.
+If the process dies before that, the messages become visible again and
+the results are bundled anew; their S3 files are still in place.
+"""
+class ResultBundler(object):
+    def __init__(self, s3_client, uploader, table, spool_dir,
+        window=300, max_bytes=1024 * 1024 * 1024, max_files=1000,
+        codec=None, on_archived=None):
+        self.s3 = s3_client
+        self.uploader = uploader
+        self.table = table
+        self.spool_dir = spool_dir
+        self.window = window
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.codec = codec
+        self.on_archived = on_archived
+        os.makedirs(spool_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.bundle = None
+        self.pending = []  # (entry, message, trace) for the open bundle
+        self.full = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_when_due, daemon=True)
+        self.flusher.start()
+
+    """Spool one result file; returns False if the job is already bundled
+    """
+    def add(self, job_id, bucket, key, message, trace=None):
+        # keep the message hidden until the bundle has been archived
+        message.change_visibility(VisibilityTimeout=int(2 * self.window + 600))
+        body = self.s3.get_object(Bucket=bucket, Key=key)
+        name = os.path.basename(key)
+        stream = body['Body']
+        if self.codec:
+            stream = CompressingReader(stream, self.codec)
+            name += CODEC_SUFFIXES[self.codec]
+        # tar needs the member size up front, and a read failing part way
+        # must not leave a partial member in the bundle: spool the file
+        # (compressed when a codec is set) to a temp file first, outside
+        # the lock so other files can be added meanwhile
+        with tempfile.TemporaryFile(dir=self.spool_dir) as spooled:
+            shutil.copyfileobj(stream, spooled, CHUNK_SIZE)
+            length = spooled.tell()
+            spooled.seek(0)
+            with self.lock:
+                if self.bundle is None:
+                    self.bundle = Bundle(self.spool_dir)
+                elif job_id in self.bundle:
+                    return False
+                try:
+                    entry = self.bundle.add(job_id, name, spooled, length,
+                        bucket=bucket, key=key, codec=self.codec)
+                except Exception:
+                    # the tar may hold part of this member: offsets of later
+                    # members would be wrong, so drop the whole bundle; the
+                    # pending messages reappear and are bundled again
+                    print(f'Discarding bundle {self.bundle.bundle_id} after a failed add')
+                    self.bundle.discard()
+                    self.bundle, self.pending = None, []
+                    raise
+                self.pending.append((entry, message, trace))
+                full = len(self.pending) >= self.max_files or \
+                    self.bundle.size >= self.max_bytes
+        if full:
+            self.full.set()
+        return True
+
+    def _flush_when_due(self):
+        while True:
+            full = self.full.wait(min(self.window, 10))
+            self.full.clear()
+            with self.lock:
+                due = self.bundle is not None and (full or
+                    time.time() - self.bundle.opened_at >= self.window)
+            if due:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f'Unable to archive bundle: {e}')
+
+    """Close the open bundle (if any) and archive it
+    """
+    def flush(self):
+        with self.lock:
+            bundle, pending = self.bundle, self.pending
+            self.bundle, self.pending = None, []
+        if bundle is None:
+            return None
+
+        size = bundle.close()
+        transfer_start = time.time()
+        try:
+            with open(bundle.path, 'rb') as fh:
+                archive_id, _, _ = self.uploader.upload(fh,
+                    description=f'bundle:{bundle.bundle_id}')
+        except Exception as e:
+            # the messages reappear once their visibility runs out
+            print(f'Unable to upload bundle {bundle.bundle_id} to Glacier: {e}')
+            os.remove(bundle.path)
+            raise
+        print(f'Archived bundle {bundle.bundle_id}: {len(pending)} files, '
+            f'{size} bytes, archive id {archive_id}')
+
+        for entry, message, trace in pending:
+            if self._record(entry, archive_id, size, trace, transfer_start):
+                try:
+                    self.s3.delete_object(Bucket=entry['bucket'], Key=entry['key'])
+                    message.delete()
+                except botocore.exceptions.ClientError as e:
+                    print(f'Unable to clean up after archiving job {entry["job_id"]}: {e}')
+        os.remove(bundle.path)
+        if self.on_archived:
+            self.on_archived(archive_id, size, len(pending))
+        return archive_id
+
+    def _record(self, entry, archive_id, archive_size, trace, transfer_start):
+        update = 'SET results_file_archive_id = :id, ' \
+            'results_file_archive_offset = :offset, ' \
+            'results_file_archive_length = :length, ' \
+            'results_file_archive_size = :size'
+        values = {':id': archive_id, ':offset': entry['offset'],
+            ':length': entry['length'], ':size': archive_size}
+        if entry.get('codec'):
+            update += f', {CODEC_ATTRIBUTE} = :codec'
+            values[':codec'] = entry['codec']
+        if trace is not None:
+            trace.add('glacier_upload', transfer_start)
+            trace_clause, trace_values = trace.update_clause()
+            update += ', ' + trace_clause
+            values.update(trace_values)
+        try:
+            self.table.update_item(
+                Key={'job_id': entry['job_id']},
+                UpdateExpression=update + ' REMOVE s3_key_result_file',
+                ExpressionAttributeValues=values)
+            return True
+        except botocore.exceptions.ClientError as e:
+            # keep the S3 file; the job is archived again from its message
+            print(f'Unable to record archive location of job {entry["job_id"]}: {e}')
+            return False
+
+### EOF
@@ -0,0 +1,158 @@
+# delay_scheduler.py
+#
+# Durable delayed actions (free user archival after the retention period)
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import fcntl
+import heapq
+import json
+import os
+import threading
+import time
+
+
+"""Heap of (due time, key, payload) backed by an append-only journal
+schedule() writes an "add" record and fsyncs it before returning, so an
+accepted entry survives a crash or restart; fired entries get a "done"
+record. On start the journal is replayed: entries added and not done
+are scheduled again, late ones fire straight away. The journal is
+rewritten with just the pending entries once it holds more than
+compact_after records beyond them. Only one process at a time may use
+a journal: a second scheduler on the same path raises RuntimeError.
+
+A background thread waits for the earliest deadline and hands every
+entry that is due (up to batch_size at a time) to fire(entries), a list
+of (key, payload). fire returns the keys it could not handle, or raises
+to fail the whole batch; those entries are retried after retry_delay.
+"""
+class DelayScheduler(object):
+    def __init__(self, path, fire, batch_size=100, retry_delay=30,
+        compact_after=10000):
+        self.path = path
+        self.fire = fire
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.compact_after = compact_after
+        self.condition = threading.Condition()
+        self.heap = []      # (due_at, key)
+        self.entries = {}   # key -> (due_at, payload), pending only
+        self.records = 0    # records in the journal
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # held for the life of the process
+        self.lock_file = open(f'{path}.lock', 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise RuntimeError(f'{path} is in use by another scheduler')
+        self._replay()
+        self.journal = open(self.path, 'a')
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _replay(self):
+        try:
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn last write: the entry was never acknowledged
+                        continue
+                    self.records += 1
+                    if 'add' in record:
+                        self.entries[record['add']] = (record['due'], record['payload'])
+                    else:
+                        for key in record['done']:
+                            self.entries.pop(key, None)
+        except FileNotFoundError:
+            pass
+        self.heap = [(due_at, key) for key, (due_at, _) in self.entries.items()]
+        heapq.heapify(self.heap)
+        if self.entries:
+            print(f'Restored {len(self.entries)} scheduled entries from {self.path}')
+
+    def _write(self, *records):
+        for record in records:
+            self.journal.write(json.dumps(record, default=str) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.records += len(records)
+
+    def _compact(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as fh:
+            for key, (due_at, payload) in self.entries.items():
+                fh.write(json.dumps({'add': key, 'due': due_at,
+                    'payload': payload}, default=str) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.journal.close()
+        os.replace(tmp, self.path)
+        self.journal = open(self.path, 'a')
+        self.records = len(self.entries)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.entries)
+
+    """Run fire() with (key, payload) at due_at (epoch seconds)
+    Returns False if the key is already scheduled.
+    """
+    def schedule(self, key, due_at, payload):
+        with self.condition:
+            if key in self.entries:
+                return False
+            self._write({'add': key, 'due': due_at, 'payload': payload})
+            self.entries[key] = (due_at, payload)
+            heapq.heappush(self.heap, (due_at, key))
+            if self.heap[0][1] == key:
+                self.condition.notify()
+            return True
+
+    def _due_batch(self):
+        with self.condition:
+            while True:
+                # drop heap items left behind by rescheduled entries
+                while self.heap and (self.heap[0][1] not in self.entries or
+                    self.entries[self.heap[0][1]][0] != self.heap[0][0]):
+                    heapq.heappop(self.heap)
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    break
+                self.condition.wait(self.heap[0][0] - now if self.heap else None)
+            batch = []
+            while self.heap and self.heap[0][0] <= now and len(batch) < self.batch_size:
+                due_at, key = heapq.heappop(self.heap)
+                if key in self.entries and self.entries[key][0] == due_at:
+                    batch.append((key, self.entries[key][1]))
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._due_batch()
+            try:
+                failed = set(self.fire(batch) or ())
+            except Exception as e:
+                print(f'Unable to fire {len(batch)} scheduled entries: {e}')
+                failed = {key for key, _ in batch}
+            with self.condition:
+                done = [key for key, _ in batch if key not in failed]
+                retry_at = time.time() + self.retry_delay
+                retries = []
+                for key, payload in batch:
+                    if key in failed:
+                        self.entries[key] = (retry_at, payload)
+                        heapq.heappush(self.heap, (retry_at, key))
+                        retries.append({'add': key, 'due': retry_at, 'payload': payload})
+                    else:
+                        self.entries.pop(key, None)
+                self._write(*([{'done': done}] if done else []), *retries)
+                if self.records > len(self.entries) + self.compact_after:
+                    self._compact()
+
+### EOF
@@ -0,0 +1,151 @@
+# glacier_stream.py
+#
+# Streaming upload of results files to Glacier
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+
+
+"""Incremental SHA-256 tree hash, as Glacier computes it
+Data is hashed in 1 MB leaves; adjacent hashes are then hashed in pairs,
+level by level, until one is left. Complete subtrees are combined as
+soon as they exist, so only O(log n) digests are kept.
+"""
+class TreeHash(object):
+    def __init__(self):
+        self.pending = b''
+        self.stack = []  # (level, digest), levels strictly decreasing
+
+    def _push(self, digest, level=0):
+        while self.stack and self.stack[-1][0] == level:
+            _, left = self.stack.pop()
+            digest = hashlib.sha256(left + digest).digest()
+            level += 1
+        self.stack.append((level, digest))
+
+    def update(self, data):
+        data = self.pending + data
+        whole = len(data) - len(data) % MB
+        for start in range(0, whole, MB):
+            self._push(hashlib.sha256(data[start:start + MB]).digest())
+        self.pending = data[whole:]
+
+    """Add a subtree digest covering 2**level whole leaves
+    """
+    def update_digest(self, digest, level):
+        assert not self.pending
+        self._push(digest, level)
+
+    def digest(self):
+        stack = list(self.stack)
+        if self.pending or not stack:
+            stack.append((0, hashlib.sha256(self.pending).digest()))
+        digest = stack.pop()[1]
+        while stack:
+            digest = hashlib.sha256(stack.pop()[1] + digest).digest()
+        return digest
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+def tree_hash(data):
+    hasher = TreeHash()
+    hasher.update(data)
+    return hasher
+
+
+"""Upload a stream to Glacier in parts, several at a time
+Reads `part_size` bytes at a time from any object with read(n) (e.g. an
+S3 StreamingBody), so memory stays at about (workers + 1) parts whatever
+the archive size. Each part's tree hash feeds the archive's tree hash as
+it goes; the part is then uploaded by a worker thread. Streams that fit
+in one part go up with a single upload_archive call.
+"""
+class GlacierStreamUploader(object):
+    def __init__(self, glacier_client, vault_name, part_size=8 * MB, workers=4):
+        # Glacier parts are 1 MB times a power of two
+        if part_size < MB or part_size % MB or (part_size // MB) & (part_size // MB - 1):
+            raise ValueError(f'Invalid Glacier part size: {part_size}')
+        self.glacier = glacier_client
+        self.vault_name = vault_name
+        self.part_size = part_size
+        self.workers = workers
+
+    def _read_part(self, stream):
+        chunks, size = [], 0
+        while size < self.part_size:
+            chunk = stream.read(self.part_size - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return b''.join(chunks)
+
+    """Returns (archive ID, archive size in bytes, tree hash)
+    """
+    def upload(self, stream, description=''):
+        part = self._read_part(stream)
+        if len(part) < self.part_size:
+            checksum = tree_hash(part).hexdigest()
+            response = self.glacier.upload_archive(vaultName=self.vault_name,
+                archiveDescription=description, checksum=checksum, body=part)
+            return response['archiveId'], len(part), checksum
+
+        upload_id = self.glacier.initiate_multipart_upload(
+            vaultName=self.vault_name, archiveDescription=description,
+            partSize=str(self.part_size))['uploadId']
+        archive_hash = TreeHash()
+        in_flight = threading.BoundedSemaphore(self.workers + 1)
+        futures, offset = [], 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while part:
+                    part_hash = tree_hash(part)
+                    checksum = part_hash.hexdigest()
+                    if len(part) == self.part_size:
+                        # a full part is a complete subtree of the archive's tree
+                        archive_hash.update_digest(part_hash.digest(),
+                            (self.part_size // MB).bit_length() - 1)
+                    else:
+                        archive_hash.update(part)
+                    in_flight.acquire()
+                    futures.append(pool.submit(self._upload_part, upload_id,
+                        offset, part, checksum, in_flight))
+                    offset += len(part)
+                    # stop reading early if a part has already failed
+                    if any(f.done() and f.exception() for f in futures):
+                        break
+                    part = self._read_part(stream) if len(part) == self.part_size else b''
+            for future in futures:
+                future.result()
+            checksum = archive_hash.hexdigest()
+            response = self.glacier.complete_multipart_upload(
+                vaultName=self.vault_name, uploadId=upload_id,
+                archiveSize=str(offset), checksum=checksum)
+            return response['archiveId'], offset, checksum
+        except Exception:
+            try:
+                self.glacier.abort_multipart_upload(vaultName=self.vault_name,
+                    uploadId=upload_id)
+            except Exception as e:
+                print(f'Unable to abort Glacier multipart upload {upload_id}: {e}')
+            raise
+
+    def _upload_part(self, upload_id, offset, part, checksum, in_flight):
+        try:
+            self.glacier.upload_multipart_part(vaultName=self.vault_name,
+                uploadId=upload_id, checksum=checksum,
+                range=f'bytes {offset}-{offset + len(part) - 1}/*', body=part)
+        finally:
+            in_flight.release()
+
+### EOF
@@ -9,7 +9,6 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
 import boto3
 from botocore.exceptions import ClientError
 
@@ -18,6 +17,9 @@ from configparser import ConfigParser
 config = ConfigParser(os.environ)
 config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
 
+os.environ.setdefault('AWS_REGION_NAME', config['aws']['AwsRegionName'])
+from secret_store import get_provider, get_secret
+
 """Send email via Amazon SES
 """
 def send_email_ses(recipients=None, sender=None, subject=None, body=None):
@@ -40,40 +42,124 @@ def send_email_ses(recipients=None, sender=None, subject=None, body=None):
   return response
 
 
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 
-"""Access user profile in accounts database
+# Accounts database connections, one pool per database, shared by all
+# threads of the process: {db_name: (pool, slots)}
+_pools = {}
+_pools_lock = threading.Lock()
+
+# {(db_name, identity_id): (fetched_at, profile)}
+_profile_cache = {}
+_profile_cache_lock = threading.Lock()
+
+
+"""Pooled connection that remembers whether the profile query is prepared
 """
-def get_user_profile(id=None, db_name=None):
-  # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    raise e
+class ProfileConnection(psycopg2.extensions.connection):
+  prepared = False
 
-  db_uri = "postgresql://" + rds_secret['username'] + ':' + \
-    rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
-    str(rds_secret['port']) + '/' + \
-    (db_name or config['gas']['AccountsDatabase'])
 
-  try:
-    # Connect to accounts database and get a cursor
-    connection = psycopg2.connect(db_uri)
-    cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
-    
-    # Query the database and get the user's profile record
-    query_string = f"SELECT * FROM profiles WHERE identity_id = '{id}'"
-    cursor.execute(query_string)
-    profile = cursor.fetchall()[0]
-  
-  except psycopg2.Error as e:
-    connection.rollback()
-    raise e
+"""True if a connection was refused for bad credentials
+"""
+def _auth_failed(e):
+  # 28000/28P01: invalid authorization / password; libpq often gives
+  # no SQLSTATE for login failures, so the message is checked as well
+  return e.pgcode in ('28000', '28P01') or 'authentication failed' in str(e)
+
+
+"""Pool for a database and a semaphore of its size
+getconn() fails when every connection is in use; taking a slot first
+makes callers wait for a connection instead. If the login is refused
+(the password was rotated since the secret was cached), the secret is
+fetched again and the pool created once more.
+"""
+def _get_pool(db_name):
+  with _pools_lock:
+    pool = _pools.get(db_name)
+    if pool is None:
+      size = int(config['gas'].get('AccountsDatabasePoolSize', '10'))
+      for attempt in range(2):
+        # Get database connection details from AWS Secrets Manager (cached)
+        rds_secret = get_secret('rds/accounts_database')
+        try:
+          connections = psycopg2.pool.ThreadedConnectionPool(1, size,
+            host=rds_secret['host'], port=rds_secret['port'],
+            user=rds_secret['username'], password=rds_secret['password'],
+            dbname=db_name, connection_factory=ProfileConnection)
+          break
+        except psycopg2.OperationalError as e:
+          if not _auth_failed(e) or attempt == 1:
+            raise e
+          get_provider().invalidate('rds/accounts_database')
+      pool = (connections, threading.BoundedSemaphore(size))
+      _pools[db_name] = pool
+    return pool
+
+
+def _query_profile(connection, identity_id):
+  if not connection.prepared:
+    # reads only: no transaction left open between calls
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+      # identity_id is a uuid column (web/models.py)
+      cursor.execute("PREPARE gas_user_profile (uuid) AS "
+        "SELECT * FROM profiles WHERE identity_id = $1")
+    connection.prepared = True
+  with connection.cursor(cursor_factory = psycopg2.extras.DictCursor) as cursor:
+    cursor.execute("EXECUTE gas_user_profile (%s)", (identity_id,))
+    return cursor.fetchall()
+
+
+"""Access user profile in accounts database
+Connections come from a per-process pool and the query is a prepared
+statement. Profiles are cached for ProfileCacheTtl seconds (util
+config), so a burst of messages for one user costs a single query;
+use_cache=False always reads the database.
+"""
+def get_user_profile(id=None, db_name=None, use_cache=True):
+  db_name = db_name or config['gas']['AccountsDatabase']
+  ttl = float(config['gas'].get('ProfileCacheTtl', '60'))
+  with _profile_cache_lock:
+    cached = _profile_cache.get((db_name, id))
+  if use_cache and cached and time.time() - cached[0] < ttl:
+    return cached[1]
+
+  pool, slots = _get_pool(db_name)
+  with slots:
+    for attempt in range(2):
+      connection = pool.getconn()
+      try:
+        rows = _query_profile(connection, id)
+      except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        # connection dropped by the server: discard it and try a new one
+        pool.putconn(connection, close=True)
+        if attempt == 1:
+          raise e
+        continue
+      except psycopg2.Error as e:
+        pool.putconn(connection)
+        raise e
+      pool.putconn(connection)
+      break
 
   # Return user profile record as a dict
+  profile = rows[0]
+  with _profile_cache_lock:
+    _profile_cache[(db_name, id)] = (time.time(), profile)
   return profile
 
-### EOF
\ No newline at end of file
+
+"""Role of a user ('free_user' or 'premium_user')
+Always read from the database: a user who just upgraded must not have
+their results archived on a stale role.
+"""
+def get_user_role(id=None, db_name=None):
+  return get_user_profile(id=id, db_name=db_name, use_cache=False)['role']
+
+### EOF
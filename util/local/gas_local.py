@@ -0,0 +1,377 @@
+# gas_local.py
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the whole GAS pipeline on one machine against the local AWS
+# stand-ins (see local_aws.py), through the production code paths:
+#
+#   ann_load.py submits jobs  -> S3 input + PENDING item + SNS publish
+#   SNS job_requests topic    -> SQS job_requests queue, and a POST to
+#                                annotator_webhook /process-job-request
+#   annotator_webhook         -> claim (RUNNING), download, run.py main()
+#   run.py                    -> annotate, upload, COMPLETED, results ready
+#   SNS results_ready topic   -> archive_app /schedule (delay scheduler)
+#   SNS wait_ended topic      -> SQS wait_ended queue, and a POST to
+#                                archive_app /archive
+#
+# boto3.client()/resource() return the stand-ins for the whole run and
+# the SNS HTTP subscriptions are served through the apps' Flask test
+# clients. run.py's main() runs on a thread where the webhook would start
+# a subprocess, so it sees the stand-ins too. Only what has no local
+# stand-in is replaced: the accounts database (users are free users
+# unless --premium) and AnnTools, which is simulated by default (a fixed
+# cost per VCF record) since it needs the reference database; pass
+# --anntools to run the real driver when it is reachable.
+#
+# The annotator and archive modules are configured when first imported,
+# so run one pipeline per process.
+#
+# Usage:
+#   python gas_local.py --jobs 50 --rate 5 --annotators 4
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import argparse
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from configparser import ConfigParser
+
+from local_aws import LocalAWS
+
+# ann_load.py lives one level up, the annotator in ../../ann
+ANN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, os.path.pardir, 'ann')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir))
+sys.path.insert(1, ANN_DIR)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'archive'))
+
+# Get configuration
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'gas_local_config.ini'))
+
+
+"""Create the buckets, tables, topics and queues
+Returns a dict of the names/ARNs the services are configured with.
+"""
+def build_stack(aws, visibility):
+  names = {
+    'inputs_bucket': config['s3']['InputsBucket'],
+    'results_bucket': config['s3']['ResultsBucket'],
+    'annotations_table': config['dynamodb']['AnnotationsTable'],
+    'results_index_table': config['dynamodb']['ResultsIndexTable'],
+    'vault': config['glacier']['VaultName'],
+    'requests_queue': config['sqs']['JobRequestsQueue'],
+    'wait_ended_queue': config['sqs']['WaitEndedQueue'],
+  }
+  aws.s3.create_bucket(Bucket=names['inputs_bucket'])
+  aws.s3.create_bucket(Bucket=names['results_bucket'])
+  aws.dynamodb.create_table(names['annotations_table'], 'job_id',
+    indexes={'user_id_index': ('user_id', 'submit_time')})
+  aws.dynamodb.create_table(names['results_index_table'], 'content_key')
+
+  for topic, option in (('requests_topic', 'JobRequestsTopic'),
+    ('job_status_topic', 'JobStatusTopic'),
+    ('results_ready_topic', 'ResultsReadyTopic'),
+    ('wait_ended_topic', 'WaitEndedTopic')):
+    names[topic] = aws.sns.create_topic(Name=config['sns'][option])['TopicArn']
+
+  aws.sns.subscribe_queue(names['requests_topic'], aws.sqs.create_queue(
+    names['requests_queue'], visibility_timeout=visibility))
+  aws.sns.subscribe_queue(names['wait_ended_topic'], aws.sqs.create_queue(
+    names['wait_ended_queue'], visibility_timeout=visibility))
+  return names
+
+
+"""Deliver a topic's notifications to a Flask endpoint, as an SNS
+HTTP(S) subscription does
+"""
+def subscribe_endpoint(aws, topic_arn, app, path):
+  def deliver(envelope):
+    app.test_client().post(path, data=json.dumps(envelope),
+      headers={'x-amz-sns-message-type': envelope['Type']})
+  aws.sns.subscribe_callback(topic_arn, deliver)
+
+
+"""Stand-in for AnnTools: writes the same two result files
+Costs `secs_per_record` per VCF data line, like a very regular AnnTools.
+"""
+def simulated_annotation(inputfile_path, secs_per_record):
+  with open(inputfile_path, 'r') as fh:
+    lines = fh.readlines()
+  records = [l for l in lines if not l.startswith('#')]
+  time.sleep(secs_per_record * len(records))
+  annofile_path = inputfile_path[:-4] + '.annot.vcf'
+  with open(annofile_path, 'w') as out:
+    for line in lines:
+      if line.startswith('#'):
+        out.write(line)
+      else:
+        out.write(line.rstrip('\n') + ';ANN=simulated\n')
+  with open(inputfile_path + '.count.log', 'w') as log:
+    log.write(f'Total number of records: {len(records)}\n')
+
+
+"""Module standing in for ann/driver.py (imported by run.py)
+"""
+def simulated_driver(secs_per_record):
+  driver = types.ModuleType('driver')
+  def run(infile, format, timings=None, checkpoint=None):
+    start = time.time()
+    simulated_annotation(infile, secs_per_record)
+    if timings is not None:
+      timings['simulated'] = time.time() - start
+  driver.run = run
+  return driver
+
+
+"""Module standing in for util/helpers.py's accounts database lookups
+(imported by archive_app.py)
+"""
+def local_accounts(premium_users):
+  helpers = types.ModuleType('helpers')
+  def get_user_profile(id=None, db_name=None, use_cache=True):
+    role = 'premium_user' if id in premium_users else 'free_user'
+    return {'identity_id': id, 'name': id, 'email': None, 'role': role}
+  def get_user_role(id=None, db_name=None):
+    return get_user_profile(id=id, db_name=db_name)['role']
+  helpers.get_user_profile = get_user_profile
+  helpers.get_user_role = get_user_role
+  return helpers
+
+
+"""Runs run.py's main() on a thread where annotator_webhook starts its
+subprocess; installed as that module's `subprocess`
+"""
+class InProcessRuns(object):
+  SubprocessError = subprocess.SubprocessError
+
+  def __init__(self, run_module):
+    self.run_module = run_module
+
+  def Popen(self, command, **kwargs):
+    # python <run.py> <user_id/job_id/file_name> [s3://<bucket>/<key>]
+    return InProcessRun(self.run_module, shlex.split(command)[2:])
+
+
+class InProcessRun(object):
+  # no process of its own, so admission control sees no memory use
+  pid = None
+
+  def __init__(self, run_module, args):
+    self.returncode = None
+    self.thread = threading.Thread(target=self._main,
+      args=(run_module, args), daemon=True)
+    self.thread.start()
+
+  def _main(self, run_module, args):
+    try:
+      self.returncode = 0 if run_module.main(*args) else 1
+    except Exception as e:
+      print(f'run.py failed on {args[0]}: {e}')
+      self.returncode = 1
+
+  def poll(self):
+    return self.returncode
+
+
+"""Import annotator_webhook and run.py configured for the local stack
+The webhook settings are set on ann_config.Config before the import;
+run.py gets the same values in a copy of ann_config.ini.
+"""
+def load_annotator(root, names, annotators, visibility, secs_per_record,
+  use_anntools):
+  ann_dir = os.path.join(root, 'ann') + '/'
+  os.makedirs(os.path.join(ann_dir, 'jobs'), exist_ok=True)
+  settings = {
+    'ANNOTATOR_BASE_DIR': ann_dir,
+    'ANNOTATOR_JOBS_DIR': os.path.join(ann_dir, 'jobs'),
+    'ANNOTATOR_RUN_SCRIPT_PATH': os.path.join(ANN_DIR, 'run.py'),
+    'ANNOTATOR_METRICS_EVENT_LOG': os.path.join(ann_dir, 'metrics_events.log'),
+    'ANNOTATOR_CHECKPOINT_TO_S3': 'false',
+    'ANNOTATOR_STREAMING_MIN_MB': 0,
+    'ANNOTATOR_MAX_JOBS': annotators,
+    'ANNOTATOR_ADMISSION_RETRY_DELAY': 1,
+    'ANNOTATOR_DISPATCH_IDLE_POLL': 1,
+    'ANNOTATOR_VISIBILITY_TIMEOUT': visibility,
+    'ANNOTATOR_VISIBILITY_HEARTBEAT': 1,
+    'AWS_SQS_WAIT_TIME': 1,
+    'AWS_SQS_NAME': names['requests_queue'],
+    'AWS_S3_INPUTS_BUCKET': names['inputs_bucket'],
+    'AWS_S3_RESULTS_BUCKET': names['results_bucket'],
+    'AWS_SNS_JOB_STATUS_TOPIC': names['job_status_topic'],
+    'AWS_SNS_RESULTS_READY_TOPIC': names['results_ready_topic'],
+    'AWS_DYNAMODB_ANNOTATIONS_TABLE': names['annotations_table'],
+    'AWS_DYNAMODB_RESULTS_INDEX_TABLE': names['results_index_table'],
+  }
+  import ann_config
+  for key, value in settings.items():
+    setattr(ann_config.Config, key, value)
+
+  ini = ConfigParser()
+  ini.read(os.path.join(ANN_DIR, 'ann_config.ini'))
+  for section in ini.sections():
+    for key in ini[section]:
+      if key.upper() in settings:
+        ini[section][key] = str(settings[key.upper()])
+  config_file = os.path.join(ann_dir, 'ann_config.ini')
+  with open(config_file, 'w') as fh:
+    ini.write(fh)
+  os.environ['ANNOTATOR_CONFIG_FILE'] = config_file
+
+  if not use_anntools:
+    sys.modules['driver'] = simulated_driver(secs_per_record)
+  import run
+  import annotator_webhook
+  annotator_webhook.subprocess = InProcessRuns(run)
+  return annotator_webhook
+
+
+"""Import archive_app configured for the local stack
+"""
+def load_archive(root, names, wait_seconds, bundle_window, premium_users):
+  settings = {
+    'AWS_SQS_WAIT_ENDED_QUEUE_NAME': names['wait_ended_queue'],
+    'AWS_SQS_WAIT_TIME': 1,
+    'AWS_SNS_WAIT_ENDED_TOPIC': names['wait_ended_topic'],
+    'FREE_USER_DATA_RETENTION': wait_seconds,
+    'ARCHIVE_SCHEDULE_FILE': os.path.join(root, config['scheduler']['JournalFile']),
+    'AWS_DYNAMODB_ANNOTATIONS_TABLE': names['annotations_table'],
+    'AWS_GLACIER_VAULT_NAME': names['vault'],
+    'AWS_GLACIER_BUNDLE_WINDOW': bundle_window,
+    'ARCHIVE_SPOOL_DIR': os.path.join(root, 'spool'),
+  }
+  import archive_app_config
+  for key, value in settings.items():
+    setattr(archive_app_config.Config, key, value)
+  sys.modules['helpers'] = local_accounts(premium_users)
+  import archive_app
+  return archive_app
+
+
+"""Per-hop timings from the trace spans the services recorded on the
+job items: {hop: (count, mean, max)}
+"""
+def hop_summary(items):
+  samples = {}
+  for item in items:
+    for span in item.get('trace_spans', []):
+      samples.setdefault(span['hop'], []).append(float(span['secs']))
+  return {hop: (len(s), sum(s) / len(s), max(s)) for hop, s in samples.items()}
+
+
+def count_archived(table):
+  return sum(1 for item in table.scan()['Items']
+    if 'results_file_archive_id' in item)
+
+
+"""Run a load test through the local pipeline and report on it
+"""
+def run_pipeline(root, jobs=20, rate=2.0, arrival='constant', size_mix=None,
+  annotators=2, secs_per_record=0.0005, wait_seconds=2.0, bundle_window=0,
+  use_anntools=False, premium=False, timeout=600, seed=None):
+  import ann_load
+
+  aws = LocalAWS(root)
+  visibility = int(config['sqs']['VisibilityTimeout'])
+  names = build_stack(aws, visibility)
+  user_id = config['gas']['UserId']
+  table = aws.dynamodb.Table(names['annotations_table'])
+
+  with aws.installed():
+    webhook = load_annotator(root, names, annotators, visibility,
+      secs_per_record, use_anntools)
+    archive = load_archive(root, names, wait_seconds, bundle_window,
+      {user_id} if premium else set())
+    subscribe_endpoint(aws, names['requests_topic'], webhook.app,
+      '/process-job-request')
+    subscribe_endpoint(aws, names['results_ready_topic'], archive.app,
+      '/schedule')
+    subscribe_endpoint(aws, names['wait_ended_topic'], archive.app,
+      '/archive')
+
+    targets = ann_load.Targets(aws.s3, table, sns=aws.sns,
+      topic_arn=names['requests_topic'])
+    summary = ann_load.run_load(targets, jobs=jobs, rate=rate,
+      arrival=arrival, size_mix=size_mix or ann_load.DEFAULT_SIZE_MIX,
+      timeout=timeout, poll_interval=0.2, user_id=user_id,
+      rng=random.Random(seed), key_prefix=config['s3']['KeyPrefix'],
+      bucket=names['inputs_bucket'])
+
+    # give the archive scheduler and archive app time to catch up
+    expected = 0 if premium else summary['completed']
+    deadline = time.time() + wait_seconds + bundle_window + 30
+    while time.time() < deadline and count_archived(table) < expected:
+      time.sleep(0.2)
+
+  items = table.scan()['Items']
+  summary.update({
+    'annotator_errors': sum(webhook.gas_metrics['errors'].values.values()),
+    'archived': sum(1 for i in items if 'results_file_archive_id' in i),
+    'kept': sum(1 for i in items if i.get('job_status') == 'COMPLETED'
+      and 'results_file_archive_id' not in i),
+    'hops': hop_summary(items),
+  })
+  return summary
+
+
+def report(summary):
+  import ann_load
+  ann_load.report(summary)
+  print(f"Annotator errors: {summary['annotator_errors']}")
+  print(f"Archived:        {summary['archived']} "
+    f"({summary['kept']} results kept in S3)")
+  print('Per-hop timings (count / mean / max):')
+  for hop, (count, mean, worst) in sorted(summary['hops'].items()):
+    print(f'  {hop:<20} {count:>6} / {mean:.3f}s / {worst:.3f}s')
+
+
+def parse_args(argv=None):
+  import ann_load
+  parser = argparse.ArgumentParser(
+    description='Run the GAS pipeline against local AWS stand-ins')
+  parser.add_argument('--jobs', type=int, default=20)
+  parser.add_argument('--rate', type=ann_load.positive_float, default=2.0,
+    help='average arrival rate (jobs/s)')
+  parser.add_argument('--arrival', choices=['constant', 'poisson', 'burst'],
+    default='constant')
+  parser.add_argument('--sizes', default=None,
+    help='records:weight pairs for synthetic VCF sizes')
+  parser.add_argument('--annotators', type=int, default=2,
+    help='annotation jobs run at once (ANNOTATOR_MAX_JOBS)')
+  parser.add_argument('--secs-per-record', type=float, default=0.0005,
+    help='simulated annotation cost per VCF record')
+  parser.add_argument('--wait-seconds', type=float, default=2.0,
+    help='scheduler delay before archival (300s in production)')
+  parser.add_argument('--bundle-window', type=int, default=0,
+    help='archive bundling window (0 archives each result file alone)')
+  parser.add_argument('--anntools', action='store_true',
+    help='run the real AnnTools driver instead of the simulation')
+  parser.add_argument('--premium', action='store_true',
+    help='submit as a premium user (results are not archived)')
+  parser.add_argument('--timeout', type=float, default=600)
+  parser.add_argument('--root', default=None,
+    help='directory for local S3/Glacier data (default: a temp dir)')
+  parser.add_argument('--seed', type=int, default=None)
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = parse_args()
+  root = args.root or tempfile.mkdtemp(prefix='gas-local-')
+  print(f'Local AWS data in {root}')
+  summary = run_pipeline(root, jobs=args.jobs, rate=args.rate,
+    arrival=args.arrival, size_mix=args.sizes, annotators=args.annotators,
+    secs_per_record=args.secs_per_record, wait_seconds=args.wait_seconds,
+    bundle_window=args.bundle_window, use_anntools=args.anntools,
+    premium=args.premium, timeout=args.timeout, seed=args.seed)
+  report(summary)
+
+### EOF
@@ -0,0 +1,1145 @@
+# local_aws.py
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+#
+# In-process stand-ins for the AWS services used by the GAS
+#
+# Implements the subset of the boto3 client/resource interfaces that the
+# GAS code paths use: SQS queues with visibility timeouts, SNS fan-out to
+# queues and callbacks, a filesystem-backed S3, an in-memory DynamoDB
+# (tables, global secondary indexes, the expression forms used in this
+# repo), a timer-based Step Functions substitute and a minimal Glacier.
+#
+# Usage:
+#   aws = LocalAWS('/tmp/gas-local')
+#   with aws.installed():      # boto3.client()/resource() return stand-ins
+#     ...
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import collections
+import copy
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+try:
+  from botocore.exceptions import ClientError
+except ImportError:
+  # botocore not installed; raise an exception with the same shape
+  class ClientError(Exception):
+    def __init__(self, error_response, operation_name):
+      self.response = error_response
+      self.operation_name = operation_name
+      super().__init__(f"An error occurred "
+        f"({error_response['Error']['Code']}) when calling the "
+        f"{operation_name} operation: {error_response['Error'].get('Message', '')}")
+
+
+def client_error(code, operation, message=''):
+  return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+"""Namespace mimicking client.exceptions.<Name> on boto3 clients
+"""
+class _Exceptions(object):
+  def __getattr__(self, name):
+    return ClientError
+
+
+###############################################################################
+# S3
+###############################################################################
+
+"""Readable body returned by get_object (like botocore's StreamingBody)
+"""
+class StreamingBody(object):
+  def __init__(self, fh, length):
+    self._fh = fh
+    self._remaining = length
+
+  def read(self, amt=None):
+    if self._remaining <= 0:
+      return b''
+    if amt is None or amt > self._remaining:
+      amt = self._remaining
+    data = self._fh.read(amt)
+    self._remaining -= len(data)
+    if not data or self._remaining <= 0:
+      self.close()
+    return data
+
+  def iter_chunks(self, chunk_size=1024 * 1024):
+    while True:
+      chunk = self.read(chunk_size)
+      if not chunk:
+        return
+      yield chunk
+
+  def iter_lines(self, chunk_size=1024 * 1024, keepends=False):
+    pending = b''
+    for chunk in self.iter_chunks(chunk_size):
+      lines = (pending + chunk).splitlines(True)
+      pending = b''
+      for line in lines:
+        if line.endswith(b'\n'):
+          yield line if keepends else line.rstrip(b'\r\n')
+        else:
+          pending = line
+    if pending:
+      yield pending
+
+  def close(self):
+    if not self._fh.closed:
+      self._fh.close()
+
+
+"""Filesystem-backed S3: <root>/<bucket>/<key>
+"""
+class LocalS3(object):
+  def __init__(self, root):
+    self.root = root
+    self.lock = threading.Lock()
+    self.multipart = {}
+    self.exceptions = _Exceptions()
+
+  def create_bucket(self, Bucket, **kwargs):
+    os.makedirs(os.path.join(self.root, Bucket), exist_ok=True)
+    return {}
+
+  def _path(self, bucket, key, operation):
+    bucket_path = os.path.join(self.root, bucket)
+    if not os.path.isdir(bucket_path):
+      raise client_error('NoSuchBucket', operation, bucket)
+    return os.path.join(bucket_path, key)
+
+  def _existing(self, bucket, key, operation, missing='NoSuchKey'):
+    path = self._path(bucket, key, operation)
+    if not os.path.isfile(path):
+      raise client_error(missing, operation, key)
+    return path
+
+  def _write(self, path, data_or_fh):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'wb') as out:
+      if isinstance(data_or_fh, (bytes, bytearray)):
+        out.write(data_or_fh)
+      elif isinstance(data_or_fh, str):
+        out.write(data_or_fh.encode())
+      else:
+        shutil.copyfileobj(data_or_fh, out, 1024 * 1024)
+    os.replace(tmp, path)
+    return self._etag(path)
+
+  def _etag(self, path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as fh:
+      for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return '"' + digest.hexdigest() + '"'
+
+  def put_object(self, Bucket, Key, Body=b'', **kwargs):
+    return {'ETag': self._write(self._path(Bucket, Key, 'PutObject'), Body)}
+
+  def get_object(self, Bucket, Key, Range=None, **kwargs):
+    path = self._existing(Bucket, Key, 'GetObject')
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    if Range:
+      match = re.match(r'bytes=(\d*)-(\d*)$', Range)
+      if not match:
+        raise client_error('InvalidRange', 'GetObject', Range)
+      if match.group(1) == '':
+        start = max(0, size - int(match.group(2)))
+      else:
+        start = int(match.group(1))
+        if match.group(2) != '':
+          end = min(int(match.group(2)), size - 1)
+      if start >= size and size > 0:
+        raise client_error('InvalidRange', 'GetObject', Range)
+    length = max(0, end - start + 1)
+    fh = open(path, 'rb')
+    fh.seek(start)
+    response = {'Body': StreamingBody(fh, length), 'ContentLength': length,
+      'ETag': self._etag(path)}
+    if Range:
+      response['ContentRange'] = f'bytes {start}-{end}/{size}'
+    return response
+
+  def head_object(self, Bucket, Key, **kwargs):
+    path = self._existing(Bucket, Key, 'HeadObject', missing='404')
+    return {'ContentLength': os.path.getsize(path), 'ETag': self._etag(path)}
+
+  def delete_object(self, Bucket, Key, **kwargs):
+    path = self._path(Bucket, Key, 'DeleteObject')
+    if os.path.isfile(path):
+      os.remove(path)
+    return {}
+
+  def copy_object(self, CopySource, Bucket, Key, **kwargs):
+    source = self._existing(CopySource['Bucket'], CopySource['Key'],
+      'CopyObject')
+    with open(source, 'rb') as fh:
+      etag = self._write(self._path(Bucket, Key, 'CopyObject'), fh)
+    return {'CopyObjectResult': {'ETag': etag}}
+
+  def copy(self, CopySource, Bucket, Key, **kwargs):
+    self.copy_object(CopySource, Bucket, Key)
+
+  def upload_file(self, Filename, Bucket, Key, **kwargs):
+    with open(Filename, 'rb') as fh:
+      self._write(self._path(Bucket, Key, 'PutObject'), fh)
+
+  def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+    self._write(self._path(Bucket, Key, 'PutObject'), Fileobj)
+
+  def download_file(self, Bucket, Key, Filename, **kwargs):
+    source = self._existing(Bucket, Key, 'HeadObject', missing='404')
+    shutil.copyfile(source, Filename)
+
+  def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+    with open(self._existing(Bucket, Key, 'GetObject'), 'rb') as fh:
+      shutil.copyfileobj(fh, Fileobj, 1024 * 1024)
+
+  def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+    bucket_path = self._path(Bucket, '', 'ListObjectsV2')
+    contents = []
+    for dirpath, _, filenames in os.walk(bucket_path):
+      for name in filenames:
+        key = os.path.relpath(os.path.join(dirpath, name), bucket_path)
+        if key.startswith(Prefix) and not key.endswith('.tmp'):
+          contents.append({'Key': key,
+            'Size': os.path.getsize(os.path.join(dirpath, name))})
+    return {'Contents': sorted(contents, key=lambda c: c['Key']),
+      'KeyCount': len(contents)}
+
+  def create_multipart_upload(self, Bucket, Key, **kwargs):
+    self._path(Bucket, Key, 'CreateMultipartUpload')
+    upload_id = uuid.uuid4().hex
+    with self.lock:
+      self.multipart[upload_id] = {'Bucket': Bucket, 'Key': Key, 'parts': {}}
+    return {'UploadId': upload_id, 'Bucket': Bucket, 'Key': Key}
+
+  def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+    with self.lock:
+      upload = self.multipart.get(UploadId)
+    if upload is None:
+      raise client_error('NoSuchUpload', 'UploadPart', UploadId)
+    data = Body if isinstance(Body, (bytes, bytearray)) else Body.read()
+    etag = '"' + hashlib.md5(data).hexdigest() + '"'
+    with self.lock:
+      upload['parts'][PartNumber] = (etag, bytes(data))
+    return {'ETag': etag}
+
+  def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload,
+    **kwargs):
+    with self.lock:
+      upload = self.multipart.pop(UploadId, None)
+    if upload is None:
+      raise client_error('NoSuchUpload', 'CompleteMultipartUpload', UploadId)
+    buffer = io.BytesIO()
+    for part in sorted(MultipartUpload['Parts'], key=lambda p: p['PartNumber']):
+      etag, data = upload['parts'][part['PartNumber']]
+      buffer.write(data)
+    buffer.seek(0)
+    return {'ETag': self._write(self._path(Bucket, Key,
+      'CompleteMultipartUpload'), buffer)}
+
+  def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+    with self.lock:
+      self.multipart.pop(UploadId, None)
+    return {}
+
+  def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600,
+    **kwargs):
+    return f"file://{os.path.join(self.root, Params['Bucket'], Params['Key'])}"
+
+  def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None,
+    ExpiresIn=3600, **kwargs):
+    return {'url': f'file://{os.path.join(self.root, Bucket)}',
+      'fields': dict(Fields or {}, key=Key)}
+
+
+"""boto3.resource('s3') stand-in
+"""
+class LocalS3Resource(object):
+  def __init__(self, client):
+    self.meta = type('Meta', (object,), {'client': client})()
+
+  def Object(self, bucket_name, key):
+    return LocalS3Object(self.meta.client, bucket_name, key)
+
+
+class LocalS3Object(object):
+  def __init__(self, client, bucket_name, key):
+    self.client = client
+    self.bucket_name = bucket_name
+    self.key = key
+
+  def get(self, **kwargs):
+    return self.client.get_object(Bucket=self.bucket_name, Key=self.key,
+      **kwargs)
+
+  def delete(self):
+    return self.client.delete_object(Bucket=self.bucket_name, Key=self.key)
+
+  @property
+  def content_length(self):
+    return self.client.head_object(Bucket=self.bucket_name,
+      Key=self.key)['ContentLength']
+
+
+###############################################################################
+# SQS
+###############################################################################
+
+class LocalMessage(object):
+  def __init__(self, queue, message_id, body):
+    self.queue = queue
+    self.message_id = message_id
+    self.body = body
+    self.receipt_handle = None
+    self.receive_count = 0
+
+  def delete(self):
+    self.queue._delete(self.message_id)
+    return {}
+
+  def change_visibility(self, VisibilityTimeout):
+    self.queue._set_visible_at(self.message_id, time.time() + VisibilityTimeout)
+    return {}
+
+
+"""SQS queue with visibility timeouts and long polling
+"""
+class LocalQueue(object):
+  def __init__(self, name, visibility_timeout=30):
+    self.name = name
+    self.url = f'local://sqs/{name}'
+    self.attributes = {'QueueArn': f'arn:aws:sqs:local:000000000000:{name}'}
+    self.visibility_timeout = visibility_timeout
+    self.messages = collections.OrderedDict()
+    self.visible_at = {}
+    self.condition = threading.Condition()
+
+  def send_message(self, MessageBody, **kwargs):
+    message_id = str(uuid.uuid4())
+    with self.condition:
+      self.messages[message_id] = LocalMessage(self, message_id, MessageBody)
+      self.visible_at[message_id] = time.time() + kwargs.get('DelaySeconds', 0)
+      self.condition.notify_all()
+    return {'MessageId': message_id}
+
+  def send_messages(self, Entries):
+    successful = []
+    for entry in Entries:
+      response = self.send_message(entry['MessageBody'])
+      successful.append({'Id': entry['Id'], 'MessageId': response['MessageId']})
+    return {'Successful': successful, 'Failed': []}
+
+  def _take(self, max_messages):
+    now = time.time()
+    taken = []
+    for message_id, message in self.messages.items():
+      if len(taken) >= max_messages:
+        break
+      if self.visible_at[message_id] <= now:
+        self.visible_at[message_id] = now + self.visibility_timeout
+        message.receive_count += 1
+        message.receipt_handle = f'{message_id}:{message.receive_count}'
+        taken.append(message)
+    return taken
+
+  def receive_messages(self, WaitTimeSeconds=0, MaxNumberOfMessages=1,
+    **kwargs):
+    deadline = time.time() + WaitTimeSeconds
+    with self.condition:
+      while True:
+        taken = self._take(MaxNumberOfMessages)
+        remaining = deadline - time.time()
+        if taken or remaining <= 0:
+          return taken
+        # wake up for new messages or when the next one becomes visible
+        pending = [t for t in self.visible_at.values() if t > time.time()]
+        if pending:
+          remaining = min(remaining, max(0.01, min(pending) - time.time()))
+        self.condition.wait(remaining)
+
+  def _delete(self, message_id):
+    with self.condition:
+      self.messages.pop(message_id, None)
+      self.visible_at.pop(message_id, None)
+
+  def _set_visible_at(self, message_id, when):
+    with self.condition:
+      if message_id in self.visible_at:
+        self.visible_at[message_id] = when
+        self.condition.notify_all()
+
+  def delete_messages(self, Entries):
+    successful = []
+    for entry in Entries:
+      self._delete(entry['ReceiptHandle'].split(':')[0])
+      successful.append({'Id': entry['Id']})
+    return {'Successful': successful, 'Failed': []}
+
+  def approximate_size(self):
+    with self.condition:
+      return len(self.messages)
+
+
+class LocalSQS(object):
+  def __init__(self):
+    self.queues = {}
+    self.lock = threading.Lock()
+    self.exceptions = _Exceptions()
+
+  def create_queue(self, QueueName, visibility_timeout=30, **kwargs):
+    with self.lock:
+      if QueueName not in self.queues:
+        self.queues[QueueName] = LocalQueue(QueueName, visibility_timeout)
+      return self.queues[QueueName]
+
+  def get_queue_by_name(self, QueueName):
+    with self.lock:
+      if QueueName not in self.queues:
+        raise client_error('AWS.SimpleQueueService.NonExistentQueue',
+          'GetQueueUrl', QueueName)
+      return self.queues[QueueName]
+
+  def _by_url(self, QueueUrl):
+    return self.get_queue_by_name(QueueUrl.rsplit('/', 1)[-1])
+
+  # client-style calls
+  def get_queue_url(self, QueueName):
+    return {'QueueUrl': self.get_queue_by_name(QueueName).url}
+
+  def send_message(self, QueueUrl, MessageBody, **kwargs):
+    return self._by_url(QueueUrl).send_message(MessageBody, **kwargs)
+
+  def receive_message(self, QueueUrl, WaitTimeSeconds=0,
+    MaxNumberOfMessages=1, **kwargs):
+    messages = self._by_url(QueueUrl).receive_messages(
+      WaitTimeSeconds=WaitTimeSeconds, MaxNumberOfMessages=MaxNumberOfMessages)
+    return {'Messages': [{'MessageId': m.message_id, 'Body': m.body,
+      'ReceiptHandle': m.receipt_handle} for m in messages]}
+
+  def delete_message(self, QueueUrl, ReceiptHandle):
+    self._by_url(QueueUrl)._delete(ReceiptHandle.split(':')[0])
+    return {}
+
+  def delete_message_batch(self, QueueUrl, Entries):
+    return self._by_url(QueueUrl).delete_messages(Entries=Entries)
+
+
+###############################################################################
+# SNS
+###############################################################################
+
+"""SNS topics fanning out to local queues and Python callbacks
+Queue subscribers get the standard notification envelope (the payload is
+in "Message"); callbacks receive the envelope dict, like an HTTP endpoint.
+"""
+class LocalSNS(object):
+  def __init__(self):
+    self.subscriptions = collections.defaultdict(list)
+    self.lock = threading.Lock()
+    self.exceptions = _Exceptions()
+
+  def create_topic(self, Name, **kwargs):
+    arn = f'arn:aws:sns:local:000000000000:{Name}'
+    with self.lock:
+      self.subscriptions.setdefault(arn, [])
+    return {'TopicArn': arn}
+
+  def subscribe_queue(self, topic_arn, queue):
+    with self.lock:
+      self.subscriptions[topic_arn].append(('queue', queue))
+
+  def subscribe_callback(self, topic_arn, callback):
+    with self.lock:
+      self.subscriptions[topic_arn].append(('callback', callback))
+
+  def publish(self, TopicArn, Message, **kwargs):
+    message_id = str(uuid.uuid4())
+    envelope = {'Type': 'Notification', 'MessageId': message_id,
+      'TopicArn': TopicArn, 'Message': Message,
+      'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    with self.lock:
+      if TopicArn not in self.subscriptions:
+        raise client_error('NotFound', 'Publish', TopicArn)
+      subscribers = list(self.subscriptions[TopicArn])
+    for kind, target in subscribers:
+      if kind == 'queue':
+        target.send_message(MessageBody=json.dumps(envelope))
+      else:
+        threading.Thread(target=target, args=(envelope,), daemon=True).start()
+    return {'MessageId': message_id}
+
+  def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+    successful = []
+    for entry in PublishBatchRequestEntries:
+      response = self.publish(TopicArn, entry['Message'])
+      successful.append({'Id': entry['Id'], 'MessageId': response['MessageId']})
+    return {'Successful': successful, 'Failed': []}
+
+
+###############################################################################
+# DynamoDB
+###############################################################################
+
+def _to_decimal(value):
+  if isinstance(value, float):
+    return Decimal(str(value))
+  return value
+
+"""Serialize a Python value into DynamoDB's typed (low-level) format
+"""
+def serialize(value):
+  if value is None:
+    return {'NULL': True}
+  if isinstance(value, bool):
+    return {'BOOL': value}
+  if isinstance(value, (int, float, Decimal)):
+    return {'N': str(_to_decimal(value))}
+  if isinstance(value, str):
+    return {'S': value}
+  if isinstance(value, (bytes, bytearray)):
+    return {'B': bytes(value)}
+  if isinstance(value, dict):
+    return {'M': {k: serialize(v) for k, v in value.items()}}
+  if isinstance(value, (list, tuple)):
+    return {'L': [serialize(v) for v in value]}
+  if isinstance(value, set):
+    if all(isinstance(v, str) for v in value):
+      return {'SS': sorted(value)}
+    return {'NS': sorted(str(v) for v in value)}
+  raise TypeError(f'Unsupported DynamoDB type: {type(value)}')
+
+"""Deserialize a typed DynamoDB value into a Python value
+"""
+def deserialize(typed):
+  (kind, value), = typed.items()
+  if kind == 'NULL':
+    return None
+  if kind == 'N':
+    return Decimal(value)
+  if kind == 'M':
+    return {k: deserialize(v) for k, v in value.items()}
+  if kind == 'L':
+    return [deserialize(v) for v in value]
+  if kind == 'NS':
+    return set(Decimal(v) for v in value)
+  if kind == 'SS':
+    return set(value)
+  return value
+
+
+def _resolve(name, names):
+  return (names or {}).get(name, name)
+
+def _operand(token, values):
+  token = token.strip()
+  if token.startswith(':'):
+    return values[token]
+  return token
+
+
+"""Split on a keyword (AND, OR) outside parentheses
+"""
+def _split_keyword(text, keyword):
+  pattern = re.compile(r'\s+' + keyword + r'\s+', re.I)
+  parts, depth, start, i = [], 0, 0, 0
+  while i < len(text):
+    char = text[i]
+    depth += {'(': 1, ')': -1}.get(char, 0)
+    if depth == 0 and char.isspace():
+      match = pattern.match(text, i)
+      if match:
+        parts.append(text[start:i])
+        start = i = match.end()
+        continue
+    i += 1
+  parts.append(text[start:])
+  return [p.strip() for p in parts]
+
+"""True if text is one parenthesized group: "(...)"
+"""
+def _enclosed(text):
+  if not text.startswith('('):
+    return False
+  depth = 0
+  for i, char in enumerate(text):
+    depth += {'(': 1, ')': -1}.get(char, 0)
+    if depth == 0:
+      return i == len(text) - 1
+  return False
+
+
+"""Evaluate the condition forms used in this repo
+Supports: a = :v, a <> :v, <, <=, >, >=, begins_with(a, :v),
+attribute_exists(a), attribute_not_exists(a), joined with AND and OR
+(AND binds tighter) and grouped with parentheses.
+"""
+def evaluate_condition(expression, item, values, names=None):
+  clause = expression.strip()
+  while _enclosed(clause):
+    clause = clause[1:-1].strip()
+  for keyword, combine in (('OR', any), ('AND', all)):
+    parts = _split_keyword(clause, keyword)
+    if len(parts) > 1:
+      return combine(evaluate_condition(part, item, values, names)
+        for part in parts)
+
+  match = re.match(r'begins_with\(\s*([#\w.]+)\s*,\s*(:\w+)\s*\)$', clause)
+  if match:
+    current = item.get(_resolve(match.group(1), names))
+    return isinstance(current, str) and \
+      current.startswith(values[match.group(2)])
+  match = re.match(r'attribute_(not_)?exists\(\s*([#\w.]+)\s*\)$', clause)
+  if match:
+    exists = _resolve(match.group(2), names) in item
+    return exists != bool(match.group(1))
+  match = re.match(r'([#\w.]+)\s*(=|<>|<=|>=|<|>)\s*(:\w+)$', clause)
+  if match:
+    current = item.get(_resolve(match.group(1), names))
+    expected = values[match.group(3)]
+    op = match.group(2)
+    if current is None:
+      return op == '<>'
+    return {'=': current == expected, '<>': current != expected,
+      '<': current < expected, '<=': current <= expected,
+      '>': current > expected, '>=': current >= expected}[op]
+  raise ValueError(f'Unsupported condition: {clause}')
+
+
+"""Split on commas that are not inside function-call parentheses
+"""
+def _split_top_level(text):
+  parts, depth, current = [], 0, ''
+  for char in text:
+    if char == ',' and depth == 0:
+      parts.append(current)
+      current = ''
+      continue
+    depth += {'(': 1, ')': -1}.get(char, 0)
+    current += char
+  parts.append(current)
+  return [p.strip() for p in parts if p.strip()]
+
+
+"""Apply a SET/REMOVE/ADD update expression to an item in place
+"""
+def apply_update(item, expression, values, names=None):
+  sections = re.split(r'\b(SET|REMOVE|ADD)\b', expression.strip())
+  action = None
+  for part in sections:
+    part = part.strip()
+    if part in ('SET', 'REMOVE', 'ADD'):
+      action = part
+      continue
+    if not part:
+      continue
+    for assignment in _split_top_level(part):
+      if action == 'SET':
+        name, _, value = assignment.partition('=')
+        name = _resolve(name.strip(), names)
+        value = value.strip()
+        match = re.match(r'if_not_exists\(\s*([#\w]+)\s*,\s*(:\w+)\s*\)$',
+          value)
+        if match:
+          if name not in item:
+            item[name] = copy.deepcopy(values[match.group(2)])
+          continue
+        match = re.match(r'list_append\(\s*(?:if_not_exists\(\s*)?([#\w]+)'
+          r'\s*(?:,\s*(:\w+)\s*\))?\s*,\s*(:\w+)\s*\)$', value)
+        if match:
+          default = values[match.group(2)] if match.group(2) else []
+          item[name] = list(item.get(_resolve(match.group(1), names),
+            default)) + copy.deepcopy(list(values[match.group(3)]))
+          continue
+        match = re.match(r'([#\w]+)\s*([+-])\s*(:\w+)$', value)
+        if match:
+          base = item.get(_resolve(match.group(1), names), 0)
+          delta = values[match.group(3)]
+          item[name] = base + delta if match.group(2) == '+' else base - delta
+          continue
+        item[name] = copy.deepcopy(_operand(value, values))
+      elif action == 'REMOVE':
+        item.pop(_resolve(assignment, names), None)
+      elif action == 'ADD':
+        name, value = assignment.split(None, 1)
+        name = _resolve(name, names)
+        item[name] = item.get(name, 0) + values[value.strip()]
+
+
+"""In-memory DynamoDB table with optional global secondary indexes
+indexes maps index name to (hash_key, range_key or None).
+"""
+class LocalTable(object):
+  def __init__(self, name, hash_key, range_key=None, indexes=None):
+    self.name = name
+    self.table_name = name
+    self.hash_key = hash_key
+    self.range_key = range_key
+    self.indexes = dict(indexes or {})
+    self.items = {}
+    self.lock = threading.RLock()
+
+  def _key(self, key):
+    try:
+      if self.range_key:
+        return (key[self.hash_key], key[self.range_key])
+      return key[self.hash_key]
+    except KeyError:
+      raise client_error('ValidationException', 'GetItem',
+        'The provided key element does not match the schema')
+
+  def put_item(self, Item, ConditionExpression=None,
+    ExpressionAttributeValues=None, ExpressionAttributeNames=None, **kwargs):
+    item = {k: _to_decimal(v) for k, v in copy.deepcopy(Item).items()}
+    with self.lock:
+      key = self._key(item)
+      if ConditionExpression and not evaluate_condition(ConditionExpression,
+        self.items.get(key, {}), ExpressionAttributeValues or {},
+        ExpressionAttributeNames):
+        raise client_error('ConditionalCheckFailedException', 'PutItem')
+      self.items[key] = item
+    return {}
+
+  def get_item(self, Key, ProjectionExpression=None, **kwargs):
+    with self.lock:
+      item = self.items.get(self._key(Key))
+      if item is None:
+        return {}
+      return {'Item': self._project(copy.deepcopy(item), ProjectionExpression,
+        kwargs.get('ExpressionAttributeNames'))}
+
+  def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+    ConditionExpression=None, ExpressionAttributeNames=None,
+    ReturnValues='NONE', **kwargs):
+    values = {k: _to_decimal(v) for k, v in
+      (ExpressionAttributeValues or {}).items()}
+    with self.lock:
+      key = self._key(Key)
+      current = self.items.get(key)
+      item = copy.deepcopy(current) if current else dict(Key)
+      if ConditionExpression and not evaluate_condition(ConditionExpression,
+        item if current else {}, values, ExpressionAttributeNames):
+        raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+      apply_update(item, UpdateExpression, values, ExpressionAttributeNames)
+      self.items[key] = item
+      if ReturnValues == 'ALL_NEW':
+        return {'Attributes': copy.deepcopy(item)}
+      if ReturnValues == 'ALL_OLD':
+        return {'Attributes': copy.deepcopy(current or {})}
+    return {}
+
+  def delete_item(self, Key, **kwargs):
+    with self.lock:
+      self.items.pop(self._key(Key), None)
+    return {}
+
+  def _project(self, item, projection, names=None):
+    if not projection:
+      return item
+    fields = [_resolve(f.strip(), names) for f in projection.split(',')]
+    return {k: v for k, v in item.items() if k in fields}
+
+  """Query the table or an index
+  KeyConditionExpression is "hash = :h" optionally followed by
+  "AND range <op> :r" or "AND begins_with(range, :r)".
+  """
+  def query(self, KeyConditionExpression, ExpressionAttributeValues,
+    IndexName=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+    FilterExpression=None, ScanIndexForward=True, Limit=None,
+    ExclusiveStartKey=None, **kwargs):
+    if IndexName:
+      if IndexName not in self.indexes:
+        raise client_error('ValidationException', 'Query',
+          f'The table does not have the specified index: {IndexName}')
+      hash_key, range_key = self.indexes[IndexName]
+    else:
+      hash_key, range_key = self.hash_key, self.range_key
+
+    values = {k: _to_decimal(v) for k, v in ExpressionAttributeValues.items()}
+    with self.lock:
+      items = [copy.deepcopy(i) for i in self.items.values()
+        if hash_key in i and (range_key is None or range_key in i)]
+    items = [i for i in items if evaluate_condition(KeyConditionExpression, i,
+      values, ExpressionAttributeNames)]
+
+    # order by range key, then table key, so pagination is stable
+    def sort_key(i):
+      table_key = self._key(i)
+      return ((i.get(range_key) if range_key else 0), str(table_key))
+    items.sort(key=sort_key, reverse=not ScanIndexForward)
+
+    if ExclusiveStartKey:
+      start = sort_key(ExclusiveStartKey)
+      items = [i for i in items if (sort_key(i) > start if ScanIndexForward
+        else sort_key(i) < start)]
+
+    last_key = None
+    if Limit is not None and len(items) > Limit:
+      items = items[:Limit]
+      last = items[-1]
+      last_key = {k: last[k] for k in {self.hash_key, self.range_key,
+        hash_key, range_key} if k}
+
+    scanned = len(items)
+    if FilterExpression:
+      items = [i for i in items if evaluate_condition(FilterExpression, i,
+        values, ExpressionAttributeNames)]
+    response = {'Items': [self._project(i, ProjectionExpression,
+      ExpressionAttributeNames) for i in items],
+      'Count': len(items), 'ScannedCount': scanned}
+    if last_key:
+      response['LastEvaluatedKey'] = last_key
+    return response
+
+  def scan(self, **kwargs):
+    with self.lock:
+      items = [copy.deepcopy(i) for i in self.items.values()]
+    return {'Items': items, 'Count': len(items)}
+
+  def batch_writer(self, **kwargs):
+    return _BatchWriter(self)
+
+
+class _BatchWriter(object):
+  def __init__(self, table):
+    self.table = table
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def put_item(self, Item):
+    self.table.put_item(Item=Item)
+
+  def delete_item(self, Key):
+    self.table.delete_item(Key=Key)
+
+
+"""DynamoDB stand-in exposing both the resource and client interfaces
+"""
+class LocalDynamoDB(object):
+  def __init__(self):
+    self.tables = {}
+    self.exceptions = _Exceptions()
+
+  def create_table(self, TableName, hash_key, range_key=None, indexes=None):
+    self.tables[TableName] = LocalTable(TableName, hash_key, range_key,
+      indexes)
+    return self.tables[TableName]
+
+  # resource interface
+  def Table(self, name):
+    if name not in self.tables:
+      raise client_error('ResourceNotFoundException', 'DescribeTable', name)
+    return self.tables[name]
+
+  def batch_write_item(self, RequestItems, **kwargs):
+    for table_name, requests in RequestItems.items():
+      table = self.Table(table_name)
+      for request in requests:
+        if 'PutRequest' in request:
+          item = request['PutRequest']['Item']
+          if all(isinstance(v, dict) and len(v) == 1 for v in item.values()) \
+            and self.typed:
+            item = {k: deserialize(v) for k, v in item.items()}
+          table.put_item(Item=item)
+        elif 'DeleteRequest' in request:
+          key = request['DeleteRequest']['Key']
+          if self.typed:
+            key = {k: deserialize(v) for k, v in key.items()}
+          table.delete_item(Key=key)
+    return {'UnprocessedItems': {}}
+
+  typed = False
+
+
+"""boto3.client('dynamodb') stand-in: same tables, typed values
+"""
+class LocalDynamoDBClient(LocalDynamoDB):
+  typed = True
+
+  def __init__(self, resource):
+    self.tables = resource.tables
+    self.exceptions = resource.exceptions
+
+  @staticmethod
+  def _plain(typed_map):
+    return {k: deserialize(v) for k, v in (typed_map or {}).items()}
+
+  @staticmethod
+  def _typed(item):
+    return {k: serialize(v) for k, v in item.items()}
+
+  def get_item(self, TableName, Key, **kwargs):
+    response = self.Table(TableName).get_item(Key=self._plain(Key), **kwargs)
+    if 'Item' in response:
+      response['Item'] = self._typed(response['Item'])
+    return response
+
+  def put_item(self, TableName, Item, **kwargs):
+    values = kwargs.pop('ExpressionAttributeValues', None)
+    if values is not None:
+      kwargs['ExpressionAttributeValues'] = self._plain(values)
+    return self.Table(TableName).put_item(Item=self._plain(Item), **kwargs)
+
+  def update_item(self, TableName, Key, **kwargs):
+    if 'ExpressionAttributeValues' in kwargs:
+      kwargs['ExpressionAttributeValues'] = \
+        self._plain(kwargs['ExpressionAttributeValues'])
+    response = self.Table(TableName).update_item(Key=self._plain(Key),
+      **kwargs)
+    if 'Attributes' in response:
+      response['Attributes'] = self._typed(response['Attributes'])
+    return response
+
+  def query(self, TableName, ExpressionAttributeValues, Select=None,
+    **kwargs):
+    if 'ExclusiveStartKey' in kwargs:
+      kwargs['ExclusiveStartKey'] = self._plain(kwargs['ExclusiveStartKey'])
+    response = self.Table(TableName).query(
+      ExpressionAttributeValues=self._plain(ExpressionAttributeValues),
+      **kwargs)
+    response['Items'] = [self._typed(i) for i in response['Items']]
+    if 'LastEvaluatedKey' in response:
+      response['LastEvaluatedKey'] = self._typed(response['LastEvaluatedKey'])
+    return response
+
+
+###############################################################################
+# Step Functions
+###############################################################################
+
+"""Timer-based substitute for the waiting-engine state machine
+Each registered state machine waits `wait_seconds` and then publishes
+the execution input to an SNS topic, like haoyiran_a17_waiting_engine.
+"""
+class LocalStepFunctions(object):
+  def __init__(self, sns):
+    self.sns = sns
+    self.machines = {}
+    self.executions = {}
+    self.lock = threading.Lock()
+    self.exceptions = _Exceptions()
+
+  def create_wait_machine(self, name, wait_seconds, topic_arn):
+    arn = f'arn:aws:states:local:000000000000:stateMachine:{name}'
+    self.machines[arn] = (wait_seconds, topic_arn)
+    return arn
+
+  def start_execution(self, stateMachineArn, name=None, input='{}',
+    **kwargs):
+    if stateMachineArn not in self.machines:
+      raise client_error('StateMachineDoesNotExist', 'StartExecution',
+        stateMachineArn)
+    name = name or str(uuid.uuid4())
+    execution_arn = stateMachineArn.replace(':stateMachine:',
+      ':execution:') + ':' + name
+    wait_seconds, topic_arn = self.machines[stateMachineArn]
+    with self.lock:
+      if execution_arn in self.executions:
+        raise client_error('ExecutionAlreadyExists', 'StartExecution', name)
+      timer = threading.Timer(wait_seconds, self.sns.publish,
+        kwargs={'TopicArn': topic_arn, 'Message': input})
+      timer.daemon = True
+      self.executions[execution_arn] = timer
+    timer.start()
+    return {'executionArn': execution_arn, 'startDate': time.time()}
+
+
+###############################################################################
+# Glacier
+###############################################################################
+
+"""Minimal Glacier vault store
+Retrieval jobs complete after `retrieval_delay` seconds and publish the
+usual completion message to the job's SNS topic.
+"""
+class LocalGlacier(object):
+  def __init__(self, root, sns, retrieval_delay=1.0):
+    self.root = root
+    self.sns = sns
+    self.retrieval_delay = retrieval_delay
+    self.jobs = {}
+    self.multipart = {}
+    self.lock = threading.Lock()
+    self.exceptions = _Exceptions()
+
+  def _path(self, vault, archive_id):
+    return os.path.join(self.root, vault, archive_id)
+
+  def _store(self, vault, data):
+    archive_id = uuid.uuid4().hex
+    path = self._path(vault, archive_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+      if isinstance(data, (bytes, bytearray)):
+        fh.write(data)
+      else:
+        shutil.copyfileobj(data, fh, 1024 * 1024)
+    return archive_id
+
+  def upload_archive(self, vaultName, body, archiveDescription='', **kwargs):
+    archive_id = self._store(vaultName, body)
+    return {'archiveId': archive_id, 'location': f'/{vaultName}/{archive_id}'}
+
+  def initiate_multipart_upload(self, vaultName, partSize,
+    archiveDescription='', **kwargs):
+    upload_id = uuid.uuid4().hex
+    with self.lock:
+      self.multipart[upload_id] = {}
+    return {'uploadId': upload_id}
+
+  def upload_multipart_part(self, vaultName, uploadId, range, body,
+    checksum=None, **kwargs):
+    start = int(re.match(r'bytes (\d+)-', range).group(1))
+    with self.lock:
+      self.multipart[uploadId][start] = bytes(body)
+    return {'checksum': checksum}
+
+  def complete_multipart_upload(self, vaultName, uploadId, archiveSize=None,
+    checksum=None, **kwargs):
+    with self.lock:
+      parts = self.multipart.pop(uploadId)
+    data = b''.join(parts[start] for start in sorted(parts))
+    archive_id = self._store(vaultName, data)
+    return {'archiveId': archive_id, 'checksum': checksum}
+
+  def abort_multipart_upload(self, vaultName, uploadId, **kwargs):
+    with self.lock:
+      self.multipart.pop(uploadId, None)
+    return {}
+
+  def initiate_job(self, vaultName, jobParameters, **kwargs):
+    archive_id = jobParameters['ArchiveId']
+    if not os.path.isfile(self._path(vaultName, archive_id)):
+      raise client_error('ResourceNotFoundException', 'InitiateJob',
+        archive_id)
+    job_id = uuid.uuid4().hex
+    with self.lock:
+      self.jobs[job_id] = (vaultName, archive_id,
+        jobParameters.get('RetrievalByteRange'))
+    message = json.dumps({'JobId': job_id, 'ArchiveId': archive_id,
+      'JobDescription': jobParameters.get('Description'),
+      'StatusCode': 'Succeeded', 'Action': 'ArchiveRetrieval',
+      'ArchiveSizeInBytes': os.path.getsize(self._path(vaultName, archive_id)),
+      'RetrievalByteRange': jobParameters.get('RetrievalByteRange'),
+      'Tier': jobParameters.get('Tier', 'Standard')})
+    if jobParameters.get('SNSTopic'):
+      timer = threading.Timer(self.retrieval_delay, self.sns.publish,
+        kwargs={'TopicArn': jobParameters['SNSTopic'], 'Message': message})
+      timer.daemon = True
+      timer.start()
+    return {'jobId': job_id, 'location': f'/{vaultName}/jobs/{job_id}'}
+
+  def get_job_output(self, vaultName, jobId, range=None, **kwargs):
+    with self.lock:
+      if jobId not in self.jobs:
+        raise client_error('ResourceNotFoundException', 'GetJobOutput', jobId)
+      vault, archive_id, byte_range = self.jobs[jobId]
+    path = self._path(vault, archive_id)
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    if byte_range:
+      start, end = [int(b) for b in byte_range.split('-')]
+    if range:
+      match = re.match(r'bytes=(\d+)-(\d*)$', range)
+      offset = start
+      start = offset + int(match.group(1))
+      if match.group(2):
+        end = min(end, offset + int(match.group(2)))
+    fh = open(path, 'rb')
+    fh.seek(start)
+    length = max(0, end - start + 1)
+    return {'body': StreamingBody(fh, length), 'status': 200,
+      'contentRange': f'bytes {start}-{end}/{size}'}
+
+  def delete_archive(self, vaultName, archiveId, **kwargs):
+    path = self._path(vaultName, archiveId)
+    if os.path.isfile(path):
+      os.remove(path)
+    return {}
+
+
+###############################################################################
+# Wiring
+###############################################################################
+
+"""One local "AWS account" holding all the stand-in services
+"""
+class LocalAWS(object):
+  def __init__(self, root, glacier_retrieval_delay=1.0):
+    self.root = root
+    os.makedirs(root, exist_ok=True)
+    self.s3 = LocalS3(os.path.join(root, 's3'))
+    self.sqs = LocalSQS()
+    self.sns = LocalSNS()
+    self.dynamodb = LocalDynamoDB()
+    self.dynamodb_client = LocalDynamoDBClient(self.dynamodb)
+    self.stepfunctions = LocalStepFunctions(self.sns)
+    self.glacier = LocalGlacier(os.path.join(root, 'glacier'), self.sns,
+      retrieval_delay=glacier_retrieval_delay)
+
+  def client(self, service_name, *args, **kwargs):
+    clients = {
+      's3': self.s3,
+      'sqs': self.sqs,
+      'sns': self.sns,
+      'dynamodb': self.dynamodb_client,
+      'stepfunctions': self.stepfunctions,
+      'glacier': self.glacier,
+    }
+    if service_name not in clients:
+      raise NotImplementedError(f'No local stand-in for {service_name}')
+    return clients[service_name]
+
+  def resource(self, service_name, *args, **kwargs):
+    if service_name == 's3':
+      return LocalS3Resource(self.s3)
+    if service_name == 'sqs':
+      return self.sqs
+    if service_name == 'dynamodb':
+      return self.dynamodb
+    raise NotImplementedError(f'No local stand-in for {service_name}')
+
+  """Route boto3.client()/boto3.resource() to these stand-ins
+  Lets unmodified GAS modules run against the local services.
+  """
+  def installed(self):
+    return _Installed(self)
+
+
+class _Installed(object):
+  def __init__(self, aws):
+    self.aws = aws
+
+  def __enter__(self):
+    import boto3
+    self.boto3 = boto3
+    self.saved = (boto3.client, boto3.resource)
+    boto3.client = self.aws.client
+    boto3.resource = self.aws.resource
+    return self.aws
+
+  def __exit__(self, *args):
+    self.boto3.client, self.boto3.resource = self.saved
+
+### EOF
@@ -0,0 +1,18 @@
+#!/bin/bash
+
+# run_gas_local.sh
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the GAS pipeline on this machine against local AWS stand-ins
+#
+##
+
+cd /home/ubuntu/gas/util/local
+
+source /usr/local/bin/virtualenvwrapper.sh
+source /home/ubuntu/.virtualenvs/mpcs/bin/activate
+python /home/ubuntu/gas/util/local/gas_local.py "$@"
+
+### EOF
@@ -0,0 +1,339 @@
+# metrics.py
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+#
+# Runtime metrics in Prometheus text exposition format
+# Shared by the annotator webhook and the utility Flask apps
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Upper bounds (seconds) used for latency and job duration histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+  10, 20, 30)
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10)
+
+
+def _label_key(labels):
+  return tuple(sorted((labels or {}).items()))
+
+def _format_labels(key, extra=None):
+  pairs = list(key) + list(extra or [])
+  if not pairs:
+    return ''
+  escaped = []
+  for name, value in pairs:
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"') \
+      .replace('\n', '\\n')
+    escaped.append(f'{name}="{value}"')
+  return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value))
+
+
+"""Base class for a named metric family with optional labels
+"""
+class Metric(object):
+  kind = 'untyped'
+
+  def __init__(self, name, documentation):
+    self.name = name
+    self.documentation = documentation
+    self.lock = threading.Lock()
+    self.values = {}
+
+  def header(self):
+    return [f'# HELP {self.name} {self.documentation}',
+      f'# TYPE {self.name} {self.kind}']
+
+
+"""Monotonically increasing counter
+"""
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = _label_key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def render(self):
+    lines = self.header()
+    with self.lock:
+      for key, value in sorted(self.values.items()):
+        lines.append(f'{self.name}{_format_labels(key)} {_format_value(value)}')
+    return lines
+
+
+"""Value that can go up and down
+A callback may be registered per label set to sample the value at scrape
+time (e.g. the admission controller's running job count).
+"""
+class Gauge(Metric):
+  kind = 'gauge'
+
+  def __init__(self, name, documentation):
+    super().__init__(name, documentation)
+    self.callbacks = {}
+
+  def set(self, value, **labels):
+    with self.lock:
+      self.values[_label_key(labels)] = value
+
+  def inc(self, amount=1, **labels):
+    key = _label_key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def dec(self, amount=1, **labels):
+    self.inc(-amount, **labels)
+
+  def set_function(self, fn, **labels):
+    with self.lock:
+      self.callbacks[_label_key(labels)] = fn
+
+  def render(self):
+    lines = self.header()
+    with self.lock:
+      values = dict(self.values)
+      callbacks = dict(self.callbacks)
+    for key, fn in callbacks.items():
+      try:
+        values[key] = fn()
+      except Exception as e:
+        print(f'Unable to sample gauge {self.name}: {e}')
+    for key, value in sorted(values.items()):
+      lines.append(f'{self.name}{_format_labels(key)} {_format_value(value)}')
+    return lines
+
+
+"""Cumulative histogram with fixed bucket upper bounds
+"""
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+    super().__init__(name, documentation)
+    self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+  def observe(self, value, **labels):
+    key = _label_key(labels)
+    with self.lock:
+      series = self.values.get(key)
+      if series is None:
+        series = self.values[key] = {
+          'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          series['buckets'][i] += 1
+      series['sum'] += value
+      series['count'] += 1
+
+  """Context manager that observes the elapsed wall-clock time
+  """
+  def time(self, **labels):
+    return _Timer(self, labels)
+
+  def render(self):
+    lines = self.header()
+    with self.lock:
+      for key, series in sorted(self.values.items()):
+        for bound, count in zip(self.buckets, series['buckets']):
+          le = [('le', _format_value(bound))]
+          lines.append(f'{self.name}_bucket{_format_labels(key, le)} {count}')
+        lines.append(f'{self.name}_sum{_format_labels(key)} '
+          f'{_format_value(series["sum"])}')
+        lines.append(f'{self.name}_count{_format_labels(key)} '
+          f'{series["count"]}')
+    return lines
+
+
+class _Timer(object):
+  def __init__(self, histogram, labels):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.secs = time.time() - self.start
+    self.histogram.observe(self.secs, **self.labels)
+
+
+"""Collection of metrics rendered together on /metrics
+"""
+class Registry(object):
+  def __init__(self):
+    self.metrics = {}
+    self.lock = threading.Lock()
+    self.ingest_lock = threading.Lock()
+
+  def _register(self, metric):
+    with self.lock:
+      return self.metrics.setdefault(metric.name, metric)
+
+  def counter(self, name, documentation):
+    return self._register(Counter(name, documentation))
+
+  def gauge(self, name, documentation):
+    return self._register(Gauge(name, documentation))
+
+  def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+    return self._register(Histogram(name, documentation, buckets))
+
+  """Apply events appended by other processes (see EventLog)
+  The log is emptied once its events are applied, so it stays small.
+  """
+  def ingest(self, path):
+    if not os.path.isfile(path):
+      return
+    with self.ingest_lock:
+      self._ingest(path)
+
+  def _ingest(self, path):
+    with open(path, 'r+') as fh:
+      # writers take the same lock for every event, so none is appended
+      # between reading the log and truncating it
+      fcntl.flock(fh, fcntl.LOCK_EX)
+      lines = fh.read().split('\n')
+      # anything after the last newline is a torn write; keep it
+      tail = lines.pop()
+      for line in lines:
+        if not line:
+          continue
+        try:
+          event = json.loads(line)
+          metric = self.metrics[event['name']]
+          getattr(metric, event['op'])(event['value'],
+            **event.get('labels', {}))
+        except (ValueError, KeyError, AttributeError, TypeError) as e:
+          print(f'Skipping bad metrics event {line.strip()}: {e}')
+      fh.seek(0)
+      fh.truncate()
+      fh.write(tail)
+
+  def render(self):
+    lines = []
+    with self.lock:
+      metrics = list(self.metrics.values())
+    for metric in metrics:
+      lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+"""Append-only metrics event log
+Lets short-lived processes (e.g. run.py, launched once per job) report
+observations to the long-running service that serves /metrics.
+Each event is a single line written with O_APPEND under an exclusive
+flock, so concurrent writers don't interleave and Registry.ingest can
+empty the log without losing events.
+"""
+class EventLog(object):
+  def __init__(self, path):
+    self.path = path
+
+  def _write(self, op, name, value, labels):
+    line = json.dumps({'op': op, 'name': name, 'value': value,
+      'labels': labels}) + '\n'
+    try:
+      fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line.encode())
+      finally:
+        os.close(fd)
+    except OSError as e:
+      print(f'Unable to write metrics event to {self.path}: {e}')
+
+  def inc(self, name, amount=1, **labels):
+    self._write('inc', name, amount, labels)
+
+  def observe(self, name, value, **labels):
+    self._write('observe', name, value, labels)
+
+
+"""Metrics common to the GAS services
+"""
+def gas_metrics(registry):
+  return {
+    'sqs_receive_seconds': registry.histogram('gas_sqs_receive_seconds',
+      'Time spent in SQS receive_messages calls'),
+    'sqs_messages_per_poll': registry.histogram('gas_sqs_messages_per_poll',
+      'Number of messages returned by each SQS poll', COUNT_BUCKETS),
+    'jobs_in_flight': registry.gauge('gas_jobs_in_flight',
+      'Jobs currently being processed'),
+    'job_duration_seconds': registry.histogram('gas_job_duration_seconds',
+      'End-to-end processing time per job or message', DURATION_BUCKETS),
+    'annotation_stage_seconds': registry.histogram(
+      'gas_annotation_stage_seconds',
+      'Time spent in each AnnTools annotation stage', DURATION_BUCKETS),
+    's3_transfer_bytes': registry.counter('gas_s3_transfer_bytes_total',
+      'Bytes transferred to or from S3/Glacier'),
+    's3_transfer_seconds': registry.counter('gas_s3_transfer_seconds_total',
+      'Time spent transferring to or from S3/Glacier'),
+    'errors': registry.counter('gas_errors_total',
+      'Errors by service and processing step'),
+    'http_requests': registry.counter('gas_http_requests_total',
+      'HTTP requests by endpoint and status code'),
+  }
+
+
+"""Context manager counting a job as in flight and timing it
+"""
+class track_job(object):
+  def __init__(self, metrics, service):
+    self.metrics = metrics
+    self.service = service
+
+  def __enter__(self):
+    self.start = time.time()
+    self.metrics['jobs_in_flight'].inc(service=self.service)
+    return self
+
+  def __exit__(self, *args):
+    self.metrics['jobs_in_flight'].dec(service=self.service)
+    self.metrics['job_duration_seconds'].observe(time.time() - self.start,
+      service=self.service)
+
+
+"""Prometheus text exposition content type
+"""
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+"""Add a /metrics route and per-request accounting to a Flask app
+event_logs lists EventLog paths written by helper processes; they are
+folded into the registry on every scrape.
+"""
+def instrument_flask_app(app, registry, metrics, service, event_logs=()):
+  from flask import Response, request
+
+  @app.after_request
+  def count_request(response):
+    endpoint = request.endpoint or 'unknown'
+    # failed requests show up here by code; gas_errors_total is left to
+    # the handlers, which count each failed step once
+    metrics['http_requests'].inc(service=service, endpoint=endpoint,
+      code=response.status_code)
+    return response
+
+  @app.route('/metrics', methods=['GET'])
+  def metrics_endpoint():
+    for path in event_logs:
+      registry.ingest(path)
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+### EOF
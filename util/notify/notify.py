@@ -12,8 +12,11 @@ import time
 import os
 import sys
 import json
+import random
+import threading
 import psycopg2
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
@@ -24,25 +27,197 @@ from configparser import ConfigParser
 config = ConfigParser(os.environ)
 config.read('notify_config.ini')
 
+
+"""Token bucket shared by the sender threads
+Keeps the process under the account's SES sending rate (emails/second).
+"""
+class RateLimiter(object):
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.tokens = self.rate
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+"""SES sending rate: the configured MaxSendRate, or the account's quota
+"""
+def ses_send_rate():
+  rate = float(config['ses'].get('MaxSendRate', '0'))
+  if rate > 0:
+    return rate
+  ses = boto3.client('ses', region_name=config['aws']['AwsRegionName'])
+  try:
+    return float(ses.get_send_quota()['MaxSendRate'])
+  except ClientError as e:
+    print(f'Unable to get SES send quota, assuming 1 email/second: {e}')
+    return 1.0
+
+
+"""Job completion event of an SQS message, or None for anything else
+Accepts SNS envelopes and raw message delivery alike.
+"""
+def parse_message(message):
+  try:
+    body = json.loads(message.body)
+    if 'Message' in body and 'TopicArn' in body:
+      body = json.loads(body['Message'])
+    if body.get('job_status') != 'COMPLETED':
+      return None
+    return {'user_id': body['user_id'], 'job_id': body['job_id'],
+      'time': body.get('time')}
+  except (ValueError, KeyError, AttributeError, TypeError) as e:
+    print(f'Unable to parse results message {message.message_id}: {e}')
+    return None
+
+
+"""Receive up to BatchSize messages
+Long-polls for the first batch of 10, then keeps taking whatever is
+already queued for up to CoalesceSeconds, so that jobs completing close
+together for one user end up in the same email.
+"""
+def receive_batch(sqs):
+  wait_time = int(config['sqs']['WaitTime'])
+  max_messages = int(config['sqs']['MaxMessages'])
+  batch_size = int(config['sqs']['BatchSize'])
+  coalesce_secs = float(config['sqs']['CoalesceSeconds'])
+
+  messages = sqs.receive_messages(WaitTimeSeconds=wait_time,
+    MaxNumberOfMessages=max_messages)
+  deadline = time.time() + coalesce_secs
+  while messages and len(messages) < batch_size and time.time() < deadline:
+    more = sqs.receive_messages(WaitTimeSeconds=1,
+      MaxNumberOfMessages=min(max_messages, batch_size - len(messages)))
+    if not more:
+      break
+    messages += more
+  return messages
+
+
+"""Delete messages, 10 per call; failures are logged and left to reappear
+"""
+def delete_messages(sqs, messages):
+  for i in range(0, len(messages), 10):
+    chunk = messages[i:i + 10]
+    try:
+      response = sqs.delete_messages(Entries=[
+        {'Id': str(n), 'ReceiptHandle': m.receipt_handle}
+        for n, m in enumerate(chunk)])
+      for failure in response.get('Failed', []):
+        print(f'Unable to delete message {chunk[int(failure["Id"])].message_id}: '
+          f'{failure.get("Message")}')
+    except ClientError as e:
+      print(f'Unable to delete messages: {e}')
+
+
+def email_body(name, job_ids):
+  annotations_url = config['gas']['AnnotationsUrl'].rstrip('/')
+  if len(job_ids) == 1:
+    summary = 'Your annotation job has completed.'
+  else:
+    summary = f'{len(job_ids)} of your annotation jobs have completed.'
+  links = '\n'.join(f'  {annotations_url}/{job_id}' for job_id in job_ids)
+  return f'Hello {name},\n\n{summary} View the results at:\n\n{links}\n'
+
+
+"""Send one email listing all of a user's completed jobs
+Returns True when the email was sent (or can never be: no such user or
+no address), so the messages can be deleted.
+"""
+def notify_user(user_id, job_ids, limiter):
+  try:
+    profile = helpers.get_user_profile(id=user_id)
+  except IndexError:
+    print(f'No profile for user {user_id}; dropping {len(job_ids)} notifications')
+    return True
+  except (ClientError, psycopg2.Error) as e:
+    print(f'Unable to get profile of user {user_id}: {e}')
+    return False
+  if not profile['email']:
+    print(f'No email address for user {user_id}')
+    return True
+
+  subject = 'Annotation job completed' if len(job_ids) == 1 \
+    else f'{len(job_ids)} annotation jobs completed'
+  attempts = int(config['ses']['Attempts'])
+  for attempt in range(attempts):
+    limiter.acquire()
+    try:
+      helpers.send_email_ses(recipients=profile['email'],
+        sender=config['gas'].get('MailDefaultSender') or None,
+        subject=subject, body=email_body(profile['name'], job_ids))
+      print(f'Notified user {user_id} of jobs {", ".join(job_ids)}')
+      return True
+    except ClientError as e:
+      # the sending rate was exceeded (e.g. by another sender): back off
+      if e.response['Error']['Code'] != 'Throttling' or attempt == attempts - 1:
+        print(f'Unable to send notification to user {user_id}: {e}')
+        return False
+      time.sleep(random.uniform(0, 2 ** attempt))
+
+
 '''Capstone - Exercise 3(d)
 Reads result messages from SQS and sends notification emails.
+One email goes to each user with completed jobs in the batch; messages
+are deleted once their user has been notified.
 '''
-def handle_results_queue(sqs=None):
+def handle_results_queue(sqs=None, pool=None, limiter=None):
 
-  # Read a message from the queue
+  # Read a batch of messages from the queue
+  try:
+    messages = receive_batch(sqs)
+  except ClientError as e:
+    print(f'Unable to receive messages from SQS: {e}')
+    time.sleep(5)
+    return
+  if not messages:
+    return
+  print(f'Received {len(messages)} results messages...')
 
-  # Process message
+  # Process messages: group completed jobs by user
+  done = []
+  jobs = {}  # {user_id: {job_id: [messages]}}
+  for message in messages:
+    event = parse_message(message)
+    if event is None:
+      # other job status changes, or not a job message at all
+      done.append(message)
+      continue
+    jobs.setdefault(event['user_id'], {}) \
+      .setdefault(event['job_id'], []).append(message)
 
-  # Delete message
+  users = list(jobs)
+  results = pool.map(lambda user_id: notify_user(user_id,
+    list(jobs[user_id]), limiter), users)
+  for user_id, sent in zip(users, results):
+    if sent:
+      done += [m for job_messages in jobs[user_id].values() for m in job_messages]
+
+  # Delete messages
+  delete_messages(sqs, done)
 
-  pass
 
 if __name__ == '__main__':
-  
+
   # Get handles to resources; and create resources if they don't exist
+  sqs_resource = boto3.resource('sqs', region_name=config['aws']['AwsRegionName'])
+  sqs = sqs_resource.get_queue_by_name(QueueName=config['sqs']['ResultsQueueName'])
+  limiter = RateLimiter(ses_send_rate())
+  pool = ThreadPoolExecutor(max_workers=int(config['ses']['Workers']))
 
   # Poll queue for new results and process them
   while True:
-    handle_results_queue(sqs=sqs)
+    handle_results_queue(sqs=sqs, pool=pool, limiter=limiter)
 
 ### EOF
@@ -9,7 +9,18 @@
 
 import boto3
 import json
+import time
+import zlib
 import botocore
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+
+# zstd-compressed archives need the zstandard package in the Lambda
+# deployment package (or a layer); gzip needs nothing extra
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Define constants here; no config file is used for Lambdas
 AWS_DYNAMODB_ANNOTATIONS_TABLE = "haoyiran_annotations"
@@ -17,13 +28,133 @@ AWS_REGION_NAME = "us-east-1"
 AWS_GLACIER_VAULT_NAME = "ucmpcs"
 AWS_S3_RESULTS_BUCKET = "gas-results"
 
+# Restores run concurrently when SNS delivers several records at once
+RESTORE_WORKERS = 4
+
+# Retrieval output is read in ranges of this size, each retried on failure
+GLACIER_RANGE_SIZE = 64 * 1024 * 1024
+GLACIER_RANGE_ATTEMPTS = 3
+
+# Multipart upload of restored files: part size and parts in flight per file
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=8)
+
+
+"""File-like object returning the decompressed form of `stream`
+The archive codec is recorded on the job item by the archive app.
+"""
+class DecompressingReader(object):
+    def __init__(self, stream, codec):
+        self.stream = stream
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstandard package required to restore zstd archives')
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif codec == 'gzip':
+            self.decompressor = zlib.decompressobj(31)
+        else:
+            raise ValueError(f'Unknown archive codec: {codec}')
+        self.buffer = b''
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or len(self.buffer) < size):
+            data = self.stream.read(1024 * 1024)
+            if data:
+                self.buffer += self.decompressor.decompress(data)
+            else:
+                if hasattr(self.decompressor, 'flush'):
+                    self.buffer += self.decompressor.flush()
+                self.done = True
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+"""File-like reader of `length` bytes of a retrieval job's output,
+starting at byte `start`
+The output is fetched with ranged get_job_output calls, `window` bytes
+at a time; a window that fails midway is requested again from where it
+stopped, so one dropped connection does not fail a large restore. For a
+job archived in a bundle only that job's bytes are ever downloaded.
+"""
+class GlacierRangeReader(object):
+    def __init__(self, glacier_client, job_id, start, length,
+        window=GLACIER_RANGE_SIZE, attempts=GLACIER_RANGE_ATTEMPTS):
+        self.glacier = glacier_client
+        self.job_id = job_id
+        self.position = start
+        self.end = start + length
+        self.window = window
+        self.attempts = attempts
+        self.stream = None
+        self.stream_end = start
+
+    def _open(self):
+        self.stream_end = min(self.position + self.window, self.end)
+        response = self.glacier.get_job_output(vaultName=AWS_GLACIER_VAULT_NAME,
+            jobId=self.job_id, range=f'bytes={self.position}-{self.stream_end - 1}')
+        self.stream = response['body']
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.end - self.position
+        size = min(size, self.end - self.position)
+        for attempt in range(self.attempts):
+            try:
+                if self.stream is None or self.position >= self.stream_end:
+                    if size <= 0:
+                        return b''
+                    self._open()
+                data = self.stream.read(min(size, self.stream_end - self.position))
+                if not data:
+                    raise botocore.exceptions.IncompleteReadError(
+                        actual_bytes=self.position, expected_bytes=self.stream_end)
+                self.position += len(data)
+                return data
+            except (botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError) as e:
+                if attempt == self.attempts - 1:
+                    raise
+                print(f'Retrying retrieval output {self.job_id} from byte {self.position}: {e}')
+                self.stream = None
+                time.sleep(0.5 * 2 ** attempt)
+
 
 def lambda_handler(event, context):
     # print("Received event: " + json.dumps(event, indent=2))
-    
+
+    # SNS may deliver several retrieval notifications in one event;
+    # restore them side by side, sharing the clients (thread-safe once
+    # created; creating them is not, so it is done here)
+    glacier_client = boto3.client('glacier', region_name = AWS_REGION_NAME)
+    s3_client = boto3.client('s3', region_name=AWS_REGION_NAME)
+    dynamodb_client = boto3.client('dynamodb', region_name=AWS_REGION_NAME)
+    records = event['Records']
+    with ThreadPoolExecutor(max_workers=max(1, min(RESTORE_WORKERS, len(records)))) as pool:
+        results = list(pool.map(
+            lambda record: restore_record(record, glacier_client, s3_client,
+                dynamodb_client),
+            records))
+
+    failed = [r for r in results if r.get('statusCode') != 200]
+    return {
+        'statusCode': 500 if failed else 200,
+        'body': f'Restored {len(results) - len(failed)} of {len(results)} archived result files',
+        'results': results
+    }
+
+
+"""Restore the archived result file of one retrieval notification
+"""
+def restore_record(record, glacier_client, s3_client, dynamodb_client):
     # parse message 
     # referring to: https://docs.aws.amazon.com/lambda/latest/dg/with-sns-example.html
-    msg_body = json.loads(event['Records'][0]['Sns']['Message'])
+    msg_body = json.loads(record['Sns']['Message'])
     archive_job_id = msg_body['JobId']
     job_id = msg_body['JobDescription']
     status_code = msg_body['StatusCode']
@@ -44,7 +175,6 @@ def lambda_handler(event, context):
     
     # if retrieval job succeeded
     # use job_id to query dynamodb
-    dynamodb_client = boto3.client('dynamodb', region_name=AWS_REGION_NAME)
     try:
         print("Getting information from dynamodb with job_id")
         response_dynamodb = dynamodb_client.get_item(
@@ -60,7 +190,7 @@ def lambda_handler(event, context):
             }
     try:
         job = response_dynamodb['Item']
-    except KeyError: 
+    except KeyError as e:
         print(f'Unable to locate job in database: {e}')
         return {
             'statusCode': 500,
@@ -74,59 +204,84 @@ def lambda_handler(event, context):
     new_result_key = f'haoyiran/{user_id}/{job_id}~{result_file_name}'
 
 
-    # download file from glacier
+    # read the file from the retrieval output in ranges
     # referring to: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
-    glacier_client = boto3.client('glacier', region_name = AWS_REGION_NAME)
-    try:
-        print("Downloading file from Glacier")
-        response_glacier = glacier_client.get_job_output(
-            jobId=archive_job_id,
-            vaultName=AWS_GLACIER_VAULT_NAME,
-        )
-    except botocore.exceptions.BotoCoreError as e:
-        print(f'Unable to get job description with archive retrieval job id: {e}')
-        return {
-            'statusCode': 500,
-            'body': f'Unable to get job description with archive retrieval job id: {e}'
-            }
+    # a job archived in a bundle was retrieved by byte range: only its
+    # own bytes within that megabyte-aligned range are read
+    if msg_body.get('RetrievalByteRange'):
+        range_start, range_end = [int(b) for b in msg_body['RetrievalByteRange'].split('-')]
+    else:
+        range_start, range_end = 0, int(msg_body['ArchiveSizeInBytes']) - 1
+    bundled = 'results_file_archive_offset' in job
+    if bundled:
+        start = int(job['results_file_archive_offset']['N']) - range_start
+        length = int(job['results_file_archive_length']['N'])
+    else:
+        start, length = 0, range_end - range_start + 1
+    print("Downloading file from Glacier")
+    body = GlacierRangeReader(glacier_client, archive_job_id, start, length)
+
+    # decompress on the way to S3, a chunk at a time
+    codec = job.get('results_file_archive_codec', {}).get('S')
+    if codec:
+        try:
+            body = DecompressingReader(body, codec)
+        except ValueError as e:
+            print(f'Unable to decompress archive: {e}')
+            return {
+                'statusCode': 500,
+                'body': f'Unable to decompress archive: {e}'
+                }
 
-    # upload file to s3
+    # upload file to s3, several parts at a time
     # referring to: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_fileobj.html
-    s3_client = boto3.client('s3', region_name=AWS_REGION_NAME)
     try:
         print("Uploading file to S3")
-        s3_client.upload_fileobj(response_glacier['body'], 
+        s3_client.upload_fileobj(body, 
                                  AWS_S3_RESULTS_BUCKET, 
-                                 new_result_key)
+                                 new_result_key,
+                                 Config=S3_TRANSFER_CONFIG)
     except botocore.exceptions.ClientError as e:
         print(f'Unable to upload retrieved file to S3: {e}')
         return {
             'statusCode': 500,
             'body': f'Unable to upload retrieved file to S3: {e}'
             }
-    except botocore.exceptions.EndpointConnectionError as e:
+    except botocore.exceptions.BotoCoreError as e:
+        print(f'Unable to upload retrieved file to S3: {e}')
         return {
             'statusCode': 500,
-            'body': f'Unable to upload retrieved file to S3 due to network issues: {e}'
+            'body': f'Unable to upload retrieved file to S3 due to network or read errors: {e}'
             }
     
-    # updating dynamodb
-    dynamodb_resource = boto3.resource('dynamodb', region_name = AWS_REGION_NAME)
+    # updating dynamodb (with the shared client: resources are not
+    # thread-safe)
     try:
         print("Updating dynamodb")
-        table = dynamodb_resource.Table(AWS_DYNAMODB_ANNOTATIONS_TABLE)
-        response = table.update_item(
-            Key={'job_id': job_id},
-            UpdateExpression='REMOVE results_file_archive_id SET s3_key_result_file = :val1',
+        response = dynamodb_client.update_item(
+            TableName=AWS_DYNAMODB_ANNOTATIONS_TABLE,
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression='REMOVE results_file_archive_id, results_file_archive_offset, '
+                'results_file_archive_length, results_file_archive_size, '
+                'results_file_archive_codec, results_file_thaw_job_id, '
+                'results_file_thaw_started '
+                'SET s3_key_result_file = :val1',
             ExpressionAttributeValues={
-                ':val1': new_result_key
+                ':val1': {'S': new_result_key}
             }
         )
     except botocore.exceptions.ClientError as e:
         print(f'Unable to update dynamodb table with new s3 key: {e}')
         return {
-        'code': 500, 
-        'body': f'Unable to update dynamodb table with new s3 key: {e}'
+            'statusCode': 500,
+            'body': f'Unable to update dynamodb table with new s3 key: {e}'
+            }
+
+    # a bundle still holds other jobs' results, so it is kept
+    if bundled:
+        return {
+            'statusCode': 200,
+            'body': "Archived result file is back in S3"
         }
 
     # deleting archive
@@ -0,0 +1,187 @@
+# secret_store.py
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+#
+# Cached access to AWS Secrets Manager for all GAS modules
+#
+# Secrets are kept in memory for a TTL and refreshed in the background
+# shortly before they expire, so callers only wait on Secrets Manager
+# the first time a process asks for a secret. Short-lived processes (the
+# per-job annotator runs, restarted web workers) can also share an
+# encrypted file cache: set GAS_SECRETS_CACHE_FILE and a Fernet key in
+# GAS_SECRETS_CACHE_KEY (needs the cryptography package).
+#
+# Settings, from the environment:
+#   AWS_REGION_NAME          region of Secrets Manager (us-east-1)
+#   GAS_SECRETS_TTL          seconds a secret is used before refreshing (3600)
+#   GAS_SECRETS_CACHE_FILE   path of the encrypted file cache (none)
+#   GAS_SECRETS_CACHE_KEY    Fernet key for the file cache
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import os
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+try:
+  from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+  Fernet = None
+
+
+"""Encrypted JSON file of {secret_id: {"fetched_at", "value"}}
+Disabled (load returns {}, save does nothing) without a key or without
+the cryptography package.
+"""
+class SecretFileCache(object):
+  def __init__(self, path, key):
+    self.path = path
+    self.fernet = Fernet(key) if (path and key and Fernet) else None
+
+  @property
+  def enabled(self):
+    return self.fernet is not None
+
+  def load(self):
+    if not self.enabled:
+      return {}
+    try:
+      with open(self.path, 'rb') as fh:
+        return json.loads(self.fernet.decrypt(fh.read()))
+    except (OSError, ValueError, InvalidToken):
+      return {}
+
+  def save(self, entries):
+    if not self.enabled:
+      return
+    tmp = f'{self.path}.{os.getpid()}.tmp'
+    try:
+      # owner-only from the start; the file holds credentials
+      fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, 'wb') as fh:
+        fh.write(self.fernet.encrypt(json.dumps(entries).encode()))
+      os.replace(tmp, self.path)
+    except OSError as e:
+      print(f'Unable to write secrets cache {self.path}: {e}')
+
+
+"""Secrets Manager values (parsed SecretString) with a TTL cache
+A secret older than ttl - refresh_ahead is returned as is while a
+background thread fetches a new value; one older than ttl + max_stale
+is fetched before returning. A failed background refresh keeps the old
+value until then.
+"""
+class SecretsProvider(object):
+  def __init__(self, region_name='us-east-1', ttl=3600, refresh_ahead=300,
+    max_stale=3600, file_cache=None):
+    self.region_name = region_name
+    self.ttl = ttl
+    self.refresh_ahead = min(refresh_ahead, ttl)
+    self.max_stale = max_stale
+    self.file_cache = file_cache or SecretFileCache(None, None)
+    self.lock = threading.Lock()
+    self.entries = self.file_cache.load()
+    self.refreshing = set()
+    self._client = None
+
+  @classmethod
+  def from_env(cls):
+    return cls(
+      region_name=os.environ.get('AWS_REGION_NAME', 'us-east-1'),
+      ttl=int(os.environ.get('GAS_SECRETS_TTL', 3600)),
+      file_cache=SecretFileCache(os.environ.get('GAS_SECRETS_CACHE_FILE'),
+        os.environ.get('GAS_SECRETS_CACHE_KEY')))
+
+  @property
+  def client(self):
+    if self._client is None:
+      self._client = boto3.client('secretsmanager', region_name=self.region_name)
+    return self._client
+
+  def _fetch(self, secret_id):
+    response = self.client.get_secret_value(SecretId=secret_id)
+    entry = {'fetched_at': time.time(),
+      'value': json.loads(response['SecretString'])}
+    with self.lock:
+      self.entries[secret_id] = entry
+      entries = dict(self.entries)
+    self.file_cache.save(entries)
+    return entry['value']
+
+  def _refresh(self, secret_id):
+    try:
+      self._fetch(secret_id)
+    except (ClientError, ValueError) as e:
+      print(f'Unable to refresh secret {secret_id}: {e}')
+    finally:
+      with self.lock:
+        self.refreshing.discard(secret_id)
+
+  """Value of a secret; raises ClientError if it cannot be fetched
+  """
+  def get(self, secret_id):
+    with self.lock:
+      entry = self.entries.get(secret_id)
+      age = time.time() - entry['fetched_at'] if entry else None
+      if entry and age < self.ttl - self.refresh_ahead:
+        return entry['value']
+      if entry and age < self.ttl + self.max_stale:
+        if secret_id not in self.refreshing:
+          self.refreshing.add(secret_id)
+          threading.Thread(target=self._refresh, args=(secret_id,),
+            daemon=True).start()
+        return entry['value']
+    return self._fetch(secret_id)
+
+  """Fetch several secrets concurrently, e.g. at startup
+  Returns {secret_id: value}; the first error is raised.
+  """
+  def get_many(self, secret_ids):
+    results, errors = {}, []
+    def fetch(secret_id):
+      try:
+        results[secret_id] = self.get(secret_id)
+      except Exception as e:
+        errors.append(e)
+    threads = [threading.Thread(target=fetch, args=(s,)) for s in secret_ids]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise errors[0]
+    return results
+
+  """Drop a secret so the next get() fetches it, e.g. after a login
+  failure caused by a rotated password
+  """
+  def invalidate(self, secret_id):
+    with self.lock:
+      self.entries.pop(secret_id, None)
+      entries = dict(self.entries)
+    self.file_cache.save(entries)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+"""The process-wide provider, configured from the environment
+"""
+def get_provider():
+  global _provider
+  with _provider_lock:
+    if _provider is None:
+      _provider = SecretsProvider.from_env()
+    return _provider
+
+
+def get_secret(secret_id):
+  return get_provider().get(secret_id)
+
+### EOF
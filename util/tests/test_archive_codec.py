@@ -0,0 +1,77 @@
+# test_archive_codec.py
+#
+# Round trips through the archive codecs: compressed by archive_codec.py
+# on the way to Glacier, decompressed by the restore Lambda
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import io
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, os.path.join(TESTS_DIR, os.path.pardir, 'archive'))
+sys.path.insert(1, os.path.join(TESTS_DIR, os.path.pardir, 'restore'))
+import archive_codec
+from archive_codec import CHUNK_SIZE, CompressingReader, select_codec
+from restore import DecompressingReader
+
+CODECS = ['gzip', pytest.param('zstd', marks=pytest.mark.skipif(
+  archive_codec.zstandard is None, reason='zstandard not installed'))]
+
+# compressible, and spanning several source chunks
+DATA = b''.join(b'chr1\t%d\t.\tA\tG\t50\tPASS\n' % i for i in range(150000))
+
+
+def read_all(reader, size):
+  chunks = []
+  while True:
+    chunk = reader.read(size)
+    if not chunk:
+      return b''.join(chunks)
+    chunks.append(chunk)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('size', [-1, 1000, CHUNK_SIZE])
+def test_round_trip(codec, size):
+  assert len(DATA) > 2 * CHUNK_SIZE
+  reader = CompressingReader(io.BytesIO(DATA), codec)
+  compressed = read_all(reader, size)
+  assert len(compressed) < len(DATA)
+  assert reader.bytes_in == len(DATA)
+  assert reader.bytes_out == len(compressed)
+  restored = read_all(DecompressingReader(io.BytesIO(compressed), codec), size)
+  assert restored == DATA
+
+
+def test_gzip_archives_are_plain_gzip():
+  compressed = CompressingReader(io.BytesIO(DATA), 'gzip').read()
+  assert gzip.decompress(compressed) == DATA
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_empty_input(codec):
+  compressed = CompressingReader(io.BytesIO(b''), codec).read()
+  assert DecompressingReader(io.BytesIO(compressed), codec).read() == b''
+
+
+def test_select_codec():
+  assert select_codec('gzip') == 'gzip'
+  assert select_codec('GZIP') == 'gzip'
+  assert select_codec('zstd') == ('zstd' if archive_codec.zstandard else 'gzip')
+  assert select_codec('none') is None
+  assert select_codec(None) is None
+  assert select_codec('lz4') is None
+
+
+def test_unknown_codec():
+  with pytest.raises(ValueError):
+    CompressingReader(io.BytesIO(DATA), 'lz4')
+  with pytest.raises(ValueError):
+    DecompressingReader(io.BytesIO(DATA), 'lz4')
+
+### EOF
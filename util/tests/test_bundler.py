@@ -0,0 +1,108 @@
+# test_bundler.py
+#
+# Bundles of free user results (archive/bundler.py): every file must be
+# readable from its recorded (offset, length) in the archive alone
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'archive'))
+from bundler import MANIFEST_NAME, Bundle, ResultBundler
+
+FILES = {'a.vcf': os.urandom(1), 'b.vcf': os.urandom(511),
+  'c.vcf': os.urandom(512), 'd.vcf': b'', 'e.vcf': os.urandom(100000)}
+
+
+def test_member_offsets(tmp_path):
+  bundle = Bundle(str(tmp_path))
+  entries = [bundle.add(f'job-{name}', name, io.BytesIO(data), len(data))
+    for name, data in FILES.items()]
+  assert 'job-a.vcf' in bundle and 'job-z.vcf' not in bundle
+  size = bundle.close()
+
+  with open(bundle.path, 'rb') as fh:
+    archive = fh.read()
+  assert len(archive) == size
+  for entry in entries:
+    data = archive[entry['offset']:entry['offset'] + entry['length']]
+    assert data == FILES[entry['name']]
+
+  # the same offsets tar itself reports, and the manifest comes last
+  with tarfile.open(bundle.path) as tar:
+    members = tar.getmembers()
+    assert [m.name for m in members] == list(FILES) + [MANIFEST_NAME]
+    assert [m.offset_data for m in members[:-1]] == [e['offset'] for e in entries]
+    manifest = json.load(tar.extractfile(MANIFEST_NAME))
+  assert manifest['bundle_id'] == bundle.bundle_id
+  assert manifest['files'] == entries
+
+
+class FakeS3(object):
+  def __init__(self, objects):
+    self.objects = dict(objects)
+
+  def get_object(self, Bucket, Key):
+    return {'Body': io.BytesIO(self.objects[Key])}
+
+  def delete_object(self, Bucket, Key):
+    del self.objects[Key]
+
+
+class FakeMessage(object):
+  deleted = False
+
+  def change_visibility(self, VisibilityTimeout):
+    pass
+
+  def delete(self):
+    self.deleted = True
+
+
+class FakeUploader(object):
+  def __init__(self):
+    self.archives = []
+
+  def upload(self, fh, description=''):
+    self.archives.append(fh.read())
+    return 'archive-1', None, None
+
+
+class FakeTable(object):
+  def __init__(self):
+    self.updates = {}
+
+  def update_item(self, Key, UpdateExpression, ExpressionAttributeValues):
+    self.updates[Key['job_id']] = ExpressionAttributeValues
+
+
+def test_full_bundle_is_archived_in_the_background(tmp_path):
+  s3 = FakeS3(FILES)
+  uploader, table = FakeUploader(), FakeTable()
+  archived = threading.Event()
+  bundler = ResultBundler(s3, uploader, table, str(tmp_path),
+    window=300, max_files=len(FILES),
+    on_archived=lambda archive_id, size, files: archived.set())
+  messages = {name: FakeMessage() for name in FILES}
+  for name in FILES:
+    assert bundler.add(f'job-{name}', 'results', name, messages[name])
+  # add() only wakes the flusher thread
+  assert archived.wait(15)
+  assert len(uploader.archives) == 1
+
+  archive = uploader.archives[0]
+  for name, data in FILES.items():
+    values = table.updates[f'job-{name}']
+    assert values[':id'] == 'archive-1'
+    assert values[':size'] == len(archive)
+    assert archive[values[':offset']:values[':offset'] + values[':length']] == data
+  assert all(m.deleted for m in messages.values())
+  assert s3.objects == {}
+  assert os.listdir(tmp_path) == []
+
+### EOF
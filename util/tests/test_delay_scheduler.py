@@ -0,0 +1,138 @@
+# test_delay_scheduler.py
+#
+# Journal replay, compaction, retries and the single-user lock of
+# archive/delay_scheduler.py
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'archive'))
+from delay_scheduler import DelayScheduler
+
+
+class Fired(object):
+  def __init__(self, fail=()):
+    self.fail = set(fail)
+    self.keys = []
+    self.changed = threading.Condition()
+
+  def __call__(self, entries):
+    with self.changed:
+      self.keys += [key for key, _ in entries]
+      self.changed.notify_all()
+    failed, self.fail = self.fail, set()
+    return failed
+
+  def wait_for(self, count, timeout=10):
+    with self.changed:
+      return self.changed.wait_for(lambda: len(self.keys) >= count, timeout)
+
+
+"""Wait until the fired entries have been journaled as done
+"""
+def settle(scheduler, pending, timeout=10):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    with scheduler.condition:
+      if sorted(scheduler.entries) == sorted(pending):
+        return True
+    time.sleep(0.01)
+  return False
+
+
+def close(scheduler):
+  # the thread is a daemon; releasing the lock lets a "restart" reopen it
+  scheduler.journal.close()
+  scheduler.lock_file.close()
+
+
+def records(path):
+  with open(path) as fh:
+    return [json.loads(line) for line in fh]
+
+
+def test_replay_restores_pending_entries(tmp_path):
+  path = str(tmp_path / 'schedule.journal')
+  fired = Fired()
+  scheduler = DelayScheduler(path, fired)
+  now = time.time()
+  assert scheduler.schedule('soon', now, {'n': 1})
+  assert scheduler.schedule('later', now + 3600, {'n': 2})
+  assert not scheduler.schedule('later', now, {'n': 3})
+  assert fired.wait_for(1)
+  assert settle(scheduler, ['later'])
+  close(scheduler)
+  assert fired.keys == ['soon']
+
+  # a torn last write is ignored
+  with open(path, 'a') as fh:
+    fh.write('{"add": "torn", "du')
+
+  restarted = DelayScheduler(path, Fired())
+  assert len(restarted) == 1
+  assert restarted.entries['later'] == (now + 3600, {'n': 2})
+  close(restarted)
+
+
+def test_late_entries_fire_on_replay(tmp_path):
+  path = str(tmp_path / 'schedule.journal')
+  with open(path, 'w') as fh:
+    for key in ('a', 'b', 'c'):
+      fh.write(json.dumps({'add': key, 'due': 1, 'payload': key}) + '\n')
+    fh.write(json.dumps({'done': ['b']}) + '\n')
+  fired = Fired()
+  scheduler = DelayScheduler(path, fired)
+  assert fired.wait_for(2)
+  assert settle(scheduler, [])
+  close(scheduler)
+  assert sorted(fired.keys) == ['a', 'c']
+
+
+def test_failed_entries_are_retried(tmp_path):
+  fired = Fired(fail={'a'})
+  scheduler = DelayScheduler(str(tmp_path / 'schedule.journal'), fired,
+    retry_delay=0.2)
+  scheduler.schedule('a', time.time(), None)
+  assert fired.wait_for(2)
+  assert settle(scheduler, [])
+  close(scheduler)
+  assert fired.keys == ['a', 'a']
+
+
+def test_compaction_keeps_only_pending_entries(tmp_path):
+  path = str(tmp_path / 'schedule.journal')
+  fired = Fired()
+  scheduler = DelayScheduler(path, fired, compact_after=5)
+  now = time.time()
+  scheduler.schedule('pending', now + 3600, 'p')
+  for i in range(10):
+    scheduler.schedule(f'due-{i}', now, i)
+    assert fired.wait_for(i + 1)
+  assert settle(scheduler, ['pending'])
+  with scheduler.condition:
+    assert scheduler.records <= len(scheduler.entries) + 5
+  close(scheduler)
+
+  adds = [r['add'] for r in records(path) if 'add' in r]
+  assert 'pending' in adds
+  assert len(records(path)) < 1 + 2 * 10
+  restarted = DelayScheduler(path, Fired())
+  assert list(restarted.entries) == ['pending']
+  close(restarted)
+
+
+def test_second_scheduler_on_a_journal_is_refused(tmp_path):
+  path = str(tmp_path / 'schedule.journal')
+  scheduler = DelayScheduler(path, Fired())
+  with pytest.raises(RuntimeError):
+    DelayScheduler(path, Fired())
+  close(scheduler)
+
+### EOF
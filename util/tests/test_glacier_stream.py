@@ -0,0 +1,92 @@
+# test_glacier_stream.py
+#
+# Tree hashes and multipart uploads in archive/glacier_stream.py, checked
+# against botocore's own tree hash
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import sys
+import threading
+
+import pytest
+from botocore.utils import calculate_tree_hash
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'archive'))
+from glacier_stream import MB, TreeHash, GlacierStreamUploader, tree_hash
+
+
+def expected(data):
+  return calculate_tree_hash(io.BytesIO(data))
+
+SIZES = [0, 1, MB - 1, MB, MB + 1, 2 * MB, 3 * MB + 5, 4 * MB, 7 * MB + 100]
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_tree_hash_matches_botocore(size):
+  data = os.urandom(size)
+  assert tree_hash(data).hexdigest() == expected(data)
+
+
+def test_tree_hash_of_uneven_updates():
+  data = os.urandom(5 * MB + 12345)
+  hasher = TreeHash()
+  for start in range(0, len(data), 700001):
+    hasher.update(data[start:start + 700001])
+  assert hasher.hexdigest() == expected(data)
+
+
+def test_tree_hash_from_subtree_digests():
+  # two 2 MB parts as level-1 subtrees, then a short tail
+  parts = [os.urandom(2 * MB), os.urandom(2 * MB), os.urandom(MB // 2)]
+  hasher = TreeHash()
+  hasher.update_digest(tree_hash(parts[0]).digest(), 1)
+  hasher.update_digest(tree_hash(parts[1]).digest(), 1)
+  hasher.update(parts[2])
+  assert hasher.hexdigest() == expected(b''.join(parts))
+
+
+class FakeGlacier(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.parts = {}
+    self.archives = []
+
+  def upload_archive(self, vaultName, archiveDescription, checksum, body):
+    self.archives.append((checksum, body))
+    return {'archiveId': 'single'}
+
+  def initiate_multipart_upload(self, vaultName, archiveDescription, partSize):
+    return {'uploadId': 'upload'}
+
+  def upload_multipart_part(self, vaultName, uploadId, checksum, range, body):
+    assert checksum == expected(body)
+    start = int(range.split()[1].split('-')[0])
+    with self.lock:
+      self.parts[start] = body
+
+  def complete_multipart_upload(self, vaultName, uploadId, archiveSize, checksum):
+    data = b''.join(self.parts[start] for start in sorted(self.parts))
+    assert int(archiveSize) == len(data)
+    self.archives.append((checksum, data))
+    return {'archiveId': 'multipart'}
+
+
+@pytest.mark.parametrize('size', [MB // 2, 2 * MB, 5 * MB + 3, 8 * MB])
+def test_upload_checksum_matches_botocore(size):
+  data = os.urandom(size)
+  glacier = FakeGlacier()
+  uploader = GlacierStreamUploader(glacier, 'vault', part_size=2 * MB, workers=2)
+  archive_id, archive_size, checksum = uploader.upload(io.BytesIO(data))
+  assert archive_size == size
+  assert archive_id == ('single' if size < 2 * MB else 'multipart')
+  assert glacier.archives == [(checksum, data)]
+  assert checksum == expected(data)
+
+
+def test_part_size_must_be_power_of_two_megabytes():
+  with pytest.raises(ValueError):
+    GlacierStreamUploader(FakeGlacier(), 'vault', part_size=3 * MB)
+
+### EOF
@@ -9,17 +9,163 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import json
 import os
+import random
+import sys
+import time
 import boto3
 import botocore
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from flask import Flask, request, jsonify
 import requests
 
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import metrics
+
 app = Flask(__name__)
 environment = 'thaw_app_config.Config'
 app.config.from_object(environment)
 app.url_map.strict_slashes = False
 
+# Runtime metrics served on /metrics
+registry = metrics.Registry()
+gas_metrics = metrics.gas_metrics(registry)
+metrics.instrument_flask_app(app, registry, gas_metrics, 'thaw')
+
+MB = 1024 * 1024
+
+"""Glacier retrieval job parameters for one archived job (typed item)
+Results archived in a bundle are retrieved by byte range: just the
+megabyte-aligned span around the job's file, not the whole bundle.
+"""
+def retrieval_parameters(item, tier):
+    parameters = {
+        'Type': 'archive-retrieval',
+        'ArchiveId': item['results_file_archive_id']['S'],
+        'Tier': tier,
+        'SNSTopic': app.config['AWS_SNS_ARCHIVE_RETRIEVED_TOPIC'],
+        'Description': item['job_id']['S']
+    }
+    if 'results_file_archive_offset' in item:
+        offset = int(item['results_file_archive_offset']['N'])
+        length = int(item['results_file_archive_length']['N'])
+        size = int(item['results_file_archive_size']['N'])
+        start = offset // MB * MB
+        end = min(-(-(offset + length) // MB) * MB, size) - 1
+        parameters['RetrievalByteRange'] = f'{start}-{end}'
+    return parameters
+
+
+"""Archived jobs of a user, following LastEvaluatedKey across pages
+Only the attributes a retrieval needs are read, and jobs that are not
+archived are filtered out on the server side.
+"""
+def archived_items(dynamodb_client, user_id):
+    kwargs = {
+        'TableName': app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+        'IndexName': "user_id_index",
+        'ProjectionExpression': "results_file_archive_id, job_id, "
+            "results_file_archive_offset, results_file_archive_length, "
+            "results_file_archive_size, results_file_thaw_job_id, "
+            "results_file_thaw_started",
+        'KeyConditionExpression': "user_id = :u",
+        'FilterExpression': "attribute_exists(results_file_archive_id)",
+        'ExpressionAttributeValues': {":u": {"S": user_id}}
+    }
+    while True:
+        response = dynamodb_client.query(**kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+"""True if a retrieval for this job was started recently enough that
+the restore may still be on its way
+"""
+def retrieval_pending(item):
+    if 'results_file_thaw_job_id' not in item:
+        return False
+    started = float(item.get('results_file_thaw_started', {}).get('N', 0))
+    return time.time() - started < float(app.config['AWS_GLACIER_THAW_PENDING_SECS'])
+
+
+"""Record the Glacier job ID of a started retrieval on the job item
+Best effort: without it a redelivered message only starts the
+retrieval again.
+"""
+def record_retrieval(dynamodb_client, job_id, glacier_job_id):
+    try:
+        dynamodb_client.update_item(
+            TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression='SET results_file_thaw_job_id = :j, results_file_thaw_started = :t',
+            ConditionExpression='attribute_exists(results_file_archive_id)',
+            ExpressionAttributeValues={':j': {'S': glacier_job_id},
+                ':t': {'N': str(int(time.time()))}})
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f'Unable to record retrieval {glacier_job_id} for job {job_id}: {e}')
+
+
+# Glacier errors worth retrying after a pause
+RETRYABLE_ERRORS = ('ThrottlingException', 'RequestLimitExceeded',
+    'ServiceUnavailableException', 'SlowDown')
+
+"""Start the retrieval of one archived job; returns the Glacier job ID
+Tries an expedited retrieval first and falls back to standard when there
+is no expedited capacity. Throttling is retried with exponential backoff
+and jitter, up to AWS_GLACIER_THAW_ATTEMPTS attempts.
+"""
+def initiate_retrieval(glacier_client, item):
+    tier = 'Expedited'
+    attempts = int(app.config['AWS_GLACIER_THAW_ATTEMPTS'])
+    for attempt in range(attempts):
+        try:
+            response = glacier_client.initiate_job(
+                vaultName=app.config['AWS_GLACIER_VAULT_NAME'],
+                jobParameters=retrieval_parameters(item, tier))
+            return response['jobId']
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'InsufficientCapacityException' and tier == 'Expedited':
+                print(f'Insufficient capacity for job {item["job_id"]["S"]}, trying standard retrieval...')
+                tier = 'Standard'
+                continue
+            if code not in RETRYABLE_ERRORS or attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise botocore.exceptions.ClientError({'Error': {'Code': 'TooManyAttempts',
+        'Message': f'No retrieval started after {attempts} attempts'}}, 'InitiateJob')
+
+
+"""Start retrievals for many archived jobs at once
+At most AWS_GLACIER_THAW_WORKERS initiate_job calls are in flight; each
+started retrieval is recorded on its job item (record_retrieval).
+Returns the jobs whose retrieval could not be started.
+"""
+def thaw_archives(glacier_client, dynamodb_client, items):
+    failed = []
+    if not items:
+        return failed
+    workers = min(int(app.config['AWS_GLACIER_THAW_WORKERS']), len(items))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(initiate_retrieval, glacier_client, item): item
+            for item in items}
+        for future in as_completed(futures):
+            job_id = futures[future]['job_id']['S']
+            try:
+                glacier_job_id = future.result()
+            except botocore.exceptions.ClientError as e:
+                print(f'Unable to start retrieval for job {job_id}: {e}')
+                failed.append(futures[future])
+                continue
+            print(f'Started retrieval {glacier_job_id} for job {job_id}')
+            record_retrieval(dynamodb_client, job_id, glacier_job_id)
+    return failed
+
+
 @app.route('/', methods=['GET'])
 def home():
   return (f"This is the Thaw utility: POST requests to /thaw.")
@@ -70,8 +216,9 @@ def thaw_premium_user_data():
             wait_time = int(app.config['AWS_SQS_WAIT_TIME'])
             max_num_message = int(app.config['AWS_SQS_MAX_MESSAGES'])
             try:
-                messages = queue.receive_messages(WaitTimeSeconds = wait_time, 
-                                                  MaxNumberOfMessages = max_num_message)
+                with gas_metrics['sqs_receive_seconds'].time(service='thaw'):
+                    messages = queue.receive_messages(WaitTimeSeconds = wait_time, 
+                                                      MaxNumberOfMessages = max_num_message)
             except botocore.exceptions.ClientError as e:
                 print(e)
                 return jsonify({
@@ -79,116 +226,74 @@ def thaw_premium_user_data():
                     "message": f'Unable to receive message from SQS: {e}'
                     }), 500
             
+            gas_metrics['sqs_messages_per_poll'].observe(len(messages), service='thaw')
+
             # Start processing messages from SQS 
             if len(messages) > 0:
                 print(f'Received {str(len(messages))} user_did_upgrade messages...')
 
                 # Iterate each message
                 for message in messages:
-                    # Parse JSON message
-                    print("new user_did_upgrade message")
-                    try:
-                        msg_body = json.loads(json.loads(message.body)["Message"])
-                        print(msg_body)
-                    except json.JSONDecodeError as e:
-                        print(e)
-                        return jsonify({
-                            "code": 500,
-                            "message": f'Unable to decode message into json: {e}'
-                            }), 500
-                    
-                    # get user_id 
-                    try: 
-                        user_id = msg_body["user_id"]
-                    except KeyError as e:
-                        print(e)
-                        return jsonify({
-                            "code": 500,
-                            "message": f'Missing field in message: {e}'
-                            }), 500
+                    with metrics.track_job(gas_metrics, 'thaw'):
+                        # Parse JSON message
+                        print("new user_did_upgrade message")
+                        try:
+                            msg_body = json.loads(json.loads(message.body)["Message"])
+                            print(msg_body)
+                        except json.JSONDecodeError as e:
+                            print(e)
+                            return jsonify({
+                                "code": 500,
+                                "message": f'Unable to decode message into json: {e}'
+                                }), 500
                     
-                    # get a list of archive id for user_id
-                    dynamodb_client = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-                    try: 
-                        print(f'Retrieving a list of archive id for user: {user_id}')
-                        response = dynamodb_client.query(
-                            TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'], 
-                            IndexName="user_id_index",
-                            Select='SPECIFIC_ATTRIBUTES', 
-                            ProjectionExpression="results_file_archive_id, job_id", 
-                            KeyConditionExpression="user_id = :u", 
-                            ExpressionAttributeValues={":u": {"S": user_id}}
-                            )
-                    except botocore.exceptions.ClientError as e:
-                        print(e)
-                        return jsonify({
-                            "code": 500,
-                            "message": f'Unable to get archive id from dynamodb: {e}'
-                            }), 500
+                        # get user_id 
+                        try: 
+                            user_id = msg_body["user_id"]
+                        except KeyError as e:
+                            print(e)
+                            return jsonify({
+                                "code": 500,
+                                "message": f'Missing field in message: {e}'
+                                }), 500
                     
-
-                    glacier_client = boto3.client('glacier', region_name=app.config['AWS_REGION_NAME'])
-                    archive_retrieved_sns_topic = app.config['AWS_SNS_ARCHIVE_RETRIEVED_TOPIC']
-                    vault_name = app.config['AWS_GLACIER_VAULT_NAME']
-                    # iterate through archive id
-                    print("Iterating through archive ids")
-                    for item in response['Items']:
-                        print("another archive id")
-                        if "results_file_archive_id" not in item: continue
-                        archive_id = item['results_file_archive_id']['S']
-                        job_id = item['job_id']['S']
+                        # find the user's archived results, a page at a time
+                        dynamodb_client = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
                         try:
-                            # Send expedited retrieval request
-                            response = glacier_client.initiate_job(
-                                vaultName=vault_name,  
-                                jobParameters={
-                                    'Type': 'archive-retrieval',
-                                    'ArchiveId': archive_id,
-                                    'Tier': 'Expedited',
-                                    'SNSTopic': archive_retrieved_sns_topic
-                                }
-                            )
-                        except glacier_client.exceptions.InsufficientCapacityException as e:
-                            # Catch and print InsufficientCapacityException
-                            print('Error: Insufficient capacity:', e)
-                            
-                            # Try standard retrieval
-                            print('Trying standard retrieval...')
-                            try:
-                                response = glacier_client.initiate_job(
-                                    vaultName=vault_name, 
-                                    jobParameters={
-                                        'Type': 'archive-retrieval',
-                                        'ArchiveId': archive_id,
-                                        'Tier': 'Standard',
-                                        'SNSTopic': archive_retrieved_sns_topic,
-                                        'Description': job_id
-                                    }
-                                )
-                                print(response['jobId'])
-                            # generic glacier exception
-                            # referring to: https://sdk.amazonaws.com/java/api/latest/software/amazon/awssdk/services/glacier/GlacierClient.html
-                            except glacier_client.exceptions.GlacierException as e:
-                                print(e)
-                                return jsonify({
-                                    "code": 500,
-                                    "message": f'Unable to start standard archive retrieval through glacier: {e}'
-                                    }), 500
-                        except glacier_client.exceptions.GlacierException as e:
+                            print(f'Retrieving a list of archive id for user: {user_id}')
+                            items = list(archived_items(dynamodb_client, user_id))
+                        except botocore.exceptions.ClientError as e:
                             print(e)
                             return jsonify({
                                 "code": 500,
-                                "message": f'Unexpected error while starting expedited retrieval through glacier: {e}'
+                                "message": f'Unable to get archive id from dynamodb: {e}'
+                                }), 500
+
+                        # a redelivered message only retries what did not start
+                        archived = len(items)
+                        items = [item for item in items if not retrieval_pending(item)]
+                        if len(items) < archived:
+                            print(f'Skipping {archived - len(items)} archives already being retrieved')
+
+                        glacier_client = boto3.client('glacier', region_name=app.config['AWS_REGION_NAME'])
+                        print(f'Initiating retrieval of {len(items)} archives')
+                        failed = thaw_archives(glacier_client, dynamodb_client, items)
+                        if failed:
+                            # keep the message: the upgrade is retried once it reappears
+                            return jsonify({
+                                "code": 500,
+                                "message": f'Unable to start archive retrieval through glacier for {len(failed)} of {len(items)} jobs'
                                 }), 500
-                    try: 
-                        print("Deleting message...")
-                        message.delete()
-                    except botocore.exceptions.ClientError as e:
-                        print(e)
-                        return jsonify({
-                        'code': 500, 
-                        'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
-                        }), 500    
+
+                        try: 
+                            print("Deleting message...")
+                            message.delete()
+                        except botocore.exceptions.ClientError as e:
+                            print(e)
+                            return jsonify({
+                            'code': 500, 
+                            'message': f'Unable to delete message on SQS after succefully processing the message: {e}'
+                            }), 500    
                         
                 return jsonify({
                     "code": 200, 
@@ -33,4 +33,11 @@ class Config(object):
   # AWS Glacier vault
   AWS_GLACIER_VAULT_NAME = "ucmpcs"
 
+  # Concurrent initiate_job calls, and attempts per archive when throttled
+  AWS_GLACIER_THAW_WORKERS = 16
+  AWS_GLACIER_THAW_ATTEMPTS = 5
+  # A started retrieval is recorded on the job item; redelivered upgrade
+  # messages skip it unless it is older than this (the restore failed)
+  AWS_GLACIER_THAW_PENDING_SECS = 86400
+
 ### EOF
@@ -0,0 +1,133 @@
+# tracing.py
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+#
+# End-to-end job tracing
+#
+# A trace context is started when the web app accepts a job and travels
+# with it: in the SNS job request message, to run.py through the
+# environment, and in the step function input. Every hop records
+# timestamped spans which are appended to the job's "trace_spans" list
+# in DynamoDB, as part of the status update the hop makes anyway.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import os
+import time
+import uuid
+from decimal import Decimal
+
+# Environment variable used to hand the context to run.py
+TRACE_ENV = 'GAS_TRACE'
+
+# DynamoDB attribute holding the spans
+SPANS_ATTRIBUTE = 'trace_spans'
+
+
+def _decimal(value):
+  return Decimal(str(round(value, 6)))
+
+
+"""Spans recorded by one hop for one job
+context is the dict carried between hops: trace_id plus sent_at, the
+time the previous hop handed the job on (used to measure queue waits).
+"""
+class Trace(object):
+  def __init__(self, context=None, service='web'):
+    self.context = dict(context or {'trace_id': uuid.uuid4().hex})
+    self.service = service
+    self.spans = []
+
+  @classmethod
+  def from_message(cls, message, service):
+    return cls(message.get('trace'), service)
+
+  @classmethod
+  def from_env(cls, service):
+    try:
+      context = json.loads(os.environ.get(TRACE_ENV, ''))
+    except ValueError:
+      context = None
+    return cls(context, service)
+
+  @property
+  def trace_id(self):
+    return self.context.get('trace_id')
+
+  @property
+  def sent_at(self):
+    return self.context.get('sent_at')
+
+  def add(self, hop, start, end=None):
+    if start is None:
+      return
+    end = time.time() if end is None else end
+    self.spans.append({
+      'hop': hop,
+      'service': self.service,
+      'start': _decimal(float(start)),
+      'end': _decimal(float(end)),
+      'secs': _decimal(float(end) - float(start))
+    })
+
+  """Time a block of code as a span
+  """
+  def span(self, hop):
+    return _Span(self, hop)
+
+  """Record the wait since the previous hop handed the job on
+  """
+  def add_wait(self, hop, end=None):
+    self.add(hop, self.sent_at, end)
+
+  """Context for the next hop, stamped with the hand-off time
+  """
+  def handoff(self):
+    return dict(self.context, sent_at=time.time())
+
+  def to_env(self):
+    return {TRACE_ENV: json.dumps(self.handoff())}
+
+  """UpdateExpression fragment and values appending the recorded spans
+  Combine with the hop's own SET clauses so tracing costs no extra write.
+  """
+  def update_clause(self):
+    clause = f'{SPANS_ATTRIBUTE} = list_append(' \
+      f'if_not_exists({SPANS_ATTRIBUTE}, :trace_empty), :trace_spans)'
+    return clause, {':trace_empty': [], ':trace_spans': self.spans}
+
+
+class _Span(object):
+  def __init__(self, trace, hop):
+    self.trace = trace
+    self.hop = hop
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.trace.add(self.hop, self.start)
+
+
+"""Spans in time order with offsets from the first one, for display
+"""
+def timeline(spans):
+  spans = sorted(spans, key=lambda s: float(s['start']))
+  if not spans:
+    return []
+  origin = float(spans[0]['start'])
+  total = max(float(s['end']) for s in spans) - origin or 1.0
+  return [{
+    'hop': s['hop'],
+    'service': s.get('service', ''),
+    'offset': float(s['start']) - origin,
+    'secs': float(s['secs']),
+    'left_pct': 100.0 * (float(s['start']) - origin) / total,
+    'width_pct': max(0.5, 100.0 * float(s['secs']) / total)
+  } for s in spans]
+
+### EOF
@@ -0,0 +1,152 @@
+# cache.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Per-user read-through cache for job listings and job details
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+
+
+"""In-process store: {user_id: {key: (expires, value)}}
+Each invalidation bumps the user's generation; set() drops values that
+were loaded under an older generation.
+"""
+class MemoryStore(object):
+  def __init__(self, max_users=10000):
+    self.max_users = max_users
+    self.lock = threading.Lock()
+    self.users = {}
+    self.generations = {}
+
+  def generation(self, user_id):
+    with self.lock:
+      return self.generations.get(user_id, 0)
+
+  def get(self, user_id, key):
+    with self.lock:
+      return self.users.get(user_id, {}).get(key)
+
+  def set(self, user_id, key, entry, generation):
+    with self.lock:
+      if self.generations.get(user_id, 0) != generation:
+        return
+      if user_id not in self.users and len(self.users) >= self.max_users:
+        # drop the oldest user's entries (dicts keep insertion order)
+        self.users.pop(next(iter(self.users)))
+      self.users.setdefault(user_id, {})[key] = entry
+
+  def invalidate_user(self, user_id):
+    with self.lock:
+      self.users.pop(user_id, None)
+      self.generations[user_id] = self.generations.get(user_id, 0) + 1
+
+
+"""Store on local disk, shared by all web server worker processes
+One directory per user, one pickle per entry; writes and invalidations
+are renames, so readers never see partial files.
+"""
+class FileStore(object):
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+
+  def _user_dir(self, user_id):
+    return os.path.join(self.path, hashlib.sha1(user_id.encode()).hexdigest())
+
+  def _generation_path(self, user_id):
+    return self._user_dir(user_id) + '.generation'
+
+  def generation(self, user_id):
+    try:
+      with open(self._generation_path(user_id), 'r') as fh:
+        return fh.read()
+    except OSError:
+      return ''
+
+  def _entry_path(self, user_id, key):
+    return os.path.join(self._user_dir(user_id),
+      hashlib.sha1(repr(key).encode()).hexdigest())
+
+  def get(self, user_id, key):
+    try:
+      with open(self._entry_path(user_id, key), 'rb') as fh:
+        return pickle.load(fh)
+    except (OSError, pickle.PickleError, EOFError):
+      return None
+
+  def set(self, user_id, key, entry, generation):
+    if self.generation(user_id) != generation:
+      return
+    path = self._entry_path(user_id, key)
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(tmp, 'wb') as fh:
+        pickle.dump(entry, fh)
+      os.replace(tmp, path)
+    except OSError:
+      # caching is an optimisation; a failed write just means a miss
+      pass
+
+  def invalidate_user(self, user_id):
+    generation_path = self._generation_path(user_id)
+    tmp = f'{generation_path}.{uuid.uuid4().hex}.tmp'
+    try:
+      with open(tmp, 'w') as fh:
+        fh.write(uuid.uuid4().hex)
+      os.replace(tmp, generation_path)
+    except OSError:
+      pass
+    user_dir = self._user_dir(user_id)
+    doomed = f'{user_dir}.{uuid.uuid4().hex}.deleted'
+    try:
+      os.rename(user_dir, doomed)
+    except OSError:
+      return
+    shutil.rmtree(doomed, ignore_errors=True)
+
+
+"""Read-through cache of per-user values
+Entries expire after `ttl` seconds even if no invalidation arrives, so a
+lost status notification only delays an update. Each cache built by
+from_config() keeps its files in its own subdirectory of GAS_CACHE_DIR
+(`name`), so invalidating one cache leaves the others alone.
+"""
+class UserCache(object):
+  def __init__(self, store, ttl=30):
+    self.store = store
+    self.ttl = ttl
+
+  @classmethod
+  def from_config(cls, config, name, ttl=None):
+    path = config.get('GAS_CACHE_DIR')
+    store = FileStore(os.path.join(path, name)) if path else MemoryStore()
+    return cls(store, ttl=config['GAS_CACHE_TTL'] if ttl is None else ttl)
+
+  """Return the cached value for (user_id, key), calling load() on a miss
+  None is returned but not cached: whatever was missing may appear soon.
+  """
+  def get(self, user_id, key, load):
+    entry = self.store.get(user_id, key)
+    if entry is not None and entry[0] > time.time():
+      return entry[1]
+    generation = self.store.generation(user_id)
+    value = load()
+    if value is not None:
+      self.store.set(user_id, key, (time.time() + self.ttl, value), generation)
+    return value
+
+  def invalidate_user(self, user_id):
+    self.store.invalidate_user(user_id)
+
+### EOF
@@ -9,13 +9,16 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
-import boto3
+import sys
 import base64
 from botocore.exceptions import ClientError
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Cached Secrets Manager access shared with the other GAS modules
+sys.path.insert(1, os.path.join(basedir, os.path.pardir, 'util'))
+from secret_store import get_provider
+
 # Get the IAM username that was stashed at launch time
 try:
   with open('/home/ubuntu/.launch_user', 'r') as file:
@@ -49,13 +52,17 @@ class Config(object):
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-  # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+  # Get various credentials from AWS Secrets Manager (all three fetched
+  # concurrently, or read from the local cache when it is configured)
+  asm = get_provider()
+  try:
+    asm.get_many(['gas/web_server', 'rds/accounts_database', 'globus/auth_client'])
+  except ClientError as e:
+    print(f"Unable to retrieve credentials from ASM: {e}")
 
   # Get Flask application secret
   try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
+    flask_secret = asm.get('gas/web_server')
   except ClientError as e:
     print(f"Unable to retrieve Flask secret from ASM: {e}")
     raise e
@@ -63,8 +70,7 @@ class Config(object):
 
   # Get RDS secret and construct database URI
   try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
+    rds_secret = asm.get('rds/accounts_database')
   except ClientError as e:
     print(f"Unable to retrieve accounts database credentials from ASM: {e}")
     raise e
@@ -82,8 +88,7 @@ class Config(object):
 
   # Get the Globus Auth client ID and secret
   try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
+    globus_auth = asm.get('globus/auth_client')
   except ClientError as e:
     print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
     raise e
@@ -123,6 +128,14 @@ class Config(object):
     f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a17_job_requests"
   AWS_SNS_DID_UPGRADE_TOPIC = \
     f'arn:aws:sns:us-east-1:127134666975:{iam_username}_a17_did_upgrade'
+  # Job status changes published by the annotator; subscribe
+  # https://<web host>/annotations/status-events to it
+  AWS_SNS_JOB_STATUS_TOPIC = \
+    f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a17_job_status"
+  # Completed jobs; the archive utility waits out the free user retention
+  # period for each before archiving its results
+  AWS_SNS_RESULTS_READY_TOPIC = \
+    f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a17_results_ready"
   
 
   # AWS SQS queues
@@ -130,6 +143,14 @@ class Config(object):
 
   # AWS DynamoDB table
   AWS_DYNAMODB_ANNOTATIONS_TABLE = f"{iam_username}_annotations"
+  # GSI with partition key user_id and sort key submit_time, so a user's
+  # jobs can be read newest first, one page at a time
+  AWS_DYNAMODB_USER_INDEX = "user_id_index"
+  # Maps input ETag + reference data version to existing result/log keys
+  AWS_DYNAMODB_RESULTS_INDEX_TABLE = f"{iam_username}_results_index"
+
+  # Must match ANNOTATOR_REFERENCE_VERSION in ann/ann_config.ini
+  ANNOTATOR_REFERENCE_VERSION = "2019-01"
 
   # Use this email address to send email via SES
   MAIL_DEFAULT_SENDER = f"{iam_username}@ucmpcs.org"
@@ -137,6 +158,37 @@ class Config(object):
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
+  # Jobs per page on /annotations; ?limit= may ask for up to the maximum
+  ANNOTATIONS_PAGE_SIZE = 20
+  ANNOTATIONS_MAX_PAGE_SIZE = 100
+
+  # Files per batch submission, and how long its presigned POSTs stay
+  # valid (seconds; the browser uploads a few files at a time)
+  ANNOTATE_BATCH_MAX_FILES = 100
+  ANNOTATE_BATCH_EXPIRATION = 900
+
+  # Lines per page in the log and results viewers, default and maximum
+  ANNOTATION_VIEWER_LINES = 100
+  ANNOTATION_VIEWER_MAX_LINES = 1000
+
+  # Seconds a cached job listing/detail is served without a status event.
+  # Status events reach only the process that receives the SNS POST, so
+  # with more than one server process set GAS_CACHE_DIR: the caches are
+  # then kept on disk (one subdirectory each) and invalidated for all
+  GAS_CACHE_TTL = int(os.environ['GAS_CACHE_TTL']) \
+    if ('GAS_CACHE_TTL' in os.environ) else 30
+  GAS_CACHE_DIR = os.environ['GAS_CACHE_DIR'] \
+    if ('GAS_CACHE_DIR' in os.environ) else ""
+  # Job status event streams (see status_events.py; needs a single server
+  # process): open streams in total and per user; each holds one of
+  # uwsgi's 32 threads. Clients over the limit poll every
+  # GAS_STATUS_POLL_SECS seconds
+  GAS_STATUS_STREAMS_MAX = 8
+  GAS_STATUS_STREAMS_PER_USER = 2
+  GAS_STATUS_POLL_SECS = 10
+  # Seconds a user's role is cached (see profile_cache.py)
+  GAS_PROFILE_CACHE_TTL = 60
+
 class DevelopmentConfig(Config):
   DEBUG = True
   GAS_LOG_LEVEL = 'DEBUG'
@@ -0,0 +1,57 @@
+# cursors.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Page tokens for the annotations list
+#
+# A token is the DynamoDB LastEvaluatedKey of a page on the user index
+# (job_id, user_id, submit_time), base64-encoded JSON. Tokens come back
+# from the browser, so a token is only used if it has exactly that shape
+# and names the signed-in user.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import base64
+import json
+import math
+
+KEY_TYPES = {'job_id': 'S', 'user_id': 'S', 'submit_time': 'N'}
+
+
+"""Opaque page token for a DynamoDB LastEvaluatedKey
+"""
+def encode_cursor(last_key):
+  return base64.urlsafe_b64encode(json.dumps(last_key).encode()).decode()
+
+
+def _is_number(value):
+  try:
+    return math.isfinite(float(value))
+  except ValueError:
+    return False
+
+
+"""Decode a page token; None if it is malformed or for another user's jobs
+"""
+def decode_cursor(token, user_id):
+  try:
+    last_key = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+  except (ValueError, RecursionError):
+    # bad base64, non-ASCII token, bytes that are not UTF-8 or JSON (all
+    # ValueErrors), or JSON nested too deep to parse
+    return None
+  if not isinstance(last_key, dict) or set(last_key) != set(KEY_TYPES):
+    return None
+  for name, value_type in KEY_TYPES.items():
+    value = last_key[name]
+    if not isinstance(value, dict) or list(value) != [value_type] or \
+      not isinstance(value[value_type], str):
+      return None
+  if last_key['user_id']['S'] != user_id or \
+    not _is_number(last_key['submit_time']['N']):
+    return None
+  return last_key
+
+### EOF
@@ -11,8 +11,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 from flask import redirect, request, session, url_for
 from functools import wraps
 
-from app import db
-from models import Profile
+from profile_cache import get_role
 
 """Mark a route as requiring authentication
 """
@@ -38,13 +37,12 @@ Subscriber must have profile.role = premium_user
 def is_premium(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
-    # Check if user is a subscriber
-    profile = db.session.query(Profile).filter_by(
-      identity_id=session.get('primary_identity')).first()
-    if not profile:
+    # Check if user is a subscriber (role cached per identity)
+    role = get_role(session.get('primary_identity'))
+    if not role:
       # Force login
       return redirect(url_for('login', next=request.url))
-    elif (profile.role != "premium_user"):
+    elif (role != "premium_user"):
       # Redirect free user to subscribe
       return redirect(url_for('subscribe', next=request.url))
 
@@ -10,9 +10,10 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import re
 import json
+import time
 
 from flask import request, render_template
-from threading import Lock
+from threading import Lock, Thread
 
 import globus_sdk
 
@@ -55,16 +56,44 @@ def get_safe_redirect():
 """Grant access token to GAS app
 Uses the client_credentials grant to get access tokens 
 on the GAS's "client identity"
+
+Tokens are reused until they near expiry, so the common path is a
+lock-free read of the current token set. Within
+PORTAL_TOKEN_REFRESH_MARGIN seconds of expiry the old tokens are still
+returned while one background thread fetches new ones; only a caller
+finding no valid token at all waits on Globus Auth.
 """
+PORTAL_TOKEN_REFRESH_MARGIN = 300
+
 def get_portal_tokens(scopes=None):
   scopes = scopes or \
     ['openid','urn:globus:auth:scope:demo-resource-server:all']
-  with get_portal_tokens.lock:
-    if not get_portal_tokens.access_tokens:
-      get_portal_tokens.access_tokens = {}
-
-    scope_string = ' '.join(scopes)
+  scope_string = ' '.join(scopes)
+
+  # cached[scope_string] is replaced, never mutated, so reading it
+  # without the lock is safe
+  entry = get_portal_tokens.cached.get(scope_string)
+  now = time.time()
+  if entry and entry['expires_at'] - now > PORTAL_TOKEN_REFRESH_MARGIN:
+    return entry['access_tokens']
+  if entry and entry['expires_at'] > now:
+    if get_portal_tokens.lock.acquire(blocking=False):
+      Thread(target=_refresh_portal_tokens, args=(scope_string, True),
+        daemon=True).start()
+    return entry['access_tokens']
 
+  with get_portal_tokens.lock:
+    entry = get_portal_tokens.cached.get(scope_string)
+    if entry and entry['expires_at'] > time.time():
+      return entry['access_tokens']
+    return _refresh_portal_tokens(scope_string)
+
+"""Fetch new tokens for a scope string and publish them
+Called with get_portal_tokens.lock held; release_lock is for the
+background refresh, which owns the lock it was started with.
+"""
+def _refresh_portal_tokens(scope_string, release_lock=False):
+  try:
     client = load_portal_client()
     tokens = client.oauth2_client_credentials_tokens(
       requested_scopes=scope_string
@@ -73,18 +102,37 @@ def get_portal_tokens(scopes=None):
     # Walk all resource servers in the token response (includes the
     # top-level server, as found in tokens.resource_server), and store the
     # relevant Access Tokens
+    access_tokens = dict(get_portal_tokens.access_tokens or {})
     for resource_server, token_info in tokens.by_resource_server.items():
-      get_portal_tokens.access_tokens.update({
+      access_tokens.update({
         resource_server: {
           'token': token_info['access_token'],
           'scope': token_info['scope'],
           'expires_at': token_info['expires_at_seconds']
         }
       })
-
-    return get_portal_tokens.access_tokens
+    get_portal_tokens.access_tokens = access_tokens
+
+    # the set is as fresh as its soonest-expiring token
+    get_portal_tokens.cached = dict(get_portal_tokens.cached, **{
+      scope_string: {
+        'access_tokens': access_tokens,
+        'expires_at': min(t['expires_at_seconds']
+          for t in tokens.by_resource_server.values())
+      }
+    })
+    return access_tokens
+  except globus_sdk.GlobusError as e:
+    if not release_lock:
+      raise
+    # the current tokens are still valid; the next call tries again
+    app.logger.error(f'Unable to refresh portal tokens: {e}')
+  finally:
+    if release_lock:
+      get_portal_tokens.lock.release()
 
 get_portal_tokens.lock = Lock()
 get_portal_tokens.access_tokens = None
+get_portal_tokens.cached = {}
 
 ### EOF
\ No newline at end of file
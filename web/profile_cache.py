@@ -0,0 +1,39 @@
+# profile_cache.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Per-identity cache of user roles, so page loads and the is_premium
+# check do not query the accounts database every time
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from app import app, db
+from cache import UserCache
+from models import Profile
+
+# Short TTL: a role changed outside this app (another web server, the
+# accounts database directly) shows up within GAS_PROFILE_CACHE_TTL
+profile_cache = UserCache.from_config(app.config, 'profiles',
+  ttl=app.config['GAS_PROFILE_CACHE_TTL'])
+
+
+def _load_role(identity_id):
+  profile = db.session.query(Profile).filter_by(identity_id=identity_id).first()
+  return profile.role if profile else None
+
+
+"""Role of a user ("free_user" or "premium_user"), or None without a profile
+"""
+def get_role(identity_id):
+  return profile_cache.get(identity_id, 'role',
+    lambda: _load_role(identity_id))
+
+
+"""Drop the cached role; call after every update_profile()
+"""
+def invalidate_profile(identity_id):
+  profile_cache.invalidate_user(identity_id)
+
+### EOF
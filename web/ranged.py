@@ -0,0 +1,94 @@
+# ranged.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Line-oriented paging of S3 objects with ranged GETs
+#
+# Pages are addressed by byte offsets that always fall on line starts,
+# so "next N lines" and "previous N lines" each read only the blocks
+# around that page, never the whole object.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+BLOCK_SIZE = 64 * 1024
+
+# Upper bound on bytes read for a single page, however long its lines
+MAX_PAGE_BYTES = 4 * 1024 * 1024
+
+
+def object_size(s3_client, bucket, key):
+  return s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+
+def _get_range(s3_client, bucket, key, start, end):
+  response = s3_client.get_object(Bucket=bucket, Key=key,
+    Range=f'bytes={start}-{end - 1}')
+  return response['Body'].read()
+
+
+"""Up to `count` lines starting at byte `start`
+Returns (lines, end offset, truncated); end is where the next page starts.
+"""
+def read_forward(s3_client, bucket, key, size, start, count):
+  data = b''
+  position = start
+  while position < size and data.count(b'\n') < count \
+    and len(data) < MAX_PAGE_BYTES:
+    end = min(position + BLOCK_SIZE, size)
+    data += _get_range(s3_client, bucket, key, position, end)
+    position = end
+
+  lines = data.split(b'\n')
+  truncated = False
+  if len(lines) > count:
+    # keep whole lines only; the rest belongs to the next page
+    lines = lines[:count]
+    end = start + sum(len(l) + 1 for l in lines)
+  elif position < size:
+    # page cap reached inside a line
+    truncated = True
+    end = position
+  else:
+    if lines and lines[-1] == b'':
+      lines.pop()
+    end = size
+  return [l.decode(errors='replace') for l in lines], end, truncated
+
+
+"""Up to `count` lines ending at byte `end` (a line start, or the size)
+Returns (lines, start offset, truncated); start is where this page begins.
+"""
+def read_backward(s3_client, bucket, key, size, end, count):
+  if end <= 0:
+    return [], 0, False
+  data = b''
+  position = end
+  # a page of n lines needs n+1 newlines before `end`, the first one
+  # closing the line before the page
+  while position > 0 and data.count(b'\n') <= count \
+    and len(data) < MAX_PAGE_BYTES:
+    start = max(position - BLOCK_SIZE, 0)
+    data = _get_range(s3_client, bucket, key, start, position) + data
+    position = start
+
+  body = data[:-1] if data.endswith(b'\n') else data
+  lines = body.split(b'\n')
+  truncated = False
+  if len(lines) > count:
+    lines = lines[-count:]
+  elif position > 0:
+    # page cap reached inside a line
+    truncated = True
+  start = end - (len(data) - len(body)) - sum(len(l) + 1 for l in lines) + 1
+  return [l.decode(errors='replace') for l in lines], start, truncated
+
+
+"""Stream a whole object in BLOCK_SIZE ranged GETs
+"""
+def iter_object(s3_client, bucket, key, size):
+  for start in range(0, size, BLOCK_SIZE):
+    yield _get_range(s3_client, bucket, key, start, min(start + BLOCK_SIZE, size))
+
+### EOF
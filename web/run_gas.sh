@@ -31,10 +31,14 @@ fi
 
 LOG_TARGET=$GAS_WEB_APP_HOME/log/$GAS_LOG_FILE_NAME
 
+# One worker process with many threads: job status events are fanned out
+# to open pages in memory (see status_events.py), so do not add --processes
+
 if [ "$1" = "console" ]; then
   /home/ubuntu/.virtualenvs/mpcs/bin/uwsgi \
     --manage-script-name \
     --enable-threads \
+    --threads 32 \
     --vacuum \
     --log-master \
     --chdir $GAS_WEB_APP_HOME \
@@ -46,6 +50,7 @@ else
     --master \
     --manage-script-name \
     --enable-threads \
+    --threads 32 \
     --vacuum \
     --log-master \
     --chdir $GAS_WEB_APP_HOME \
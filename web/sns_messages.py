@@ -0,0 +1,113 @@
+# sns_messages.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Authenticity checks for SNS HTTPS deliveries
+#
+# SNS signs every message it POSTs to a subscribed endpoint with the key
+# of a certificate it serves from sns.<region>.amazonaws.com. A message
+# is only trusted when that certificate comes from the topic's own region
+# over HTTPS and the signature over the message fields checks out; the
+# SubscribeURL of a confirmation must point at the same host. Needs the
+# cryptography package: without it every message is rejected.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import base64
+import threading
+import urllib.request
+from urllib.parse import urlparse
+
+try:
+  from cryptography import x509
+  from cryptography.exceptions import InvalidSignature
+  from cryptography.hazmat.primitives import hashes
+  from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+  x509 = None
+
+# Fields covered by the signature, in signing order
+SIGNED_FIELDS = {
+  'Notification': ('Message', 'MessageId', 'Subject', 'Timestamp',
+    'TopicArn', 'Type'),
+  'SubscriptionConfirmation': ('Message', 'MessageId', 'SubscribeURL',
+    'Timestamp', 'Token', 'TopicArn', 'Type'),
+  'UnsubscribeConfirmation': ('Message', 'MessageId', 'SubscribeURL',
+    'Timestamp', 'Token', 'TopicArn', 'Type'),
+}
+
+_certificates = {}
+_certificates_lock = threading.Lock()
+
+
+"""Region of an SNS topic ARN (arn:aws:sns:<region>:<account>:<name>)
+"""
+def topic_region(topic_arn):
+  parts = (topic_arn or '').split(':')
+  return parts[3] if len(parts) == 6 and parts[2] == 'sns' else None
+
+
+"""True if url is an HTTPS URL on exactly sns.<region>.amazonaws.com
+"""
+def is_sns_url(url, region):
+  try:
+    parsed = urlparse(url or '')
+    port = parsed.port
+  except ValueError:
+    return False
+  return bool(region) and parsed.scheme == 'https' and \
+    port in (None, 443) and not parsed.username and not parsed.password and \
+    parsed.hostname == f'sns.{region}.amazonaws.com'
+
+
+def _certificate(url):
+  with _certificates_lock:
+    if url in _certificates:
+      return _certificates[url]
+  with urllib.request.urlopen(url, timeout=10) as response:
+    certificate = x509.load_pem_x509_certificate(response.read())
+  with _certificates_lock:
+    _certificates[url] = certificate
+  return certificate
+
+
+def _string_to_sign(envelope):
+  fields = SIGNED_FIELDS.get(envelope.get('Type'))
+  if fields is None:
+    return None
+  parts = []
+  for field in fields:
+    value = envelope.get(field)
+    if value is None:
+      if field == 'Subject':
+        continue
+      return None
+    parts.append(f'{field}\n{value}\n')
+  return ''.join(parts).encode('utf-8')
+
+
+"""True if envelope was signed by SNS in the given region
+The signing certificate is fetched (once per URL) only from that
+region's SNS host; SignatureVersion 1 is SHA1, 2 is SHA256.
+"""
+def verify_message(envelope, region):
+  if x509 is None:
+    return False
+  algorithm = {'1': hashes.SHA1, '2': hashes.SHA256} \
+    .get(str(envelope.get('SignatureVersion')))
+  signed = _string_to_sign(envelope)
+  if algorithm is None or signed is None or \
+    not is_sns_url(envelope.get('SigningCertURL'), region):
+    return False
+  try:
+    signature = base64.b64decode(envelope.get('Signature', ''), validate=True)
+    certificate = _certificate(envelope['SigningCertURL'])
+    certificate.public_key().verify(signature, signed,
+      padding.PKCS1v15(), algorithm())
+    return True
+  except (InvalidSignature, OSError, ValueError, TypeError):
+    return False
+
+### EOF
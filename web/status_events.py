@@ -0,0 +1,146 @@
+# status_events.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# In-process fan-out of job status changes to server-sent event streams
+#
+# The annotator publishes every status change to the job_status SNS topic
+# (see annotation_status_events() in views.py); each change is handed to
+# the streams of the job's owner, so open pages update without reading
+# DynamoDB.
+#
+# Subscribers are kept in memory, so this assumes a single server process:
+# run_gas.sh starts one uwsgi worker with a thread per request, and every
+# stream sees every event. With several worker processes a stream would
+# only see the events POSTed to its own process, and the others would
+# show up when the page is reloaded; keep --processes at 1 (the job and
+# role caches can be shared through GAS_CACHE_DIR, this broker cannot).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import collections
+import json
+import threading
+import time
+
+
+"""Recent status events per user
+Events get increasing ids; a stream resumes from the last id it sent
+(the browser's Last-Event-ID) or from a timestamp, so changes that land
+between rendering a page and opening its stream are not lost.
+
+Every open stream holds a request thread, so at most max_streams are
+open in this process and max_user_streams per user; clients over the
+limit poll instead (see event_stream()).
+"""
+class StatusBroker(object):
+  def __init__(self, history_secs=300, max_history=100, max_streams=8,
+    max_user_streams=2):
+    self.history_secs = history_secs
+    self.max_history = max_history
+    self.max_streams = max_streams
+    self.max_user_streams = max_user_streams
+    self.changed = threading.Condition()
+    self.events = {}
+    self.last_id = 0
+    self.streams = collections.Counter()
+
+  @classmethod
+  def from_config(cls, config):
+    return cls(max_streams=config['GAS_STATUS_STREAMS_MAX'],
+      max_user_streams=config['GAS_STATUS_STREAMS_PER_USER'])
+
+  """Reserve a stream slot for user_id; False if none is free
+  """
+  def open_stream(self, user_id):
+    with self.changed:
+      if sum(self.streams.values()) >= self.max_streams or \
+        self.streams[user_id] >= self.max_user_streams:
+        return False
+      self.streams[user_id] += 1
+      return True
+
+  def close_stream(self, user_id):
+    with self.changed:
+      self.streams[user_id] -= 1
+      if self.streams[user_id] <= 0:
+        del self.streams[user_id]
+
+  def _prune(self, user_id, now):
+    events = self.events.get(user_id)
+    while events and events[0]['received_at'] < now - self.history_secs:
+      events.popleft()
+    if events is not None and not events:
+      del self.events[user_id]
+
+  def publish(self, user_id, event):
+    now = time.time()
+    with self.changed:
+      self.last_id += 1
+      self.events.setdefault(user_id,
+        collections.deque(maxlen=self.max_history)).append(
+          dict(event, id=self.last_id, received_at=now))
+      self._prune(user_id, now)
+      self.changed.notify_all()
+
+  def _pending(self, user_id, after_id, since):
+    return [e for e in self.events.get(user_id, ())
+      if e['id'] > after_id and e['received_at'] >= since]
+
+  """Events for user_id newer than after_id (and not older than since)
+  Blocks up to `timeout` seconds; returns [] if nothing arrived.
+  """
+  def wait(self, user_id, after_id=0, since=0, timeout=15):
+    deadline = time.time() + timeout
+    with self.changed:
+      while True:
+        pending = self._pending(user_id, after_id, since)
+        remaining = deadline - time.time()
+        if pending or remaining <= 0:
+          return pending
+        self.changed.wait(remaining)
+
+
+def _status_events(events, job_id):
+  for event in events:
+    if job_id and event.get('job_id') != job_id:
+      continue
+    data = {k: event.get(k) for k in ('job_id', 'job_status', 'time')}
+    yield f'id: {event["id"]}\nevent: status\ndata: {json.dumps(data)}\n\n'
+
+
+"""Server-sent event stream of one user's status changes
+Sends a comment every `keepalive` seconds so proxies keep the connection
+open, and ends after `max_secs`; the browser then reconnects with
+Last-Event-ID, which frees the request thread now and then. Without a
+free stream slot the response only carries the events already pending
+and asks the browser to come back in `poll_secs`, so it polls without
+tying up a thread.
+"""
+def event_stream(broker, user_id, after_id=0, since=0, job_id=None,
+  keepalive=15, max_secs=300, poll_secs=10):
+  if after_id > broker.last_id:
+    # id from before a restart of this process
+    after_id = 0
+  if not broker.open_stream(user_id):
+    yield f'retry: {int(poll_secs * 1000)}\n\n'
+    yield from _status_events(broker.wait(user_id, after_id, since, timeout=0), job_id)
+    return
+
+  try:
+    yield 'retry: 2000\n\n'
+    ends_at = time.time() + max_secs
+    while time.time() < ends_at:
+      events = broker.wait(user_id, after_id, since,
+        timeout=min(keepalive, ends_at - time.time()))
+      if not events:
+        yield ': keepalive\n\n'
+        continue
+      after_id = events[-1]['id']
+      yield from _status_events(events, job_id)
+  finally:
+    broker.close_stream(user_id)
+
+### EOF
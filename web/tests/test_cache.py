@@ -0,0 +1,127 @@
+# test_cache.py
+#
+# UserCache (cache.py) over the in-process and on-disk stores: expiry,
+# invalidation, and loads that race with an invalidation
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir))
+import cache
+from cache import FileStore, MemoryStore, UserCache
+
+
+@pytest.fixture(params=['memory', 'file'])
+def store(request, tmp_path):
+  return MemoryStore() if request.param == 'memory' else FileStore(str(tmp_path))
+
+
+class Loader(object):
+  def __init__(self, value):
+    self.value = value
+    self.calls = 0
+
+  def __call__(self):
+    self.calls += 1
+    return self.value
+
+
+def test_hits_until_invalidated(store):
+  user_cache = UserCache(store, ttl=30)
+  load = Loader(['job-1'])
+  assert user_cache.get('alice', ('list', 10), load) == ['job-1']
+  assert user_cache.get('alice', ('list', 10), load) == ['job-1']
+  assert load.calls == 1
+
+  load.value = ['job-1', 'job-2']
+  user_cache.invalidate_user('alice')
+  assert user_cache.get('alice', ('list', 10), load) == ['job-1', 'job-2']
+  assert load.calls == 2
+
+
+def test_invalidation_is_per_user(store):
+  user_cache = UserCache(store, ttl=30)
+  alice, bob = Loader('a'), Loader('b')
+  user_cache.get('alice', 'k', alice)
+  user_cache.get('bob', 'k', bob)
+  user_cache.invalidate_user('alice')
+  user_cache.get('alice', 'k', alice)
+  user_cache.get('bob', 'k', bob)
+  assert (alice.calls, bob.calls) == (2, 1)
+
+
+def test_load_racing_an_invalidation_is_not_cached(store):
+  user_cache = UserCache(store, ttl=30)
+  # the status changes while the old listing is being read
+  def stale_load():
+    user_cache.invalidate_user('alice')
+    return 'stale'
+  assert user_cache.get('alice', 'k', stale_load) == 'stale'
+  fresh = Loader('fresh')
+  assert user_cache.get('alice', 'k', fresh) == 'fresh'
+  assert user_cache.get('alice', 'k', fresh) == 'fresh'
+  assert fresh.calls == 1
+
+
+def test_entries_expire(store, monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+  user_cache = UserCache(store, ttl=30)
+  load = Loader('v')
+  user_cache.get('alice', 'k', load)
+  now[0] += 29
+  user_cache.get('alice', 'k', load)
+  assert load.calls == 1
+  now[0] += 2
+  user_cache.get('alice', 'k', load)
+  assert load.calls == 2
+
+
+def test_none_is_not_cached(store):
+  user_cache = UserCache(store, ttl=30)
+  load = Loader(None)
+  assert user_cache.get('alice', 'k', load) is None
+  assert user_cache.get('alice', 'k', load) is None
+  assert load.calls == 2
+
+
+def test_memory_store_drops_oldest_user():
+  user_cache = UserCache(MemoryStore(max_users=2), ttl=30)
+  loads = {user: Loader(user) for user in ('a', 'b', 'c')}
+  for user in ('a', 'b', 'c'):
+    user_cache.get(user, 'k', loads[user])
+  # a was dropped to make room for c
+  for user in ('b', 'c', 'a'):
+    user_cache.get(user, 'k', loads[user])
+  assert [loads[u].calls for u in ('a', 'b', 'c')] == [2, 1, 1]
+
+
+def test_file_store_is_shared_between_processes(tmp_path):
+  # two server processes, each with its own FileStore on one directory
+  first = UserCache(FileStore(str(tmp_path)), ttl=30)
+  second = UserCache(FileStore(str(tmp_path)), ttl=30)
+  load = Loader('v')
+  first.get('alice', 'k', load)
+  second.get('alice', 'k', load)
+  assert load.calls == 1
+  second.invalidate_user('alice')
+  first.get('alice', 'k', load)
+  assert load.calls == 2
+
+
+def test_named_caches_are_independent(tmp_path):
+  config = {'GAS_CACHE_DIR': str(tmp_path), 'GAS_CACHE_TTL': 30}
+  jobs = UserCache.from_config(config, 'jobs')
+  profiles = UserCache.from_config(config, 'profiles', ttl=60)
+  role = Loader('premium_user')
+  profiles.get('alice', 'role', role)
+  jobs.invalidate_user('alice')
+  profiles.get('alice', 'role', role)
+  assert role.calls == 1
+  assert (jobs.ttl, profiles.ttl) == (30, 60)
+
+### EOF
@@ -0,0 +1,71 @@
+# test_cursors.py
+#
+# Page tokens of the annotations list (cursors.py): valid tokens round
+# trip, anything tampered with or malformed is rejected
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import base64
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir))
+from cursors import decode_cursor, encode_cursor
+
+USER_ID = '8a4f0e4c-5ed1-4b42-9fb9-0a2d8d3f6d11'
+LAST_KEY = {'job_id': {'S': 'b47c4e9f-2603-43d2-8b1e-bab2fb9462b9'},
+  'user_id': {'S': USER_ID}, 'submit_time': {'N': '1681234567.123'}}
+
+
+def token(value):
+  return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def test_round_trip():
+  assert decode_cursor(encode_cursor(LAST_KEY), USER_ID) == LAST_KEY
+
+
+def test_token_is_url_safe():
+  cursor = encode_cursor(dict(LAST_KEY, job_id={'S': '>>>???~~~'}))
+  assert not set(cursor) & set('+/')
+
+
+def test_other_users_token():
+  assert decode_cursor(encode_cursor(LAST_KEY), 'someone-else') is None
+
+
+@pytest.mark.parametrize('cursor', [
+  '',
+  'not base64!',
+  'e30',                                  # '{}' without padding
+  base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+  base64.urlsafe_b64encode(b'{"user_id": ').decode(),
+  'ÿÿÿÿ',
+  token('[' * 100000 + ']' * 100000),
+])
+def test_malformed_tokens(cursor):
+  assert decode_cursor(cursor, USER_ID) is None
+
+
+@pytest.mark.parametrize('last_key', [
+  None,
+  [LAST_KEY],
+  'user_id',
+  {},
+  {'user_id': {'S': USER_ID}},
+  dict(LAST_KEY, extra={'S': 'x'}),
+  dict(LAST_KEY, user_id=USER_ID),
+  dict(LAST_KEY, user_id={'S': USER_ID, 'N': '1'}),
+  dict(LAST_KEY, job_id={'N': '1'}),
+  dict(LAST_KEY, job_id={'S': 5}),
+  dict(LAST_KEY, submit_time={'S': '1681234567'}),
+  dict(LAST_KEY, submit_time={'N': 'soon'}),
+  dict(LAST_KEY, submit_time={'N': 'nan'}),
+])
+def test_tampered_keys(last_key):
+  assert decode_cursor(token(last_key), USER_ID) is None
+
+### EOF
@@ -8,9 +8,13 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import sys
 import uuid
 import time
 import json
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 from datetime import datetime
 
@@ -19,13 +23,36 @@ from botocore.client import Config
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
-from flask import (abort, flash, redirect, render_template, 
-  request, session, url_for)
+from flask import (abort, flash, jsonify, redirect, render_template, 
+  request, session, url_for, Response)
 
 from app import app, db
 from decorators import authenticated, is_premium
 
-from auth import update_profile, get_profile
+from auth import update_profile
+from profile_cache import get_role, invalidate_profile
+from cache import UserCache
+from cursors import encode_cursor, decode_cursor
+from status_events import StatusBroker, event_stream
+import sns_messages
+
+# Import shared job tracing helpers from util
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'util'))
+import tracing
+import ranged
+
+# Job listings and details, per user; see annotation_status_events()
+job_cache = UserCache.from_config(app.config, 'jobs')
+# Status changes for open pages; see annotation_events()
+status_broker = StatusBroker.from_config(app.config)
+
+# serialize Decimal object
+# referring to: https://stackoverflow.com/questions/63278737/object-of-type-decimal-is-not-json-serializable
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+        return json.JSONEncoder.default(self, obj)
 
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
@@ -49,7 +76,8 @@ def annotate():
   key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
     str(uuid.uuid4()) + '~${filename}'
 
-  # Create the redirect URL
+  # Create the redirect URL; the page adds the time the form is submitted
+  # (upload_start) so the job trace includes the browser-to-S3 upload
   redirect_url = str(request.url) + "/job"
 
   # Define policy conditions
@@ -78,8 +106,8 @@ def annotate():
     app.logger.error(f'Unable to generate presigned URL for upload: {e}')
     return abort(500)
   
-  # Get user profile
-  role = get_profile(identity_id=session.get('primary_identity')).role
+  # Get user role (cached; see profile_cache.py)
+  role = get_role(session.get('primary_identity'))
 
   # Render the upload form which will parse/submit the presigned POST
   return render_template('annotate.html',
@@ -107,6 +135,7 @@ def create_annotation_job_request():
   # Parse redirect URL query parameters for S3 object info
   bucket = request.args.get('bucket')
   key = request.args.get('key')
+  upload_start = request.args.get('upload_start', type=float)
   _, user_id, job_id_w_file_name = key.split('/')
   job_id, file_name = job_id_w_file_name.split('~')
 
@@ -114,6 +143,21 @@ def create_annotation_job_request():
   if file_name == "":
     return abort(409)
 
+  # The ETag decides which results can be reused and is indexed for later
+  # jobs, so take it from S3: the redirect's query string can be edited
+  try:
+    etag = boto3.client('s3', region_name=app.config['AWS_REGION_NAME']).head_object(
+      Bucket=app.config['AWS_S3_INPUTS_BUCKET'], Key=key)['ETag'].strip('"')
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+      return abort(404)
+    app.logger.error(f'Unable to get ETag of input {key}: {e}')
+    etag = None
+
+  # Start the job's trace with the upload that led here
+  trace = tracing.Trace(service='web')
+  trace.add('s3_upload', upload_start)
+
   # Update job status to PENDING on dynamodb
   data = {
     "job_id": job_id, 
@@ -124,59 +168,534 @@ def create_annotation_job_request():
     "submit_time": Decimal(time.time()),
     "job_status": "PENDING" 
   }
+  if etag:
+    data["input_etag"] = etag
+  data["trace_id"] = trace.trace_id
 
   dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
   table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
 
+  # Identical input already annotated against the same reference data:
+  # complete the job from the existing results instead of re-running it
+  previous = find_reusable_results(etag) if etag else None
+  if previous:
+    try:
+      with trace.span('reuse_results'):
+        completed = dict(data, 
+          **copy_reusable_results(previous, user_id, job_id, file_name))
+      completed[tracing.SPANS_ATTRIBUTE] = trace.spans
+      table.put_item(Item = completed)
+    except ClientError as e:
+      # fall back to running the annotator
+      app.logger.error(f'Unable to reuse results of job {previous["job_id"]}: {e}')
+    else:
+      app.logger.info(f'Job {job_id} reused results of job {previous["job_id"]}')
+      job_cache.invalidate_user(user_id)
+      try:
+        start_archive_timer(user_id, job_id, completed, trace)
+      except ClientError as e:
+        app.logger.error(f'Unable to start archive timer for job {job_id}: {e}')
+      return render_template('annotate_confirm.html', job_id=job_id)
+
   try:
-    table.put_item(Item = data)
+    with trace.span('dynamodb_put'):
+      table.put_item(Item = data)
   except ClientError as e:
     app.logger.error(f'Unable to persist job to database: {e}')
     return abort(500)
+  job_cache.invalidate_user(user_id)
   
   # publish a notification to SNS
-  # serialize Decimal object
-  # referring to: https://stackoverflow.com/questions/63278737/object-of-type-decimal-is-not-json-serializable
-  class DecimalEncoder(json.JSONEncoder):
-      def default(self, obj):
-          if isinstance(obj, Decimal):
-              return str(obj)
-          return json.JSONEncoder.default(self, obj)
-      
   sns_client = boto3.client("sns", region_name=app.config['AWS_REGION_NAME'])
   topicArn = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
   try:
-    sns_client.publish(TopicArn = topicArn,
-                       Message = json.dumps(data, cls=DecimalEncoder),
-                       )
+    with trace.span('sns_publish'):
+      sns_client.publish(TopicArn = topicArn,
+                         Message = json.dumps(dict(data, trace=trace.handoff()), cls=DecimalEncoder),
+                         )
   except ClientError as e:
     app.logger.error(f'Unable to send job to queue: {e}')
     return abort(500)
 
+  # record the web tier spans; the annotator appends its own
+  record_trace_spans(table, job_id, trace)
+
   return render_template('annotate_confirm.html', job_id=job_id)
 
 
-"""List all annotations for the user
+"""Start a batch annotation request
+Renders a form for selecting many input files; the browser then asks
+for one presigned POST per file, uploads them directly to S3 and submits
+the whole batch in one request.
+"""
+@app.route('/annotate/batch', methods=['GET'])
+@authenticated
+def annotate_batch():
+  return render_template('annotate_batch.html',
+    max_files=app.config['ANNOTATE_BATCH_MAX_FILES'])
+
+
+"""Issue presigned POSTs for every file of a batch
+Expects JSON {"files": [file names]}; returns the batch ID and, per
+file, its job ID plus the URL and fields of its presigned POST.
+"""
+@app.route('/annotate/batch/uploads', methods=['POST'])
+@authenticated
+def create_batch_uploads():
+  body = request.get_json(silent=True) or {}
+  file_names = body.get('files')
+  if not isinstance(file_names, list) or not file_names or \
+    len(file_names) > app.config['ANNOTATE_BATCH_MAX_FILES']:
+    abort(400)
+  if not all(valid_input_file_name(f) for f in file_names):
+    abort(400)
+
+  s3 = boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
+  user_id = session['primary_identity']
+  encryption = app.config['AWS_S3_ENCRYPTION']
+  acl = app.config['AWS_S3_ACL']
+  # the browser uploads with XHR, so S3 answers 201 instead of redirecting
+  fields = {
+    "success_action_status": "201",
+    "x-amz-server-side-encryption": encryption,
+    "acl": acl
+  }
+  conditions = [
+    {"success_action_status": "201"},
+    {"x-amz-server-side-encryption": encryption},
+    {"acl": acl}
+  ]
+
+  batch_id = str(uuid.uuid4())
+  uploads = []
+  try:
+    for file_name in file_names:
+      job_id = str(uuid.uuid4())
+      presigned_post = s3.generate_presigned_post(
+        Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+        Key=input_file_key(user_id, job_id, file_name),
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=app.config['ANNOTATE_BATCH_EXPIRATION'])
+      uploads.append({'job_id': job_id, 'file_name': file_name,
+        'url': presigned_post['url'], 'fields': presigned_post['fields']})
+    # remember which job IDs were issued; only those can be submitted
+    s3.put_object(Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+      Key=batch_manifest_key(user_id, batch_id),
+      Body=json.dumps({
+        'batch_id': batch_id,
+        'issued': [{'job_id': u['job_id'], 'input_file_name': u['file_name']}
+          for u in uploads]}).encode(),
+      ServerSideEncryption=encryption)
+  except ClientError as e:
+    app.logger.error(f'Unable to generate presigned URLs for batch upload: {e}')
+    abort(500)
+
+  return jsonify({'batch_id': batch_id, 'uploads': uploads}), 200
+
+
+"""Submit the uploaded files of a batch as annotation jobs
+Expects JSON {"jobs": [{"job_id", "upload_start"}]} for the files that
+reached S3. Only job IDs issued for this batch by /annotate/batch/uploads
+are accepted, each input must exist in S3 (its ETag is taken from S3,
+never from the client) and a job item is only created if none exists.
+Jobs are announced with SNS publish_batch, 10 entries per call. The job
+IDs are kept in the manifest for the batch status page.
+"""
+@app.route('/annotate/batch/<batch_id>/submit', methods=['POST'])
+@authenticated
+def submit_annotation_batch(batch_id):
+  body = request.get_json(silent=True) or {}
+  jobs = body.get('jobs')
+  if not valid_uuid(batch_id) or not isinstance(jobs, list) or not jobs or \
+    len(jobs) > app.config['ANNOTATE_BATCH_MAX_FILES']:
+    abort(400)
+
+  user_id = session['primary_identity']
+  bucket = app.config['AWS_S3_INPUTS_BUCKET']
+  s3_client = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  manifest_key = batch_manifest_key(user_id, batch_id)
+  try:
+    manifest = json.loads(s3_client.get_object(Bucket=bucket,
+      Key=manifest_key)['Body'].read())
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+      abort(404)
+    app.logger.error(f'Unable to get batch {batch_id}: {e}')
+    abort(500)
+  if 'jobs' in manifest:
+    # already submitted
+    abort(409)
+  issued = {job['job_id']: job['input_file_name'] for job in manifest['issued']}
+
+  requested = {}
+  for job in jobs:
+    job_id = job.get('job_id') if isinstance(job, dict) else None
+    if job_id not in issued:
+      abort(400)
+    requested[job_id] = job.get('upload_start')
+
+  # inputs that never reached S3 are not queued
+  etags = head_input_files(s3_client, bucket,
+    {job_id: input_file_key(user_id, job_id, issued[job_id]) for job_id in requested})
+
+  items, messages, not_uploaded = [], [], []
+  for job_id, upload_start in requested.items():
+    if etags.get(job_id) is None:
+      not_uploaded.append(job_id)
+      continue
+    file_name = issued[job_id]
+    trace = tracing.Trace(service='web')
+    if isinstance(upload_start, (int, float)):
+      trace.add('s3_upload', upload_start)
+    data = {
+      "job_id": job_id,
+      "user_id": user_id,
+      "batch_id": batch_id,
+      "input_file_name": file_name,
+      "s3_inputs_bucket": bucket,
+      "s3_key_input_file": input_file_key(user_id, job_id, file_name),
+      "submit_time": Decimal(time.time()),
+      "job_status": "PENDING",
+      "trace_id": trace.trace_id,
+      "input_etag": etags[job_id]
+    }
+    items.append(dict(data, **{tracing.SPANS_ATTRIBUTE: trace.spans}))
+    messages.append(json.dumps(dict(data, trace=trace.handoff()),
+      cls=DecimalEncoder))
+
+  try:
+    existing = put_new_jobs(items)
+  except ClientError as e:
+    app.logger.error(f'Unable to persist batch {batch_id} to database: {e}')
+    abort(500)
+  # jobs that already exist (a concurrent submit) are left alone
+  rejected = [items[n]['job_id'] for n in sorted(existing)]
+  messages = [m for n, m in enumerate(messages) if n not in existing]
+  items = [i for n, i in enumerate(items) if n not in existing]
+  if rejected:
+    app.logger.error(f'{len(rejected)} jobs of batch {batch_id} already exist')
+
+  if items:
+    try:
+      s3_client.put_object(Bucket=bucket, Key=manifest_key,
+        Body=json.dumps(dict(manifest,
+          submit_time=time.time(),
+          jobs=[{'job_id': i['job_id'], 'input_file_name': i['input_file_name']}
+            for i in items])).encode(),
+        ServerSideEncryption=app.config['AWS_S3_ENCRYPTION'])
+    except ClientError as e:
+      app.logger.error(f'Unable to persist batch {batch_id} manifest: {e}')
+      abort(500)
+  job_cache.invalidate_user(user_id)
+
+  failed = publish_job_batch(messages)
+  if failed:
+    app.logger.error(f'Unable to send {len(failed)} jobs of batch {batch_id} to queue')
+
+  return jsonify({
+    'batch_id': batch_id,
+    'submitted': len(items) - len(failed),
+    'failed': [items[i]['job_id'] for i in failed] + not_uploaded + rejected,
+    'status_url': url_for('annotation_batch', batch_id=batch_id)
+  }), 200
+
+
+"""Show the status of every job in a batch
+"""
+@app.route('/annotate/batch/<batch_id>', methods=['GET'])
+@authenticated
+def annotation_batch(batch_id):
+  if not valid_uuid(batch_id):
+    abort(404)
+  user_id = session['primary_identity']
+  try:
+    jobs = job_cache.get(user_id, ('batch', batch_id),
+      lambda: get_batch_jobs(user_id, batch_id))
+  except ClientError as e:
+    code = e.response['Error']['Code']
+    if code in ('NoSuchKey', '404'):
+      abort(404)
+    app.logger.error(f'Unable to get batch {batch_id}: {e}')
+    abort(500)
+
+  counts = {}
+  for job in jobs:
+    counts[job['job_status']] = counts.get(job['job_status'], 0) + 1
+  return render_template('annotation_batch.html', batch_id = batch_id,
+    jobs = jobs, counts = counts, rendered_at = time.time())
+
+
+def valid_uuid(value):
+  try:
+    return str(uuid.UUID(value)) == value
+  except (TypeError, ValueError, AttributeError):
+    return False
+
+
+"""File names that fit the <job_id>~<file name> input key scheme
+"""
+def valid_input_file_name(file_name):
+  return isinstance(file_name, str) and file_name.endswith('.vcf') and \
+    len(file_name) > 4 and len(file_name) <= 255 and \
+    '/' not in file_name and '~' not in file_name
+
+
+def input_file_key(user_id, job_id, file_name):
+  return app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + job_id + '~' + file_name
+
+
+def batch_manifest_key(user_id, batch_id):
+  return app.config['AWS_S3_KEY_PREFIX'] + user_id + '/batches/' + batch_id + '.json'
+
+
+"""ETag of each input file, from S3; None for files that are missing
+Takes {job_id: key}; the HEAD requests run concurrently.
+"""
+def head_input_files(s3_client, bucket, keys):
+  def head(key):
+    try:
+      return s3_client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+        return None
+      raise
+  job_ids = list(keys)
+  with ThreadPoolExecutor(max_workers=16) as pool:
+    return dict(zip(job_ids, pool.map(head, [keys[j] for j in job_ids])))
+
+
+"""Create job items, never overwriting an existing job
+Conditional puts (batch_write_item cannot take conditions), several at a
+time. Returns the indexes of items whose job_id already existed.
+"""
+def put_new_jobs(items):
+  dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  def put(item):
+    try:
+      table.put_item(Item=item, ConditionExpression='attribute_not_exists(job_id)')
+      return False
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+        return True
+      raise
+  with ThreadPoolExecutor(max_workers=16) as pool:
+    return {n for n, exists in enumerate(pool.map(put, items)) if exists}
+
+
+"""Publish job request messages with SNS publish_batch, 10 per call
+Failed entries are retried once; returns the indexes still failing.
+"""
+def publish_job_batch(messages):
+  sns_client = boto3.client("sns", region_name=app.config['AWS_REGION_NAME'])
+  topic_arn = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
+  pending = list(range(len(messages)))
+  for attempt in range(2):
+    failed = []
+    for i in range(0, len(pending), 10):
+      chunk = pending[i:i + 10]
+      try:
+        response = sns_client.publish_batch(TopicArn=topic_arn,
+          PublishBatchRequestEntries=[{'Id': str(n), 'Message': messages[n]}
+            for n in chunk])
+        failed += [int(f['Id']) for f in response.get('Failed', [])]
+      except ClientError as e:
+        app.logger.error(f'Unable to publish job batch: {e}')
+        failed += chunk
+    pending = failed
+    if not pending:
+      break
+  return pending
+
+
+"""Jobs of a batch, in submission order, from its manifest
+"""
+def get_batch_jobs(user_id, batch_id):
+  s3_client = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  response = s3_client.get_object(Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+    Key=batch_manifest_key(user_id, batch_id))
+  manifest = json.loads(response['Body'].read())
+
+  dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
+  statuses = {}
+  # a batch whose files are still uploading has no jobs yet
+  manifest.setdefault('jobs', [])
+  job_ids = [job['job_id'] for job in manifest['jobs']]
+  for i in range(0, len(job_ids), 100):
+    request_items = {table_name: {
+      'Keys': [{'job_id': job_id} for job_id in job_ids[i:i + 100]],
+      'ProjectionExpression': 'job_id, job_status'}}
+    for attempt in range(5):
+      response = dynamodb_resource.batch_get_item(RequestItems=request_items)
+      for item in response['Responses'].get(table_name, []):
+        statuses[item['job_id']] = item['job_status']
+      request_items = response.get('UnprocessedKeys')
+      if not request_items:
+        break
+      time.sleep(0.05 * 2 ** attempt)
+
+  # jobs whose SNS message failed never got further than PENDING
+  return [dict(job, job_status=statuses.get(job['job_id'], 'UNKNOWN'))
+    for job in manifest['jobs']]
+
+
+"""Append a hop's trace spans to the job item
+Tracing is best effort: failures are logged, never surfaced to the user.
+"""
+def record_trace_spans(table, job_id, trace):
+  clause, values = trace.update_clause()
+  try:
+    table.update_item(
+      Key={'job_id': job_id},
+      UpdateExpression='SET ' + clause,
+      ExpressionAttributeValues=values)
+  except ClientError as e:
+    app.logger.warning(f'Unable to record trace spans for job {job_id}: {e}')
+
+
+"""Look up results already produced for an identical input file
+The results index is keyed by input ETag and reference data version.
+Returns the index entry only if its result and log objects are still in
+S3 (free user results may have been archived to Glacier since).
+"""
+def find_reusable_results(etag):
+  dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  index_table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_RESULTS_INDEX_TABLE'])
+  s3_client = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  try:
+    response = index_table.get_item(
+      Key={'content_key': f"{etag}:{app.config['ANNOTATOR_REFERENCE_VERSION']}"})
+    entry = response.get('Item')
+    if not entry:
+      return None
+    for s3_key in (entry['s3_key_result_file'], entry['s3_key_log_file']):
+      s3_client.head_object(Bucket=entry['s3_results_bucket'], Key=s3_key)
+  except ClientError as e:
+    app.logger.info(f'No reusable results for input {etag}: {e}')
+    return None
+  return entry
+
+
+"""Copy indexed result and log files to a new job's S3 keys
+Uses server-side (managed) copies, so nothing passes through the web
+server. Returns the job attributes for a COMPLETED job.
+"""
+def copy_reusable_results(entry, user_id, job_id, file_name):
+  results_bucket = entry['s3_results_bucket']
+  prefix = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + job_id + '~'
+  result_key = prefix + file_name[:-4] + ".annot.vcf"
+  log_key = prefix + file_name + ".count.log"
+
+  s3_client = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  s3_client.copy({'Bucket': results_bucket, 'Key': entry['s3_key_result_file']},
+    results_bucket, result_key)
+  s3_client.copy({'Bucket': results_bucket, 'Key': entry['s3_key_log_file']},
+    results_bucket, log_key)
+
+  return {
+    "job_status": "COMPLETED",
+    "s3_results_bucket": results_bucket,
+    "s3_key_result_file": result_key,
+    "s3_key_log_file": log_key,
+    "complete_time": Decimal(time.time()),
+    "reused_from_job_id": entry['job_id']
+  }
+
+
+"""Start the free user retention timer for a completed job
+Same message run.py publishes when an annotation finishes; the archive
+utility schedules the job's archival when it arrives
+"""
+def start_archive_timer(user_id, job_id, job, trace):
+  sns_client = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+  sns_client.publish(
+    TopicArn=app.config['AWS_SNS_RESULTS_READY_TOPIC'],
+    Message=json.dumps({
+      "user_id": user_id,
+      "job_id": job_id,
+      "results_bucket": job['s3_results_bucket'],
+      "annofile_path_s3": job['s3_key_result_file'],
+      "completed_at": time.time(),
+      "trace": trace.handoff()
+    }))
+
+
+JOB_STATUSES = ('PENDING', 'RUNNING', 'COMPLETED')
+
+
+"""Read one page of a user's jobs, newest first
+The status filter runs inside DynamoDB; since it applies after Limit,
+the query is repeated (at most max_queries times) until the page is
+full. Returns (items, last_key); last_key is None on the last page.
+"""
+def query_annotations_page(user_id, limit, status=None, start_key=None,
+  max_queries=10):
+  dynamodb_client = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  query_args = {
+    'TableName': app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+    'IndexName': app.config['AWS_DYNAMODB_USER_INDEX'],
+    'Select': 'SPECIFIC_ATTRIBUTES',
+    'ProjectionExpression': "job_id, user_id, submit_time, input_file_name, job_status",
+    'KeyConditionExpression': "user_id = :u",
+    'ExpressionAttributeValues': {":u": {"S": user_id}},
+    'ScanIndexForward': False,
+    'Limit': limit
+  }
+  if status:
+    query_args['FilterExpression'] = "job_status = :s"
+    query_args['ExpressionAttributeValues'][":s"] = {"S": status}
+  if start_key:
+    query_args['ExclusiveStartKey'] = start_key
+
+  items, last_key = [], None
+  for _ in range(max_queries):
+    response = dynamodb_client.query(**query_args)
+    items.extend(response['Items'])
+    last_key = response.get('LastEvaluatedKey')
+    if not last_key or len(items) >= limit:
+      break
+    query_args['ExclusiveStartKey'] = last_key
+
+  if len(items) > limit:
+    # resume right after the last job shown, not after the last one read
+    items = items[:limit]
+    last_key = {k: items[-1][k] for k in ('job_id', 'user_id', 'submit_time')}
+  return items, last_key
+
+
+"""List annotations for the user, one page at a time
+Query parameters: cursor (from the previous page), limit, status
 """
 @app.route('/annotations', methods=['GET'])
 @authenticated
 def annotations_list():
-  dynamodb_client = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  user_id = session['primary_identity']
+  limit = request.args.get('limit', app.config['ANNOTATIONS_PAGE_SIZE'], type=int)
+  limit = max(1, min(limit, app.config['ANNOTATIONS_MAX_PAGE_SIZE']))
+  status = request.args.get('status')
+  if status not in JOB_STATUSES:
+    status = None
+
+  start_key = None
+  cursor = request.args.get('cursor')
+  if cursor:
+    start_key = decode_cursor(cursor, user_id)
+    if start_key is None:
+      abort(400)
+
   try: 
-    response = dynamodb_client.query(
-      TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'], 
-      IndexName="user_id_index",
-      Select='SPECIFIC_ATTRIBUTES', 
-      ProjectionExpression="job_id, submit_time, input_file_name, job_status", 
-      KeyConditionExpression="user_id = :u", 
-      ExpressionAttributeValues={":u": {"S": session['primary_identity']}}
-      )
+    items, last_key = job_cache.get(user_id, ('list', limit, status, cursor),
+      lambda: query_annotations_page(user_id, limit, status, start_key))
   except ClientError as e: 
     app.logger.error(f'Unable to get job lists from database: {e}')
     abort(500)
   
   job_list = []
-  for item in response['Items']:
+  for item in items:
     job = {}
     job['job_id'] = item['job_id']['S']
     # referring to: https://docs.python.org/3/library/time.html#time.localtime
@@ -186,8 +705,21 @@ def annotations_list():
     job['input_file_name'] = item['input_file_name']['S']
     job['job_status'] = item['job_status']['S']
     job_list.append(job)
-  job_list.reverse()
-  return render_template('annotations.html', job_list = job_list)
+  return render_template('annotations.html', job_list = job_list,
+    rendered_at = time.time(),
+    statuses = JOB_STATUSES, status = status, limit = limit,
+    next_cursor = encode_cursor(last_key) if last_key else None,
+    is_first_page = cursor is None)
+
+
+"""Get a job item through the signed-in user's cache
+The owner check is done by the caller on the returned item, cached or not.
+"""
+def get_job_item(dynamodb_client, job_id):
+  return job_cache.get(session['primary_identity'], ('job', job_id),
+    lambda: dynamodb_client.get_item(
+      TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+      Key={'job_id': {'S': job_id}}))
 
 
 """Display details of a specific annotation job
@@ -199,9 +731,7 @@ def annotations_list():
 def annotation_details(id):
   try:
     dynamodb_client = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-    response = dynamodb_client.get_item(
-       TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'], 
-       Key={'job_id': {'S': id}})
+    response = get_job_item(dynamodb_client, id)
     # throw ResourceNotFoundException
     # referring to: https://stackoverflow.com/a/68521788/8527838
   except dynamodb_client.exceptions.ResourceNotFoundException:
@@ -262,11 +792,44 @@ def annotation_details(id):
         app.logger.error(f'Unable to download result file from S3: {e}')
         abort(500)
       job_details['result_file_url'] = result_response
+
+  job_details['has_trace'] = tracing.SPANS_ATTRIBUTE in job
     
-  return render_template('annotation.html', job_details = job_details)
+  return render_template('annotation.html', job_details = job_details,
+    rendered_at = time.time())
+
+
+"""Display the per-hop timeline of an annotation job
+"""
+@app.route('/annotations/<id>/trace', methods=['GET'])
+@authenticated
+def annotation_trace(id):
+  dynamodb_resource = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table = dynamodb_resource.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  try:
+    response = table.get_item(
+      Key={'job_id': id},
+      ProjectionExpression='job_id, user_id, job_status, trace_id, trace_spans')
+  except ClientError as e:
+    app.logger.error(f'Unable to get job trace from database: {e}')
+    abort(500)
+
+  job = response.get('Item')
+  if not job:
+    abort(404)
+  if job['user_id'] != session['primary_identity']:
+    abort(403)
+
+  spans = tracing.timeline(job.get(tracing.SPANS_ATTRIBUTE, []))
+  total_secs = max([s['offset'] + s['secs'] for s in spans] or [0])
+  return render_template('trace.html', job_id=id,
+    job_status=job['job_status'], trace_id=job.get('trace_id'),
+    spans=spans, total_secs=total_secs)
 
 
 """Display the log file contents for an annotation job
+A page of lines at a time (see view_results_object); ?raw=1 streams
+the whole file.
 """
 @app.route('/annotations/<id>/log', methods=['GET'])
 @authenticated
@@ -274,9 +837,7 @@ def annotation_log(id):
   try:
     print(id)
     dynamodb_client = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-    response = dynamodb_client.get_item(
-       TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'], 
-       Key={'job_id': {'S': id}})
+    response = get_job_item(dynamodb_client, id)
     # throw ResourceNotFoundException
     # referring to: https://stackoverflow.com/a/68521788/8527838
   except dynamodb_client.exceptions.ResourceNotFoundException:
@@ -292,22 +853,137 @@ def annotation_log(id):
     abort(403)
   s3_key_log_file = job['s3_key_log_file']['S']
 
+  return view_results_object(id, 'Annotation Log', s3_key_log_file,
+    'annotation_log')
+
+
+"""Display the annotated results file for an annotation job
+Same paging as the log; only while the results are on S3 (not archived).
+"""
+@app.route('/annotations/<id>/result', methods=['GET'])
+@authenticated
+def annotation_result(id):
+  dynamodb_client = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  try:
+    response = get_job_item(dynamodb_client, id)
+  except ClientError as e:
+    app.logger.error(f'Unable to get job from database: {e}')
+    abort(500)
+
+  job = response.get('Item')
+  if not job:
+    abort(404)
+  if job['user_id']['S'] != session['primary_identity']:
+    abort(403)
+  if 's3_key_result_file' not in job:
+    abort(404)
+
+  return view_results_object(id, 'Annotated Results',
+    job['s3_key_result_file']['S'], 'annotation_result')
+
+
+"""Render one page of lines of a results bucket object, or stream it all
+Query parameters: lines (page length), start (byte offset of the first
+line: "head" and "next"), end (byte offset just past the last line:
+"previous"), tail (last page), raw (whole object as text/plain). Only
+the blocks around the requested page are fetched, with ranged GETs.
+"""
+def view_results_object(job_id, title, key, endpoint):
+  bucket = app.config['AWS_S3_RESULTS_BUCKET']
+  count = request.args.get('lines', app.config['ANNOTATION_VIEWER_LINES'], type=int)
+  count = max(1, min(count, app.config['ANNOTATION_VIEWER_MAX_LINES']))
+
   s3_client = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
-  try: 
-    response = s3_client.get_object(
-      Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
-      Key=s3_key_log_file)
-  except ClientError as e: 
-    app.logger.error(f'Unable to locate file on S3: {e}')
+  try:
+    size = ranged.object_size(s3_client, bucket, key)
+    if request.args.get('raw'):
+      return Response(ranged.iter_object(s3_client, bucket, key, size),
+        mimetype='text/plain',
+        headers={'Content-Length': str(size)})
+
+    end = request.args.get('end', type=int)
+    if request.args.get('tail'):
+      end = size
+    if end is not None:
+      end = max(0, min(end, size))
+      lines, start, truncated = ranged.read_backward(
+        s3_client, bucket, key, size, end, count)
+    else:
+      start = max(0, min(request.args.get('start', 0, type=int), size))
+      lines, end, truncated = ranged.read_forward(
+        s3_client, bucket, key, size, start, count)
+  except ClientError as e:
+    app.logger.error(f'Unable to read file on S3: {e}')
     code = e.response['Error']['Code']
-    if code == 'NoSuchKey' or code == 'NoSuchBucket': 
+    if code in ('NoSuchKey', 'NoSuchBucket', '404'):
       abort(404)
-    else: 
+    else:
       abort(500)
 
-  log_file_contents = response['Body'].read().decode()
+  return render_template('view_log.html', job_id = job_id, title = title,
+    endpoint = endpoint, lines = lines, count = count, start = start,
+    end = end, size = size, truncated = truncated)
+
 
-  return render_template('view_log.html', job_id = id, log_file_contents = log_file_contents)
+"""Job status change notifications from the annotator (SNS over HTTPS)
+Confirms the subscription, then drops the job owner's cached listings
+and details whenever a job changes status, and passes the change on to
+the owner's open event streams. Not behind @authenticated: only messages
+signed by SNS for the configured topic are acted on.
+"""
+@app.route('/annotations/status-events', methods=['POST'])
+def annotation_status_events():
+  try:
+    envelope = json.loads(request.get_data(as_text=True))
+  except ValueError:
+    abort(400)
+  topic_arn = app.config['AWS_SNS_JOB_STATUS_TOPIC']
+  region = sns_messages.topic_region(topic_arn)
+  if not isinstance(envelope, dict) or envelope.get('TopicArn') != topic_arn:
+    abort(403)
+  if not sns_messages.verify_message(envelope, region):
+    app.logger.warning('Rejected job status message with an invalid signature')
+    abort(403)
+
+  if envelope.get('Type') == 'SubscriptionConfirmation':
+    subscribe_url = envelope.get('SubscribeURL')
+    if not sns_messages.is_sns_url(subscribe_url, region):
+      abort(400)
+    try:
+      urllib.request.urlopen(subscribe_url, timeout=10).read()
+    except OSError as e:
+      app.logger.error(f'Unable to confirm job status subscription: {e}')
+      abort(500)
+    return jsonify({'code': 200, 'message': 'Subscription confirmed'}), 200
+
+  if envelope.get('Type') == 'Notification':
+    try:
+      event = json.loads(envelope['Message'])
+      user_id = event['user_id']
+    except (KeyError, TypeError, ValueError):
+      abort(400)
+    job_cache.invalidate_user(user_id)
+    status_broker.publish(user_id, event)
+
+  return jsonify({'code': 200, 'message': 'OK'}), 200
+
+
+"""Stream the user's job status changes as server-sent events
+Query parameters: job_id (only that job), since (epoch seconds the page
+was rendered, so changes before the stream opened are replayed).
+"""
+@app.route('/annotations/events', methods=['GET'])
+@authenticated
+def annotation_events():
+  user_id = session['primary_identity']
+  after_id = request.headers.get('Last-Event-ID', 0, type=int)
+  since = request.args.get('since', 0, type=float)
+  job_id = request.args.get('job_id')
+  return Response(
+    event_stream(status_broker, user_id, after_id, since, job_id,
+      poll_secs=app.config['GAS_STATUS_POLL_SECS']),
+    mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 """Subscription management handler
@@ -358,9 +1034,10 @@ def subscribe():
       identity_id=session['primary_identity'],
       role="premium_user"
       )
+    invalidate_profile(session['primary_identity'])
 
     # Update role in the session
-    session['role'] == "premium_user"
+    session['role'] = "premium_user"
 
 
     # Request restoration of the user's data from Glacier
@@ -391,6 +1068,7 @@ def make_me_premium():
     identity_id=session['primary_identity'],
     role="premium_user"
   )
+  invalidate_profile(session['primary_identity'])
   return redirect(url_for('profile'))
 
 
@@ -404,6 +1082,7 @@ def unsubscribe():
     identity_id=session['primary_identity'],
     role="free_user"
   )
+  invalidate_profile(session['primary_identity'])
   return redirect(url_for('profile'))
 
 